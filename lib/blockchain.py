@@ -21,7 +21,10 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import mmap
+import hashlib
 import threading
+import time
 
 from . import util
 from .bitcoin import Hash, hash_encode, int_to_hex, rev_hex
@@ -29,6 +32,13 @@ from . import constants
 from .util import bfh, bh2u
 
 MAX_TARGET = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
+# headers saved one by one are written and synced to disk in batches,
+# when this many are pending or the oldest one has waited this long (seconds)
+COMMIT_HEADERS = 2016
+COMMIT_INTERVAL = 10
+# up to this many bytes (one chunk), hashing in other processes costs
+# more than it saves
+PARALLEL_HASH_MIN = 80 * 2016
 
 
 class MissingHeader(Exception):
@@ -68,10 +78,62 @@ def hash_header(header):
     return hash_encode(Hash(bfh(serialize_header(header))))
 
 
+def hash_raw_headers(data):
+    '''Double SHA256 of each 80-byte header in data, in internal byte order'''
+    sha256 = hashlib.sha256
+    return [sha256(sha256(data[i:i+80]).digest()).digest()
+            for i in range(0, len(data) - 79, 80)]
+
+def hash_headers(data, executor=None, workers=1):
+    '''Like hash_raw_headers; if an executor with several workers is
+    given, inputs larger than a chunk are split and hashed in parallel'''
+    if executor is None or workers < 2 or len(data) <= PARALLEL_HASH_MIN:
+        return hash_raw_headers(data)
+    step = (len(data) // 80 + workers - 1) // workers * 80
+    parts = [bytes(data[i:i+step]) for i in range(0, len(data), step)]
+    hashes = []
+    for part in executor.map(hash_raw_headers, parts):
+        hashes.extend(part)
+    return hashes
+
+def verify_raw_headers(data, hashes, prev_hash, target, bits):
+    '''Check that the headers in data are linked, starting from prev_hash
+    (internal byte order), and that they match bits and target.
+    If bits is None, only the linkage is checked.'''
+    for i in range(len(hashes)):
+        raw_header = data[i*80:(i+1)*80]
+        if raw_header[4:36] != prev_hash:
+            raise Exception("prev hash mismatch at header %d: %s vs %s"
+                            % (i, hash_encode(prev_hash), hash_encode(raw_header[4:36])))
+        _hash = hashes[i]
+        if bits is not None:
+            header_bits = int.from_bytes(raw_header[72:76], 'little')
+            if header_bits != bits:
+                raise Exception("bits mismatch: %s vs %s" % (bits, header_bits))
+            if int.from_bytes(_hash, 'little') > target:
+                raise Exception("insufficient proof of work: %s vs target %s"
+                                % (int.from_bytes(_hash, 'little'), target))
+        prev_hash = _hash
+
+_hash_executor = None
+
+def get_hash_executor(config):
+    '''Process pool used to hash headers, if enabled with the
+    'header_hash_processes' config variable'''
+    global _hash_executor
+    n = config.get('header_hash_processes', 0)
+    if _hash_executor is None and n > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        _hash_executor = ProcessPoolExecutor(max_workers=n)
+    return _hash_executor
+
+
 blockchains = {}
 
 def read_blockchains(config):
     blockchains[0] = Blockchain(config, 0, None)
+    if os.path.exists(blockchains[0].path()):
+        blockchains[0].truncate_unverified()
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
     util.make_dir(fdir)
     l = filter(lambda x: x.startswith('fork_'), os.listdir(fdir))
@@ -80,9 +142,11 @@ def read_blockchains(config):
         checkpoint = int(filename.split('_')[2])
         parent_id = int(filename.split('_')[1])
         b = Blockchain(config, checkpoint, parent_id)
+        b.truncate_unverified()
         h = b.read_header(b.checkpoint)
         if b.parent().can_connect(h, check_height=False):
             blockchains[b.checkpoint] = b
+            b.parent().children.append(b)
         else:
             util.print_error("cannot connect", filename)
     return blockchains
@@ -113,7 +177,12 @@ class Blockchain(util.PrintError):
         self.checkpoint = checkpoint
         self.checkpoints = constants.net.CHECKPOINTS
         self.parent_id = parent_id
+        self.children = []  # forks of this chain; their parent_id is our checkpoint
         self.lock = threading.Lock()
+        self._mmap = None
+        self._hashes = bytearray()  # 32 bytes per header, zeros if not known yet
+        self._pending = bytearray()  # verified headers not written to disk yet
+        self._pending_time = None
         with self.lock:
             self.update_size()
 
@@ -121,8 +190,7 @@ class Blockchain(util.PrintError):
         return blockchains[self.parent_id]
 
     def get_max_child(self):
-        children = list(filter(lambda y: y.parent_id==self.checkpoint, blockchains.values()))
-        return max([x.checkpoint for x in children]) if children else None
+        return max([x.checkpoint for x in self.children]) if self.children else None
 
     def get_checkpoint(self):
         mc = self.get_max_child()
@@ -143,6 +211,7 @@ class Blockchain(util.PrintError):
         checkpoint = header.get('block_height')
         self = Blockchain(parent.config, checkpoint, parent.checkpoint)
         open(self.path(), 'w+').close()
+        parent.children.append(self)
         self.save_header(header)
         return self
 
@@ -154,8 +223,27 @@ class Blockchain(util.PrintError):
             return self._size
 
     def update_size(self):
+        self.close_mmap()
         p = self.path()
         self._size = os.path.getsize(p)//80 if os.path.exists(p) else 0
+        self._size += len(self._pending) // 80
+        del self._hashes[self._size*32:]
+
+    def close_mmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _read_raw_header(self, delta):
+        file_size = self._size - len(self._pending) // 80
+        if delta >= file_size:
+            return bytes(self._pending[(delta - file_size)*80:(delta - file_size + 1)*80])
+        if self._mmap is None:
+            name = self.path()
+            self.assert_headers_file_available(name)
+            with open(name, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap[delta*80:(delta+1)*80]
 
     def verify_header(self, header, prev_hash, target):
         _hash = hash_header(header)
@@ -169,29 +257,36 @@ class Blockchain(util.PrintError):
         if int('0x' + _hash, 16) > target:
             raise Exception("insufficient proof of work: %s vs target %s" % (int('0x' + _hash, 16), target))
 
-    def verify_chunk(self, index, data):
-        num = len(data) // 80
-        prev_hash = self.get_hash(index * 2016 - 1)
+    def verify_chunk(self, index, data, hashes=None):
+        if len(data) % 80:
+            raise Exception('Invalid chunk length: {}'.format(len(data)))
+        prev_hash = bfh(self.get_hash(index * 2016 - 1))[::-1]
         target = self.get_target(index-1)
-        for i in range(num):
-            raw_header = data[i*80:(i+1) * 80]
-            header = deserialize_header(raw_header, index*2016 + i)
-            self.verify_header(header, prev_hash, target)
-            prev_hash = hash_header(header)
+        bits = None if constants.net.TESTNET else self.target_to_bits(target)
+        if hashes is None:
+            hashes = self.hash_headers(data)
+        verify_raw_headers(data, hashes, prev_hash, target, bits)
+        return hashes
+
+    def hash_headers(self, data):
+        return hash_headers(data, get_hash_executor(self.config),
+                            self.config.get('header_hash_processes', 0))
 
     def path(self):
         d = util.get_headers_dir(self.config)
         filename = 'blockchain_headers' if self.parent_id is None else os.path.join('forks', 'fork_%d_%d'%(self.parent_id, self.checkpoint))
         return os.path.join(d, filename)
 
-    def save_chunk(self, index, chunk):
+    def save_chunk(self, index, chunk, hashes=None):
         filename = self.path()
         d = (index * 2016 - self.checkpoint) * 80
         if d < 0:
             chunk = chunk[-d:]
+            if hashes is not None:
+                hashes = hashes[-d//80:]
             d = 0
         truncate = index >= len(self.checkpoints)
-        self.write(chunk, d, truncate)
+        self.write(chunk, d, truncate, hashes)
         self.swap_with_parent()
 
     def swap_with_parent(self):
@@ -204,6 +299,9 @@ class Blockchain(util.PrintError):
         parent_id = self.parent_id
         checkpoint = self.checkpoint
         parent = self.parent()
+        self.commit()
+        parent.commit()
+        # only the headers above our checkpoint are exchanged
         self.assert_headers_file_available(self.path())
         with open(self.path(), 'rb') as f:
             my_data = f.read()
@@ -213,23 +311,44 @@ class Blockchain(util.PrintError):
             parent_data = f.read(parent_branch_size*80)
         self.write(parent_data, 0)
         parent.write(my_data, (checkpoint - parent.checkpoint)*80)
-        # store file path
-        for b in blockchains.values():
-            b.old_path = b.path()
-        # swap parameters
-        self.parent_id = parent.parent_id; parent.parent_id = parent_id
-        self.checkpoint = parent.checkpoint; parent.checkpoint = checkpoint
-        self._size = parent._size; parent._size = parent_branch_size
-        # move files
-        for b in blockchains.values():
-            if b in [self, parent]: continue
-            if b.old_path != b.path():
-                self.print_error("renaming", b.old_path, b.path())
-                os.rename(b.old_path, b.path())
+        # self now holds the headers of parent above checkpoint, and
+        # parent holds ours: swap their identities. Readers must not see
+        # the new sizes with the old paths, nor map the old files.
+        with self.lock, parent.lock:
+            self.close_mmap()
+            parent.close_mmap()
+            self._size, parent._size = parent._size, self._size
+            self._hashes, parent._hashes = parent._hashes, self._hashes
+            self.parent_id = parent.parent_id; parent.parent_id = parent_id
+            self.checkpoint = parent.checkpoint; parent.checkpoint = checkpoint
+        if self.parent_id is not None:
+            grandparent = self.parent()
+            grandparent.children.remove(parent)
+            grandparent.children.append(self)
+        # forks of parent above checkpoint now branch off parent, ours
+        # and those below checkpoint off self
+        children = [c for c in parent.children if c != self]
+        self.children += [c for c in children if c.checkpoint < checkpoint] + [parent]
+        parent.children = [c for c in children if c.checkpoint > checkpoint]
+        for b in self.children:
+            b.set_parent_id(self.checkpoint)
+        for b in parent.children:
+            b.set_parent_id(parent.checkpoint)
         # update pointers
         blockchains[self.checkpoint] = self
         blockchains[parent.checkpoint] = parent
 
+    def set_parent_id(self, parent_id):
+        if parent_id == self.parent_id:
+            return
+        with self.lock:
+            old_path = self.path()
+            # mapped files cannot be renamed on Windows
+            self.close_mmap()
+            self.parent_id = parent_id
+            self.print_error("renaming", old_path, self.path())
+            os.rename(old_path, self.path())
+
     def assert_headers_file_available(self, path):
         if os.path.exists(path):
             return
@@ -238,28 +357,111 @@ class Blockchain(util.PrintError):
         else:
             raise FileNotFoundError('Cannot find headers file but headers_dir is there. Should be at {}'.format(path))
 
-    def write(self, data, offset, truncate=True):
+    def write(self, data, offset, truncate=True, hashes=None):
         filename = self.path()
         with self.lock:
+            self._commit()
             self.assert_headers_file_available(filename)
+            self.close_mmap()
             with open(filename, 'rb+') as f:
                 if truncate and offset != self._size*80:
                     f.seek(offset)
                     f.truncate()
+                    del self._hashes[offset//80*32:]
                 f.seek(offset)
                 f.write(data)
                 f.flush()
                 os.fsync(f.fileno())
             self.update_size()
+            self._store_hashes(offset // 80, data, hashes)
+
+    def _store_hashes(self, delta, data, hashes=None):
+        if hashes is None:
+            hashes = hash_raw_headers(data)
+        for i, h in enumerate(hashes):
+            if data[i*80:(i+1)*80] != bytes(80):
+                self._set_hash(delta + i, h)
+
+    def _set_hash(self, delta, h):
+        if len(self._hashes) < (delta + 1) * 32:
+            self._hashes.extend(bytes((delta + 1) * 32 - len(self._hashes)))
+        self._hashes[delta*32:(delta+1)*32] = h
+
+    def commit(self):
+        '''Write pending headers to disk'''
+        with self.lock:
+            self._commit()
+
+    def maybe_commit(self):
+        '''Write pending headers to disk if enough of them are waiting,
+        or if they have been waiting for long enough'''
+        with self.lock:
+            if not self._pending:
+                return
+            if (len(self._pending) // 80 >= COMMIT_HEADERS
+                    or time.time() - self._pending_time > COMMIT_INTERVAL):
+                self._commit()
+
+    def _commit(self):
+        if not self._pending:
+            return
+        filename = self.path()
+        self.assert_headers_file_available(filename)
+        self.close_mmap()
+        with open(filename, 'rb+') as f:
+            f.seek((self._size - len(self._pending) // 80) * 80)
+            f.truncate()
+            f.write(self._pending)
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending = bytearray()
+        self._pending_time = None
+        self.update_size()
+
+    def replace_headers_file(self, filename):
+        '''Atomically replace our headers file with filename'''
+        with self.lock:
+            self.close_mmap()
+            self._pending = bytearray()
+            self._pending_time = None
+            os.replace(filename, self.path())
+            self._hashes = bytearray()
+            self.update_size()
 
     def save_header(self, header):
         delta = header.get('block_height') - self.checkpoint
         data = bfh(serialize_header(header))
         assert delta == self.size()
         assert len(data) == 80
-        self.write(data, delta*80)
+        with self.lock:
+            if not self._pending:
+                self._pending_time = time.time()
+            self._pending += data
+            self._size += 1
+            self._set_hash(delta, Hash(data))
+        self.maybe_commit()
         self.swap_with_parent()
 
+    def truncate_unverified(self):
+        '''Drop headers at the end of the file that do not connect to the
+        ones before them, e.g. after a crash during a write.'''
+        self.assert_headers_file_available(self.path())
+        with self.lock:
+            self.close_mmap()
+            if os.path.getsize(self.path()) % 80:
+                self.print_error("truncating partial header")
+                with open(self.path(), 'rb+') as f:
+                    f.truncate(self._size * 80)
+        # headers are appended in batches, so only the last ones can be bad
+        start = max(self.checkpoint + 1, len(self.checkpoints) * 2016,
+                    self.height() - 2 * COMMIT_HEADERS)
+        for height in range(start, self.height() + 1):
+            header = self.read_header(height)
+            if header is None or header.get('prev_block_hash') != self.get_hash(height - 1):
+                self.print_error("truncating at height", height)
+                self.write(b'', (height - self.checkpoint) * 80)
+                break
+
     def read_header(self, height):
         assert self.parent_id != self.checkpoint
         if height < 0:
@@ -269,13 +471,10 @@ class Blockchain(util.PrintError):
         if height > self.height():
             return
         delta = height - self.checkpoint
-        name = self.path()
-        self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * 80)
-            h = f.read(80)
-            if len(h) < 80:
-                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
+        with self.lock:
+            h = self._read_raw_header(delta)
+        if len(h) < 80:
+            raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
         if h == bytes([0])*80:
             return None
         return deserialize_header(h, height)
@@ -290,8 +489,26 @@ class Blockchain(util.PrintError):
             index = height // 2016
             h, t = self.checkpoints[index]
             return h
+        elif height < self.checkpoint:
+            return self.parent().get_hash(height)
+        elif height > self.height():
+            return hash_header(None)
         else:
-            return hash_header(self.read_header(height))
+            return hash_encode(self.get_raw_hash(height - self.checkpoint))
+
+    def get_raw_hash(self, delta):
+        with self.lock:
+            h = self._hashes[delta*32:(delta+1)*32]
+            if h and h != bytes(32):
+                return bytes(h)
+            raw_header = self._read_raw_header(delta)
+            if len(raw_header) < 80:
+                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(raw_header)))
+            if raw_header == bytes(80):
+                return bytes(32)
+            h = Hash(raw_header)
+            self._set_hash(delta, h)
+            return h
 
     def get_target(self, index):
         # compute target from chunk x, used in chunk x+1
@@ -307,6 +524,11 @@ class Blockchain(util.PrintError):
         last = self.read_header(index * 2016 + 2015)
         if not first or not last:
             raise MissingHeader()
+        return self.compute_target(first, last)
+
+    def compute_target(self, first, last):
+        '''Target following the chunk starting with header first and
+        ending with header last'''
         bits = last.get('bits')
         target = self.bits_to_target(bits)
         nActualTimespan = last.get('timestamp') - first.get('timestamp')
@@ -361,15 +583,35 @@ class Blockchain(util.PrintError):
         return True
 
     def connect_chunk(self, idx, hexdata):
-        try:
-            data = bfh(hexdata)
-            self.verify_chunk(idx, data)
-            #self.print_error("validated chunk %d" % idx)
-            self.save_chunk(idx, data)
-            return True
-        except BaseException as e:
-            self.print_error('verify_chunk %d failed'%idx, str(e))
-            return False
+        return self.connect_chunks(idx, [hexdata]) == 1
+
+    def connect_chunks(self, index, hexdatas):
+        '''Verify and save consecutive chunks, starting at index. They are
+        hashed together, so that a process pool has enough work to share.
+        Returns the number of chunks connected.'''
+        chunks = []
+        for hexdata in hexdatas:
+            try:
+                data = bfh(hexdata)
+            except ValueError:
+                break
+            if len(data) % 80:
+                break
+            chunks.append(data)
+        if len(chunks) < len(hexdatas):
+            self.print_error('invalid chunk %d' % (index + len(chunks)))
+        hashes = self.hash_headers(b''.join(chunks))
+        pos = 0
+        for i, data in enumerate(chunks):
+            chunk_hashes = hashes[pos:pos + len(data) // 80]
+            pos += len(data) // 80
+            try:
+                self.verify_chunk(index + i, data, chunk_hashes)
+                self.save_chunk(index + i, data, chunk_hashes)
+            except BaseException as e:
+                self.print_error('verify_chunk %d failed' % (index + i), str(e))
+                return i
+        return len(chunks)
 
     def get_checkpoints(self):
         # for each chunk, store the hash of the last block and the target after the chunk
@@ -22,6 +22,7 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import time
 from collections import defaultdict, namedtuple
 from math import floor, log10
 
@@ -76,11 +77,53 @@ Bucket = namedtuple('Bucket',
                      'min_height',  # min block height where a coin was confirmed
                      'witness'])    # whether any coin uses segwit
 
-def strip_unneeded(bkts, sufficient_funds):
+
+class Totals(namedtuple('Totals', ['value', 'weight', 'witness', 'legacy_inputs'])):
+    '''Running totals of a list of buckets'''
+
+    def add(self, bkt):
+        return Totals(self.value + bkt.value,
+                      self.weight + bkt.weight,
+                      self.witness or bkt.witness,
+                      self.legacy_inputs + (0 if bkt.witness else len(bkt.coins)))
+
+NO_BUCKETS = Totals(0, 0, False, 0)
+
+def totals(bkts, start=NO_BUCKETS):
+    for bkt in bkts:
+        start = start.add(bkt)
+    return start
+
+
+# Estimating the weight of an input serializes it.  Inputs of the
+# same kind have the same weight, so it is computed once per kind.
+input_weights = {}
+
+def input_weight(coin, is_segwit_tx):
+    if coin.get('scriptSig') is not None or coin.get('witness') not in (None, '00') \
+            or coin['type'] in ('coinbase', 'unknown'):
+        return Transaction.estimated_input_weight(coin, is_segwit_tx)
+    key = (coin['type'],
+           Transaction.guess_txintype_from_address(coin['address']) if coin['type'] == 'address' else None,
+           coin.get('num_sig', 1),
+           len(coin.get('x_pubkeys', [None])),
+           Transaction.estimate_pubkey_size_for_txin(coin),
+           is_segwit_tx)
+    weight = input_weights.get(key)
+    if weight is None:
+        weight = input_weights[key] = Transaction.estimated_input_weight(coin, is_segwit_tx)
+    return weight
+
+
+def strip_unneeded(bkts, sufficient_funds, start=NO_BUCKETS):
     '''Remove buckets that are unnecessary in achieving the spend amount'''
     bkts = sorted(bkts, key = lambda bkt: bkt.value)
+    # suffix[i] are the totals of bkts[i:]
+    suffix = [start] * (len(bkts) + 1)
+    for i in reversed(range(len(bkts))):
+        suffix[i] = suffix[i + 1].add(bkts[i])
     for i in range(len(bkts)):
-        if not sufficient_funds(bkts[i + 1:]):
+        if not sufficient_funds(suffix[i + 1]):
             return bkts[i:]
     # Shouldn't get here
     return bkts
@@ -102,8 +145,7 @@ class CoinChooserBase(PrintError):
             witness = any(Transaction.is_segwit_input(coin, guess_for_address=True) for coin in coins)
             # note that we're guessing whether the tx uses segwit based
             # on this single bucket
-            weight = sum(Transaction.estimated_input_weight(coin, witness)
-                         for coin in coins)
+            weight = sum(input_weight(coin, witness) for coin in coins)
             value = sum(coin['value'] for coin in coins)
             min_height = min(coin['height'] for coin in coins)
             return Bucket(desc, weight, value, coins, min_height, witness)
@@ -211,26 +253,30 @@ class CoinChooserBase(PrintError):
         def fee_estimator_w(weight):
             return fee_estimator(Transaction.virtual_size_from_weight(weight))
 
-        def get_tx_weight(buckets):
-            total_weight = base_weight + sum(bucket.weight for bucket in buckets)
-            is_segwit_tx = any(bucket.witness for bucket in buckets)
-            if is_segwit_tx:
+        def get_tx_weight(t):
+            total_weight = base_weight + t.weight
+            if t.witness:
                 total_weight += 2  # marker and flag
                 # non-segwit inputs were previously assumed to have
                 # a witness of '' instead of '00' (hex)
                 # note that mixed legacy/segwit buckets are already ok
-                num_legacy_inputs = sum((not bucket.witness) * len(bucket.coins)
-                                        for bucket in buckets)
-                total_weight += num_legacy_inputs
+                total_weight += t.legacy_inputs
 
             return total_weight
 
-        def sufficient_funds(buckets):
-            '''Given a list of buckets, return True if it has enough
-            value to pay for the transaction'''
-            total_input = sum(bucket.value for bucket in buckets)
-            total_weight = get_tx_weight(buckets)
-            return total_input >= spent_amount + fee_estimator_w(total_weight)
+        def sufficient_funds(t):
+            '''Given the totals of a list of buckets, return True if it
+            has enough value to pay for the transaction'''
+            return t.value >= spent_amount + fee_estimator_w(get_tx_weight(t))
+
+        # Used by choosers that work with effective values.  The change
+        # address is not known yet if we send back to an input address.
+        self.base_weight = base_weight
+        self.spent_amount = spent_amount
+        self.fee_estimator_w = fee_estimator_w
+        self.dust_threshold = dust_threshold
+        change_addr = change_addrs[0] if change_addrs else coins[0]['address'] if coins else None
+        self.change_weight = 4 * Transaction.estimated_output_size(change_addr) if change_addr else 0
 
         # Collect the coins into buckets, choose a subset of the buckets
         buckets = self.bucketize_coins(coins)
@@ -238,7 +284,7 @@ class CoinChooserBase(PrintError):
                                       self.penalty_func(tx))
 
         tx.add_inputs([coin for b in buckets for coin in b.coins])
-        tx_weight = get_tx_weight(buckets)
+        tx_weight = get_tx_weight(totals(buckets))
 
         # change is sent back to sending address unless specified
         if not change_addrs:
@@ -264,8 +310,9 @@ class CoinChooserBase(PrintError):
 
 class CoinChooserRandom(CoinChooserBase):
 
-    def bucket_candidates_any(self, buckets, sufficient_funds):
-        '''Returns a list of bucket sets.'''
+    def bucket_candidates_any(self, buckets, sufficient_funds, start=NO_BUCKETS):
+        '''Returns a list of bucket sets, which are enough together
+        with buckets of totals start.'''
         if not buckets:
             raise NotEnoughFunds()
 
@@ -273,20 +320,21 @@ class CoinChooserRandom(CoinChooserBase):
 
         # Add all singletons
         for n, bucket in enumerate(buckets):
-            if sufficient_funds([bucket]):
+            if sufficient_funds(start.add(bucket)):
                 candidates.add((n, ))
 
         # And now some random ones
         attempts = min(100, (len(buckets) - 1) * 10 + 1)
         permutation = list(range(len(buckets)))
         for i in range(attempts):
-            # Get a random permutation of the buckets, and
-            # incrementally combine buckets until sufficient
-            self.p.shuffle(permutation)
-            bkts = []
-            for count, index in enumerate(permutation):
-                bkts.append(buckets[index])
-                if sufficient_funds(bkts):
+            # Draw a random permutation of the buckets, only as far
+            # as needed, and incrementally combine buckets until sufficient
+            t = start
+            for count in range(len(permutation)):
+                j = self.p.randint(count, len(permutation))
+                permutation[count], permutation[j] = permutation[j], permutation[count]
+                t = t.add(buckets[permutation[count]])
+                if sufficient_funds(t):
                     candidates.add(tuple(sorted(permutation[:count + 1])))
                     break
             else:
@@ -295,7 +343,7 @@ class CoinChooserRandom(CoinChooserBase):
                 raise NotEnoughFunds()
 
         candidates = [[buckets[n] for n in c] for c in candidates]
-        return [strip_unneeded(c, sufficient_funds) for c in candidates]
+        return [strip_unneeded(c, sufficient_funds, start) for c in candidates]
 
     def bucket_candidates_prefer_confirmed(self, buckets, sufficient_funds):
         """Returns a list of bucket sets preferring confirmed coins.
@@ -315,19 +363,21 @@ class CoinChooserRandom(CoinChooserBase):
 
         bucket_sets = [conf_buckets, unconf_buckets, other_buckets]
         already_selected_buckets = []
+        already_selected = NO_BUCKETS
 
         for bkts_choose_from in bucket_sets:
             try:
-                def sfunds(bkts):
-                    return sufficient_funds(already_selected_buckets + bkts)
-
-                candidates = self.bucket_candidates_any(bkts_choose_from, sfunds)
+                candidates = self.bucket_candidates_any(bkts_choose_from, sufficient_funds,
+                                                        already_selected)
                 break
             except NotEnoughFunds:
                 already_selected_buckets += bkts_choose_from
+                already_selected = totals(bkts_choose_from, already_selected)
         else:
             raise NotEnoughFunds()
 
+        if not already_selected_buckets:
+            return candidates
         candidates = [(already_selected_buckets + c) for c in candidates]
         return [strip_unneeded(c, sufficient_funds) for c in candidates]
 
@@ -375,8 +425,119 @@ class CoinChooserPrivacy(CoinChooserRandom):
         return penalty
 
 
+class CoinChooserBranchAndBound(CoinChooserPrivacy):
+    """Looks for a set of coins that pays for the transaction without
+    change, with as little excess as possible, by a depth-first search
+    over their effective values (value minus the fee to spend them).
+    Coins of a user address are spent together, as with Privacy.
+    If there is no such set, or the search takes too long, coins are
+    chosen as with Privacy.
+    """
+
+    max_tries = 100000
+    time_budget = 0.2  # seconds
+
+    def branch_and_bound(self, values, target, upper, deadline=None):
+        '''Returns the indices of values, sorted in decreasing order, whose
+        sum is in [target, upper] and closest to target, or None.'''
+        n = len(values)
+        remaining = [0] * (n + 1)
+        for i in reversed(range(n)):
+            remaining[i] = remaining[i + 1] + values[i]
+        if remaining[0] < target:
+            return None
+        if deadline is None:
+            deadline = time.time() + self.time_budget
+        best, best_excess = None, None
+        selection = []
+        total = 0
+        i = 0
+        for tries in range(self.max_tries):
+            if total + remaining[i] < target or total > upper:
+                backtrack = True
+            elif total >= target:
+                excess = total - target
+                if best is None or excess < best_excess:
+                    best, best_excess = list(selection), excess
+                    if excess == 0:
+                        break
+                backtrack = True
+            else:
+                backtrack = False
+            if not backtrack:
+                selection.append(i)
+                total += values[i]
+                i += 1
+                continue
+            if not selection:
+                break
+            # exclude the last included value, and its duplicates which
+            # would lead to equivalent sets
+            j = selection.pop()
+            total -= values[j]
+            i = j + 1
+            while i < n and values[i] == values[j]:
+                i += 1
+            if tries % 1000 == 0 and time.time() > deadline:
+                self.print_error("branch and bound: out of time")
+                break
+        return best
+
+    def search_changeless(self, buckets, is_segwit_tx, deadline):
+        '''Returns the estimated excess and the buckets of a changeless
+        set, assuming the transaction uses segwit or not, or None'''
+        fee = self.fee_estimator_w
+        base_weight = self.base_weight + (2 if is_segwit_tx else 0)
+        base_fee = fee(base_weight)
+        def effective_value(bkt):
+            weight = bkt.weight + (0 if bkt.witness or not is_segwit_tx else len(bkt.coins))
+            return bkt.value - (fee(base_weight + weight) - base_fee)
+        target = self.spent_amount + base_fee
+        # change below this is not worth creating, and goes to fees
+        cost_of_change = fee(base_weight + self.change_weight) - base_fee + self.dust_threshold
+        values = [(effective_value(bkt), bkt) for bkt in buckets]
+        values = sorted([v for v in values if v[0] > 0], key=lambda v: -v[0])
+        selection = self.branch_and_bound([v[0] for v in values], target,
+                                          target + cost_of_change - 1, deadline)
+        if selection is None:
+            return None
+        return sum(values[i][0] for i in selection) - target, [values[i][1] for i in selection]
+
+    def changeless_buckets(self, buckets, sufficient_funds):
+        # fees depend on whether the transaction uses segwit, so sets of
+        # legacy buckets and sets with a segwit bucket are searched
+        # separately. The latter search may also return a legacy set,
+        # which then pays a little more fee than needed.
+        deadline = time.time() + self.time_budget
+        legacy = [bkt for bkt in buckets if not bkt.witness]
+        searches = [(legacy, False)] if legacy else []
+        if len(legacy) < len(buckets):
+            searches.append((buckets, True))
+        results = []
+        for bkts, is_segwit_tx in searches:
+            result = self.search_changeless(bkts, is_segwit_tx, deadline)
+            if result is not None:
+                results.append(result)
+        # effective values are an estimate; sufficient_funds has the last word
+        for excess, bkts in sorted(results, key=lambda r: r[0]):
+            if sufficient_funds(totals(bkts)):
+                return bkts
+        return None
+
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func):
+        conf_buckets = [bkt for bkt in buckets if bkt.min_height > 0]
+        bucket_sets = [conf_buckets, buckets] if len(conf_buckets) < len(buckets) else [buckets]
+        for bkts in bucket_sets:
+            winner = self.changeless_buckets(bkts, sufficient_funds)
+            if winner:
+                self.print_error("Changeless bucket set:", len(winner))
+                return winner
+        return super().choose_buckets(buckets, sufficient_funds, penalty_func)
+
+
 COIN_CHOOSERS = {
     'Privacy': CoinChooserPrivacy,
+    'BranchAndBound': CoinChooserBranchAndBound,
 }
 
 def get_name(config):
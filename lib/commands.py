@@ -23,13 +23,18 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import os
 import sys
 import datetime
+import tempfile
+import time
 import copy
 import argparse
 import json
 import ast
 import base64
+import bisect
+import itertools
 from functools import wraps
 from decimal import Decimal
 
@@ -39,8 +44,13 @@ from .import bitcoin
 from .bitcoin import is_address,  hash_160, COIN, TYPE_ADDRESS
 from .i18n import _
 from .transaction import Transaction, multisig_script
+from . import paymentrequest
+from .consolidation import ConsolidationPlanner, MAX_INPUTS
 from .paymentrequest import PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED
 from .plugins import run_hook
+from .network import serialize_server
+from . import blockchain
+from . import headers_snapshot
 
 known_commands = {}
 
@@ -50,6 +60,37 @@ def satoshis(amount):
     return int(COIN*Decimal(amount)) if amount not in ['!', None] else amount
 
 
+def paginate(items, key, limit=None, cursor=None):
+    '''Returns the items following the one whose key is cursor, at most
+    limit of them, and the cursor of the next page, or None if there
+    are no more items. Only the page is kept in memory.'''
+    if limit is not None and limit <= 0:
+        raise BaseException('limit must be positive')
+    items = iter(items)
+    if cursor is not None:
+        for item in items:
+            if key(item) == cursor:
+                break
+        else:
+            raise BaseException('Unknown cursor: %s' % cursor)
+    page = list(itertools.islice(items, limit))
+    end = object()
+    if page and limit is not None and next(items, end) is not end:
+        return page, key(page[-1])
+    return page, None
+
+
+def seek(items, start):
+    '''Iterates over items from index start, without copying them'''
+    return (items[i] for i in range(start, len(items)))
+
+
+def cursor_position(positions, cursor):
+    if cursor not in positions:
+        raise BaseException('Unknown cursor: %s' % cursor)
+    return positions[cursor] + 1
+
+
 class Command:
     def __init__(self, func, s):
         self.name = func.__name__
@@ -91,11 +132,12 @@ def command(s):
 
 class Commands:
 
-    def __init__(self, config, wallet, network, callback = None):
+    def __init__(self, config, wallet, network, callback = None, daemon = None):
         self.config = config
         self.wallet = wallet
         self.network = network
         self._callback = callback
+        self.daemon = daemon
 
     def _run(self, method, args, password_getter):
         # this wrapper is called from the python console
@@ -184,14 +226,37 @@ class Commands:
         return self.network.get_history_for_scripthash(sh)
 
     @command('w')
-    def listunspent(self):
+    def listunspent(self, from_height=None, limit=None, cursor=None):
         """List unspent outputs. Returns the list of unspent transaction
-        outputs in your wallet."""
-        l = copy.deepcopy(self.wallet.get_utxos(exclude_frozen=False))
+        outputs in your wallet. With from_height, limit or cursor, returns
+        a page of items and the cursor of the next page."""
+        paged = from_height is not None or limit is not None or cursor is not None
+        if paged:
+            # sorted once, until the history changes; pages seek to the cursor
+            utxos, keys = self.wallet.get_view('utxos', self._utxos_view)
+            start = 0
+            if cursor is not None:
+                try:
+                    prevout_hash, prevout_n = cursor.split(':')
+                    start = bisect.bisect_right(keys, (prevout_hash, int(prevout_n)))
+                except ValueError:
+                    raise BaseException('Unknown cursor: %s' % cursor)
+            l = seek(utxos, start)
+            if from_height is not None:
+                l = filter(lambda x: x['height'] <= 0 or x['height'] >= from_height, l)
+            l, cursor = paginate(l, lambda x: '%s:%d' % (x['prevout_hash'], x['prevout_n']), limit)
+        else:
+            l = self.wallet.get_utxos(exclude_frozen=False)
+        l = copy.deepcopy(l)
         for i in l:
             v = i["value"]
             i["value"] = str(Decimal(v)/COIN) if v is not None else None
-        return l
+        return {'items': l, 'cursor': cursor} if paged else l
+
+    def _utxos_view(self):
+        l = sorted(self.wallet.get_utxos(exclude_frozen=False),
+                   key=lambda x: (x['prevout_hash'], x['prevout_n']))
+        return l, [(x['prevout_hash'], x['prevout_n']) for x in l]
 
     @command('n')
     def getaddressunspent(self, address):
@@ -327,6 +392,26 @@ class Commands:
         out["unconfirmed"] =  str(Decimal(out["unconfirmed"])/COIN)
         return out
 
+    def _main_chain(self):
+        if self.network:
+            with self.network.blockchains_lock:
+                return self.network.blockchains[0]
+        return blockchain.read_blockchains(self.config)[0]
+
+    @command('')
+    def export_headers_snapshot(self, path, height=None):
+        """Write the block headers of the main chain, up to a given height
+        (default: all), to a file."""
+        return headers_snapshot.export_snapshot(self._main_chain(), path, height)
+
+    @command('')
+    def import_headers_snapshot(self, path):
+        """Verify a headers snapshot file, and use it to replace the local
+        block headers, if it is longer. The daemon must not be running."""
+        if self.network:
+            raise BaseException('Cannot import headers while the network is running. Stop the daemon first.')
+        return headers_snapshot.import_snapshot(self._main_chain(), path)
+
     @command('n')
     def getmerkle(self, txid, height):
         """Get Merkle branch of a transaction included in a block. Electrum
@@ -335,8 +420,19 @@ class Commands:
 
     @command('n')
     def getservers(self):
-        """Return the list of available servers"""
-        return self.network.get_servers()
+        """Return the list of available servers, with the connection
+        statistics of the ones we have used"""
+        servers = {}
+        for host, d in self.network.get_servers().items():
+            d = dict(d)
+            port = d.get(self.network.protocol)
+            if port:
+                server = serialize_server(host, port, self.network.protocol)
+                stats = self.network.server_stats.get(server)
+                if stats:
+                    d['stats'] = stats
+            servers[host] = d
+        return servers
 
     @command('')
     def version(self):
@@ -446,11 +542,51 @@ class Commands:
         return tx.as_dict()
 
     @command('w')
-    def history(self, year=None, show_addresses=False, show_fiat=False):
-        """Wallet history. Returns the transaction history of your wallet."""
+    def consolidate(self, fee_rate=None, imax=MAX_INPUTS, max_value=None, max_txs=None, create=False, broadcast=False, password=None):
+        """Merge small coins. Plans self-spend transactions of up to imax
+        inputs, from the smallest coins, and reports their fees and the
+        projected savings in fees and coin selection time. Frozen addresses
+        and unconfirmed coins are left out, as are transactions that would
+        not save fees. With --create or --broadcast,
+        the transactions are signed, unless fees are above the
+        consolidate_max_feerate setting; a fee rate given with --fee_rate
+        is used as is. The password is only needed to sign."""
+        planner = ConsolidationPlanner(self.wallet, self.config)
+        txs, summary = planner.plan(fee_rate, imax, satoshis(max_value), max_txs)
+        for k in ['fee', 'fee_saved']:
+            summary[k] = str(Decimal(summary[k])/COIN)
+        for item in summary['transactions']:
+            for k in ['value', 'fee']:
+                item[k] = str(Decimal(item[k])/COIN)
+        if not (create or broadcast):
+            return summary
+        if fee_rate is None and not summary['fees_low']:
+            raise BaseException('Fee rate is above consolidate_max_feerate: %d sat/kvB' % summary['fee_rate'])
+        if broadcast and not self.network:
+            raise BaseException('Cannot broadcast offline')
+        if password is None and self.wallet.has_password():
+            raise BaseException('Password required')
+        for tx, item in zip(txs, summary['transactions']):
+            self.wallet.sign_transaction(tx, password)
+            item.update(tx.as_dict())
+            if broadcast:
+                ok, msg = self.network.broadcast_transaction(tx)
+                item['broadcast'] = ok
+                if ok:
+                    self.wallet.add_transaction(tx.txid(), tx)
+                else:
+                    item['error'] = msg
+        if broadcast:
+            self.wallet.save_transactions(write=True)
+        return summary
+
+    @command('w')
+    def history(self, year=None, show_addresses=False, show_fiat=False, from_height=None, limit=None, cursor=None):
+        """Wallet history. Returns the transaction history of your wallet.
+        With from_height, limit or cursor, returns a page of transactions,
+        without summary, and the cursor of the next page."""
         kwargs = {'show_addresses': show_addresses}
         if year:
-            import time
             start_date = datetime.datetime(year, 1, 1)
             end_date = datetime.datetime(year+1, 1, 1)
             kwargs['from_timestamp'] = time.mktime(start_date.timetuple())
@@ -459,7 +595,34 @@ class Commands:
             from .exchange_rate import FxThread
             fx = FxThread(self.config, None)
             kwargs['fx'] = fx
-        return json_encode(self.wallet.get_full_history(**kwargs))
+        if from_height is None and limit is None and cursor is None:
+            return json_encode(self.wallet.get_full_history(**kwargs))
+        from_timestamp = kwargs.pop('from_timestamp', None)
+        to_timestamp = kwargs.pop('to_timestamp', None)
+        def f(x):
+            tx_hash, height, conf, timestamp, value, balance = x
+            if value is None:
+                return False
+            if from_height is not None and 0 < height < from_height:
+                return False
+            if from_timestamp and (timestamp or time.time()) < from_timestamp:
+                return False
+            if to_timestamp and (timestamp or time.time()) >= to_timestamp:
+                return False
+            return True
+        h, heights, positions = self.wallet.get_view('history', self._history_view)
+        start = cursor_position(positions, cursor) if cursor is not None else 0
+        if from_height is not None:
+            start = max(start, bisect.bisect_left(heights, from_height))
+        page, cursor = paginate(filter(f, seek(h, start)), lambda x: x[0], limit)
+        items = [self.wallet.get_history_item(*x, **kwargs) for x in page]
+        return json_encode({'items': items, 'cursor': cursor})
+
+    def _history_view(self):
+        h = self.wallet.get_history()
+        # confirmed transactions come first, in increasing height
+        heights = [x[1] if x[1] > 0 else float('inf') for x in h]
+        return h, heights, {x[0]: i for i, x in enumerate(h)}
 
     @command('w')
     def setlabel(self, key, label):
@@ -487,10 +650,34 @@ class Commands:
         return results
 
     @command('w')
-    def listaddresses(self, receiving=False, change=False, labels=False, frozen=False, unused=False, funded=False, balance=False):
-        """List wallet addresses. Returns the list of all addresses in your wallet. Use optional arguments to filter the results."""
-        out = []
-        for addr in self.wallet.get_addresses():
+    def listaddresses(self, receiving=False, change=False, labels=False, frozen=False, unused=False, funded=False, balance=False, limit=None, cursor=None):
+        """List wallet addresses. Returns the list of all addresses in your wallet. Use optional arguments to filter the results.
+        With limit or cursor, returns a page of addresses and the cursor of the next page."""
+        addresses = self._addresses_after(cursor)
+        out = self._list_addresses(addresses, receiving, change, labels, frozen, unused, funded, balance)
+        if limit is None and cursor is None:
+            return list(out)
+        items, cursor = paginate(out, lambda x: x if type(x) is str else x[0], limit)
+        return {'items': items, 'cursor': cursor}
+
+    def _addresses_after(self, cursor):
+        '''The addresses of the wallet, in order, following cursor'''
+        receiving = self.wallet.get_receiving_addresses()
+        change = self.wallet.get_change_addresses()
+        if cursor is None:
+            return itertools.chain(receiving, change)
+        if not self.wallet.is_mine(cursor):
+            raise BaseException('Unknown cursor: %s' % cursor)
+        if self.wallet.is_deterministic():
+            is_change, n = self.wallet.get_address_index(cursor)
+            start, change_start = (len(receiving), n + 1) if is_change else (n + 1, 0)
+        else:
+            # imported addresses are sorted
+            start, change_start = bisect.bisect_right(receiving, cursor), 0
+        return itertools.chain(seek(receiving, start), seek(change, change_start))
+
+    def _list_addresses(self, addresses, receiving, change, labels, frozen, unused, funded, balance):
+        for addr in addresses:
             if frozen and not self.wallet.is_frozen(addr):
                 continue
             if receiving and self.wallet.is_change(addr):
@@ -508,8 +695,7 @@ class Commands:
                 item += (format_satoshis(sum(self.wallet.get_addr_balance(addr))),)
             if labels:
                 item += (repr(self.wallet.labels.get(addr, '')),)
-            out.append(item)
-        return out
+            yield item
 
     @command('n')
     def gettransaction(self, txid):
@@ -561,9 +747,9 @@ class Commands:
     #    pass
 
     @command('w')
-    def listrequests(self, pending=False, expired=False, paid=False):
-        """List the payment requests you made."""
-        out = self.wallet.get_sorted_requests(self.config)
+    def listrequests(self, pending=False, expired=False, paid=False, limit=None, cursor=None):
+        """List the payment requests you made. With limit or cursor,
+        returns a page of requests and the cursor of the next page."""
         if pending:
             f = PR_UNPAID
         elif expired:
@@ -572,9 +758,22 @@ class Commands:
             f = PR_PAID
         else:
             f = None
+        if limit is None and cursor is None:
+            keys = self.wallet.get_sorted_request_keys()
+        else:
+            keys, positions = self.wallet.get_view('requests', self._requests_view)
+            keys = seek(keys, cursor_position(positions, cursor) if cursor is not None else 0)
+        out = (self.wallet.get_payment_request(key, self.config) for key in keys)
         if f is not None:
-            out = list(filter(lambda x: x.get('status')==f, out))
-        return list(map(self._format_request, out))
+            out = filter(lambda x: x.get('status')==f, out)
+        if limit is None and cursor is None:
+            return list(map(self._format_request, out))
+        items, cursor = paginate(out, lambda x: x['address'], limit)
+        return {'items': list(map(self._format_request, items)), 'cursor': cursor}
+
+    def _requests_view(self):
+        keys = self.wallet.get_sorted_request_keys()
+        return keys, {key: i for i, key in enumerate(keys)}
 
     @command('w')
     def createnewaddress(self):
@@ -605,6 +804,43 @@ class Commands:
         out = self.wallet.get_payment_request(addr, self.config)
         return self._format_request(out)
 
+    @command('w')
+    def addrequests(self, requests, export=None, force=False):
+        """Create several payment requests at once. Requests are a list of
+        {"amount": BTC amount, "memo": description, "expiration": seconds},
+        each one using an unused address of the wallet.
+        With export, all the requests are written atomically to that file
+        instead of one file per request in requests_dir."""
+        addresses = self.wallet.get_unused_addresses()[:len(requests)]
+        if len(addresses) < len(requests):
+            if not force:
+                raise BaseException('Not enough unused addresses (%d); use --force to create new ones' % len(addresses))
+            while len(addresses) < len(requests):
+                addresses.append(self.wallet.create_new_address(False))
+        reqs = []
+        for addr, r in zip(addresses, requests):
+            amount = satoshis(r['amount'])
+            expiration = int(r['expiration']) if r.get('expiration') else None
+            reqs.append(self.wallet.make_payment_request(addr, amount, r.get('memo', ''), expiration))
+        reqs = self.wallet.add_payment_requests(reqs, self.config, write_files=export is None)
+        out = [self.wallet.get_payment_request(req['address'], self.config) for req in reqs]
+        if export is not None:
+            for req, o in zip(reqs, out):
+                o['bip70'] = bh2u(paymentrequest.make_request(self.config, req).SerializeToString())
+            with tempfile.NamedTemporaryFile('w', encoding='utf-8', delete=False,
+                                             dir=os.path.dirname(os.path.abspath(export))) as f:
+                try:
+                    f.write(json.dumps(out))
+                    f.flush()
+                    os.fsync(f.fileno())
+                except BaseException:
+                    os.unlink(f.name)
+                    raise
+            os.replace(f.name, export)
+            for o in out:
+                o.pop('bip70')
+        return [self._format_request(o) for o in out]
+
     @command('w')
     def addtransaction(self, tx):
         """ Add a transaction to the wallet history """
@@ -636,26 +872,35 @@ class Commands:
 
     @command('n')
     def notify(self, address, URL):
-        """Watch an address. Every time the address changes, a http POST is sent to the URL."""
-        def callback(x):
-            import urllib.request
-            headers = {'content-type':'application/json'}
-            data = {'address':address, 'status':x.get('result')}
-            serialized_data = util.to_bytes(json.dumps(data))
-            try:
-                req = urllib.request.Request(URL, serialized_data, headers)
-                response_stream = urllib.request.urlopen(req, timeout=5)
-                util.print_error('Got Response for %s' % address)
-            except BaseException as e:
-                util.print_error(str(e))
-        self.network.subscribe_to_addresses([address], callback)
+        """Watch an address, or a list of addresses. Every time one of them changes, a http POST is sent to the URL.
+        Registrations are kept when the daemon restarts."""
+        addresses = address if isinstance(address, list) else [address]
+        self._get_notifier().add(addresses, URL)
+        return True
+
+    @command('n')
+    def rmnotify(self, address, URL):
+        """Stop sending notifications to the URL for an address, or a list of addresses."""
+        addresses = address if isinstance(address, list) else [address]
+        self._get_notifier().remove(addresses, URL)
         return True
 
+    def _get_notifier(self):
+        if self.daemon is None or self.daemon.notifier is None:
+            raise BaseException('Notifications require a running daemon')
+        return self.daemon.notifier
+
     @command('wn')
     def is_synchronized(self):
         """ return wallet synchronization status """
         return self.wallet.is_up_to_date()
 
+    @command('wn')
+    def getsyncprogress(self):
+        """Return the number of subscribed addresses, and of pending
+        subscriptions, history and transaction requests."""
+        return self.wallet.get_sync_progress()
+
     @command('n')
     def getfeerate(self, fee_method=None, fee_level=None):
         """Return current suggested fee rate (in sat/kvByte), according to config
@@ -697,6 +942,8 @@ param_descriptions = {
     'requested_amount': 'Requested amount (in BTC).',
     'outputs': 'list of ["address", amount]',
     'redeem_script': 'redeem script (hexadecimal)',
+    'path': 'File path',
+    'requests': 'list of {"amount": amount, "memo": description, "expiration": seconds}',
 }
 
 command_options = {
@@ -733,9 +980,22 @@ command_options = {
     'show_fiat':   (None, "Show fiat value of transactions"),
     'year':        (None, "Show history for a given year"),
     'fee_method':  (None, "Fee estimation method to use"),
-    'fee_level':   (None, "Float between 0.0 and 1.0, representing fee slider position")
+    'fee_level':   (None, "Float between 0.0 and 1.0, representing fee slider position"),
+    'height':      (None, "Block height"),
+    'from_height': (None, "Only list items from this block height, and unconfirmed ones"),
+    'limit':       (None, "Maximum number of items; the result includes the cursor of the next items"),
+    'cursor':      (None, "Continue the listing from this cursor"),
+    'export':      (None, "Write the requests to this file, instead of requests_dir"),
+    'fee_rate':    (None, "Fee rate in sat/kvB"),
+    'max_value':   (None, "Only merge coins up to this value (in BTC)"),
+    'max_txs':     (None, "Maximum number of transactions"),
+    'create':      (None, "Create and sign the transactions"),
+    'broadcast':   (None, "Broadcast the transactions"),
 }
 
+# commands whose items can be listed a page at a time
+paged_commands = ['history', 'listaddresses', 'listrequests', 'listunspent']
+
 
 # don't use floats because of rounding errors
 from .transaction import tx_from_str
@@ -750,11 +1010,18 @@ arg_types = {
     'jsontx': json_loads,
     'inputs': json_loads,
     'outputs': json_loads,
+    'requests': json_loads,
     'fee': lambda x: str(Decimal(x)) if x is not None else None,
     'amount': lambda x: str(Decimal(x)) if x != '!' else '!',
     'locktime': int,
     'fee_method': str,
     'fee_level': json_loads,
+    'height': int,
+    'from_height': int,
+    'limit': int,
+    'fee_rate': int,
+    'max_value': lambda x: str(Decimal(x)) if x is not None else None,
+    'max_txs': int,
 }
 
 config_variables = {
@@ -765,6 +1032,16 @@ config_variables = {
         'ssl_chain': 'Chain of SSL certificates, needed for signed requests. Put your certificate at the top and the root CA at the end',
         'url_rewrite': 'Parameters passed to str.replace(), in order to create the r= part of bitcoin: URIs. Example: \"(\'file:///var/www/\',\'https://electrum.org/\')\"',
     },
+    'addrequests': {
+        'requests_dir': 'directory where a bip70 file will be written.',
+        'ssl_privkey': 'Path to your SSL private key, needed to sign the request.',
+        'ssl_chain': 'Chain of SSL certificates, needed for signed requests. Put your certificate at the top and the root CA at the end',
+        'url_rewrite': 'Parameters passed to str.replace(), in order to create the r= part of bitcoin: URIs. Example: \"(\'file:///var/www/\',\'https://electrum.org/\')\"',
+    },
+    'consolidate': {
+        'consolidate_max_feerate': 'Fee rate in sat/kvB below which consolidation transactions are created. Default: 5000',
+        'consolidate_future_feerate': 'Fee rate in sat/kvB at which coins are expected to be spent otherwise, for the projected savings. Default: 20000',
+    },
     'listrequests':{
         'url_rewrite': 'Parameters passed to str.replace(), in order to create the r= part of bitcoin: URIs. Example: \"(\'file:///var/www/\',\'https://electrum.org/\')\"',
     }
@@ -865,6 +1142,8 @@ def get_parser():
         add_global_options(p)
         if cmdname == 'restore':
             p.add_argument("-o", "--offline", action="store_true", dest="offline", default=False, help="Run offline")
+        if cmdname in paged_commands:
+            p.add_argument("--stream", action="store_true", dest="stream", default=False, help="Print items as newline-delimited JSON, fetching them a page at a time")
         for optname, default in zip(cmd.options, cmd.defaults):
             a, help = command_options[optname]
             b = '--' + optname
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+import time
+import traceback
+
+from . import coinchooser
+from .bitcoin import TYPE_ADDRESS
+from .keystore import Software_KeyStore
+from .simple_config import SimpleConfig
+from .transaction import Transaction
+from .util import PrintError, DaemonThread, NoDynamicFeeEstimates
+
+
+MAX_INPUTS = 100            # per transaction
+MAX_FEERATE = 5000          # sat/kvB; fees are low enough below this
+FUTURE_FEERATE = 20000      # sat/kvB; rate at which the coins would be spent otherwise
+CONSOLIDATION_INTERVAL = 600
+
+
+class ConsolidationPlanner(PrintError):
+    '''Plans self-spend transactions that merge the smallest coins of a
+    wallet into one output each.  Coins of frozen addresses, unconfirmed
+    and immature coins, and coins that cost more to spend than they are
+    worth, are left out, as are transactions that would not save fees.'''
+
+    def __init__(self, wallet, config):
+        self.wallet = wallet
+        self.config = config
+
+    def diagnostic_name(self):
+        return self.wallet.basename()
+
+    def get_coins(self):
+        coins = self.wallet.get_utxos(exclude_frozen=True, mature=True, confirmed_only=True)
+        for coin in coins:
+            self.wallet.add_input_info(coin)
+        return coins
+
+    def get_addresses(self):
+        '''Unused addresses to merge coins into: receiving addresses,
+        then change addresses, then new change addresses.'''
+        # get_unused_addresses does not know about local transactions
+        for address in self.wallet.get_unused_addresses() + self.wallet.get_change_addresses():
+            if not self.wallet.history.get(address) and not self.wallet.get_address_history(address):
+                yield address
+        while self.wallet.is_deterministic():
+            yield self.wallet.create_new_address(True)
+
+    def input_fee(self, coin, fee_per_kb):
+        witness = Transaction.is_segwit_input(coin, guess_for_address=True)
+        weight = coinchooser.input_weight(coin, witness)
+        return SimpleConfig.estimate_fee_for_feerate(fee_per_kb, Transaction.virtual_size_from_weight(weight))
+
+    def plan(self, fee_per_kb=None, max_inputs=MAX_INPUTS, max_value=None, max_txs=None, measure=True):
+        '''Returns the unsigned transactions, and a summary with their
+        fees and the projected savings.  Amounts are in satoshis.'''
+        max_feerate = self.config.get('consolidate_max_feerate', MAX_FEERATE)
+        future_feerate = self.config.get('consolidate_future_feerate', FUTURE_FEERATE)
+        if fee_per_kb is None:
+            fee_per_kb = self.config.fee_per_kb()
+            if fee_per_kb is None:
+                raise NoDynamicFeeEstimates()
+        coins = self.get_coins()
+        candidates = [c for c in coins
+                      if (max_value is None or c['value'] <= max_value)
+                      and c['value'] > self.input_fee(c, fee_per_kb)]
+        candidates.sort(key=lambda c: c['value'])
+        batches = [candidates[i:i + max_inputs] for i in range(0, len(candidates), max_inputs)]
+        batches = [b for b in batches if len(b) > 1][:max_txs]
+        addresses = self.get_addresses()
+        fee_estimator = lambda size: SimpleConfig.estimate_fee_for_feerate(fee_per_kb, size)
+        txs = []
+        fee = future_fee = 0
+        address = None
+        for batch in list(batches):
+            address = address or next(addresses, None)
+            if address is None:
+                # do not merge coins into an address that was used
+                batches = batches[:len(txs)]
+                break
+            outputs = [(TYPE_ADDRESS, address, '!')]
+            tx = self.wallet.make_unsigned_transaction(batch, outputs, self.config, fee_estimator)
+            # spending the coins later, against spending the merged output
+            saved = sum(self.input_fee(c, future_feerate) for c in batch)
+            saved -= self.input_fee(dict(batch[0], address=address), future_feerate)
+            if tx.output_value() < self.wallet.dust_threshold() or saved <= tx.get_fee():
+                batches.remove(batch)
+                continue
+            txs.append(tx)
+            fee += tx.get_fee()
+            future_fee += saved
+            address = None
+        spent = [c for batch in batches for c in batch]
+        summary = {
+            'fee_rate': fee_per_kb,
+            'max_fee_rate': max_feerate,
+            'fees_low': fee_per_kb <= max_feerate,
+            'coins': len(coins),
+            'coins_after': len(coins) - len(spent) + len(txs),
+            'transactions': [{'inputs': len(tx.inputs()),
+                              'value': tx.output_value(),
+                              'fee': tx.get_fee(),
+                              'address': tx.outputs()[0][1]} for tx in txs],
+            'fee': fee,
+            'future_fee_rate': future_feerate,
+            'fee_saved': future_fee - fee,
+        }
+        if measure:
+            spent_ids = set((c['prevout_hash'], c['prevout_n']) for c in spent)
+            after = [c for c in coins if (c['prevout_hash'], c['prevout_n']) not in spent_ids]
+            after += [dict(batch[0], prevout_hash=tx.txid(), prevout_n=0, value=tx.output_value())
+                      for batch, tx in zip(batches, txs)]
+            summary['selection_ms'] = {
+                'before': self.selection_time(coins, future_feerate),
+                'after': self.selection_time(after, future_feerate),
+            }
+        return txs, summary
+
+    def selection_time(self, coins, fee_per_kb):
+        '''Time taken to choose coins for a payment of half of their value'''
+        if not coins:
+            return 0
+        amount = sum(c['value'] for c in coins) // 2
+        address = coins[0]['address']
+        fee_estimator = lambda size: SimpleConfig.estimate_fee_for_feerate(fee_per_kb, size)
+        chooser = coinchooser.get_coin_chooser(self.config)
+        t0 = time.time()
+        try:
+            chooser.make_tx(coins, [(TYPE_ADDRESS, address, amount)], [address],
+                            fee_estimator, self.wallet.dust_threshold())
+        except BaseException as e:
+            self.print_error('selection failed', e)
+        return round((time.time() - t0) * 1000, 1)
+
+
+class ConsolidationThread(DaemonThread):
+    '''Plans consolidations for the wallets loaded in the daemon, while
+    fees are low.  With consolidate_broadcast set, the transactions of
+    wallets that need no password are signed and broadcast.  Runs in its
+    own thread, as signing and broadcasting take time.  Hardware
+    wallets are never signed from here.'''
+
+    def __init__(self, daemon, config):
+        DaemonThread.__init__(self)
+        self.daemon = daemon
+        self.config = config
+        self.next_time = 0
+        self.plans = {}
+
+    def run(self):
+        while self.is_running():
+            if time.time() >= self.next_time:
+                self.next_time = time.time() + self.config.get('consolidate_interval', CONSOLIDATION_INTERVAL)
+                try:
+                    self.consolidate_wallets()
+                except Exception:
+                    traceback.print_exc(file=sys.stderr)
+            time.sleep(0.1)
+        self.on_stop()
+
+    def consolidate_wallets(self):
+        with self.daemon.wallets_lock:
+            wallets = dict(self.daemon.wallets)
+        for path, wallet in wallets.items():
+            if not self.is_running():
+                break
+            if not wallet.is_up_to_date():
+                continue
+            lock = self.daemon.get_wallet_lock(path)
+            if not lock.acquire(False):
+                continue
+            try:
+                self.consolidate(path, wallet)
+            finally:
+                lock.release()
+
+    def consolidate(self, path, wallet):
+        planner = ConsolidationPlanner(wallet, self.config)
+        try:
+            txs, summary = planner.plan(measure=False)
+        except NoDynamicFeeEstimates:
+            return
+        self.plans[path] = summary
+        if not txs or not summary['fees_low'] or summary['fee_saved'] <= 0:
+            return
+        if not self.config.get('consolidate_broadcast', False):
+            return
+        if wallet.is_watching_only() or wallet.has_keystore_encryption():
+            return
+        # hardware wallets need their user
+        if not all(isinstance(k, Software_KeyStore) for k in wallet.get_keystores()):
+            return
+        for tx in txs:
+            wallet.sign_transaction(tx, None)
+            ok, msg = self.daemon.network.broadcast_transaction(tx)
+            self.print_error('broadcast', tx.txid(), ok, msg)
+            if ok:
+                wallet.add_transaction(tx.txid(), tx)
+        wallet.save_transactions(write=True)
+
+    def get_stats(self):
+        plans = dict(self.plans)
+        return {path: {k: summary[k] for k in ['fee_rate', 'fees_low', 'coins', 'coins_after', 'fee', 'fee_saved']}
+                for path, summary in plans.items()}
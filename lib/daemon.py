@@ -24,6 +24,7 @@
 # SOFTWARE.
 import ast
 import os
+import threading
 import time
 import traceback
 import sys
@@ -41,9 +42,19 @@ from .storage import WalletStorage
 from .commands import known_commands, Commands
 from .simple_config import SimpleConfig
 from .exchange_rate import FxThread
+from .notifier import Notifier
+from .consolidation import ConsolidationThread
 from .plugins import run_hook
 
 
+# number of threads handling RPC requests
+RPC_WORKERS = 8
+# wallets are only unloaded after being unused for that long (seconds)
+WALLET_IDLE_TIME = 60
+# how often the wallet pool budget is checked (seconds)
+WALLET_POOL_INTERVAL = 10
+
+
 def get_lockfile(config):
     return os.path.join(config.path, 'daemon')
 
@@ -117,6 +128,97 @@ def get_rpc_credentials(config):
     return rpc_user, rpc_password
 
 
+class CommandStats:
+    '''Number of calls, queueing and execution time of RPC commands'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, name, queue_time, exec_time):
+        with self.lock:
+            d = self.stats.setdefault(name, {
+                'count': 0,
+                'queue_time': 0.,
+                'max_queue_time': 0.,
+                'exec_time': 0.,
+                'max_exec_time': 0.,
+            })
+            d['count'] += 1
+            d['queue_time'] += queue_time
+            d['max_queue_time'] = max(d['max_queue_time'], queue_time)
+            d['exec_time'] += exec_time
+            d['max_exec_time'] = max(d['max_exec_time'], exec_time)
+
+    def get(self):
+        with self.lock:
+            return {name: {
+                'count': d['count'],
+                'avg_queue_time': round(d['queue_time'] / d['count'], 4),
+                'max_queue_time': round(d['max_queue_time'], 4),
+                'avg_exec_time': round(d['exec_time'] / d['count'], 4),
+                'max_exec_time': round(d['max_exec_time'], 4),
+            } for name, d in self.stats.items()}
+
+
+class RequestIndex:
+    '''Payment request id -> (wallet path, address), for the wallets of
+    the daemon, including the ones unloaded from the pool'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+
+    def add(self, request_id, path, addr):
+        with self.lock:
+            self.requests[request_id] = (path, addr)
+
+    def remove(self, request_id):
+        with self.lock:
+            self.requests.pop(request_id, None)
+
+    def get(self, request_id):
+        with self.lock:
+            return self.requests.get(request_id)
+
+    def add_wallet(self, wallet):
+        '''Index the requests of wallet, and keep them up to date'''
+        path = wallet.storage.path
+        with self.lock:
+            self._remove_path(path)
+            for request_id, addr in wallet.request_ids.items():
+                self.requests[request_id] = (path, addr)
+            wallet.request_index = self
+
+    def remove_wallet(self, path):
+        with self.lock:
+            self._remove_path(path)
+
+    def _remove_path(self, path):
+        for request_id in [k for k, v in self.requests.items() if v[0] == path]:
+            self.requests.pop(request_id)
+
+
+class UnloadedWallet:
+    '''Watches the addresses of a wallet that was unloaded from the
+    pool, and asks for it to be loaded again if one of them changes.'''
+
+    def __init__(self, path, statuses, on_change):
+        self.path = path
+        self.statuses = statuses  # address -> status when unloaded
+        self.on_change = on_change
+        self.active = True
+        self.callback = None  # as subscribed to the network
+
+    def on_address_status(self, response):
+        if not self.active or response.get('error'):
+            return
+        addr = response['params'][0]
+        if self.statuses.get(addr) != response.get('result'):
+            self.active = False
+            self.on_change(self.path)
+
+
 class Daemon(DaemonThread):
 
     def __init__(self, config, fd, is_gui):
@@ -128,10 +230,30 @@ class Daemon(DaemonThread):
             self.network = Network(config)
             self.network.start()
         self.fx = FxThread(config, self.network)
+        self.notifier = None
         if self.network:
             self.network.add_jobs([self.fx])
+            # webhooks of the notify command
+            self.notifier = Notifier(config, self.network)
+            self.notifier.start()
         self.gui = None
         self.wallets = {}
+        self.wallets_lock = threading.RLock()
+        # commands on the same wallet are run one at a time
+        self.wallet_locks = {}
+        # wallet pool: idle wallets are unloaded when there are more than
+        # max_wallets, or their files take more than max_wallets_size MB
+        self.wallet_last_used = {}
+        self.unloaded_wallets = {}  # path -> UnloadedWallet
+        self.wallets_to_reload = set()
+        self.pool_time = time.time()
+        self.command_stats = CommandStats()
+        self.request_index = RequestIndex()
+        # consolidation of small coins, while fees are low
+        self.consolidator = None
+        if self.network and config.get('consolidate_job', False):
+            self.consolidator = ConsolidationThread(self, config)
+            self.consolidator.start()
         # Setup JSONRPC server
         self.init_server(config, fd, is_gui)
 
@@ -142,7 +264,8 @@ class Daemon(DaemonThread):
         rpc_user, rpc_password = get_rpc_credentials(config)
         try:
             server = VerifyingJSONRPCServer((host, port), logRequests=False,
-                                            rpc_user=rpc_user, rpc_password=rpc_password)
+                                            rpc_user=rpc_user, rpc_password=rpc_password,
+                                            workers=config.get('rpc_workers', RPC_WORKERS))
         except Exception as e:
             self.print_error('Warning: cannot initialize RPC server on host', host, e)
             self.server = None
@@ -157,14 +280,44 @@ class Daemon(DaemonThread):
             server.register_function(self.run_gui, 'gui')
         else:
             server.register_function(self.run_daemon, 'daemon')
-            self.cmd_runner = Commands(self.config, None, self.network)
+            self.cmd_runner = Commands(self.config, None, self.network, daemon=self)
             for cmdname in known_commands:
-                server.register_function(getattr(self.cmd_runner, cmdname), cmdname)
+                server.register_function(self.wrap_command(cmdname), cmdname)
             server.register_function(self.run_cmdline, 'run_cmdline')
 
     def ping(self):
         return True
 
+    def get_wallet_lock(self, path):
+        with self.wallets_lock:
+            return self.wallet_locks.setdefault(path, threading.Lock())
+
+    def run_command(self, name, func, args, kwargs, wallet_path=None):
+        accept_time = self.server.get_accept_time() if self.server else time.time()
+        lock = self.get_wallet_lock(wallet_path) if wallet_path else None
+        if lock:
+            lock.acquire()
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            end = time.time()
+            if lock:
+                lock.release()
+            self.command_stats.record(name, start - accept_time, end - start)
+
+    def wrap_command(self, cmdname):
+        cmd = known_commands[cmdname]
+        def func(*args, **kwargs):
+            wallet = self.cmd_runner.wallet
+            path = wallet.storage.path if cmd.requires_wallet and wallet else None
+            f = getattr(self.cmd_runner, cmdname)
+            return self.run_command(cmdname, f, args, kwargs, path)
+        return func
+
+    def get_command_stats(self):
+        return self.command_stats.get()
+
     def run_daemon(self, config_options):
         config = SimpleConfig(config_options)
         sub = config.get('subcommand')
@@ -180,7 +333,7 @@ class Daemon(DaemonThread):
             response = wallet is not None
         elif sub == 'close_wallet':
             path = config.get_wallet_path()
-            if path in self.wallets:
+            if self.get_wallet(path) is not None:
                 self.stop_wallet(path)
                 response = True
             else:
@@ -191,17 +344,29 @@ class Daemon(DaemonThread):
                 current_wallet = self.cmd_runner.wallet
                 current_wallet_path = current_wallet.storage.path \
                                       if current_wallet else None
+                with self.wallets_lock:
+                    wallets = dict(self.wallets)
+                    unloaded = sorted(self.unloaded_wallets.keys())
                 response = {
                     'path': self.network.config.path,
                     'server': p[0],
                     'blockchain_height': self.network.get_local_height(),
                     'server_height': self.network.get_server_height(),
                     'spv_nodes': len(self.network.get_interfaces()),
+                    'server_stats': self.network.get_server_stats(),
+                    'event_stats': self.network.get_event_stats(),
+                    'tx_store': self.network.tx_store.get_stats(),
+                    'notifier': self.notifier.get_stats(),
+                    'consolidation': self.consolidator.get_stats() if self.consolidator else None,
+                    'rpc_stats': self.get_command_stats(),
                     'connected': self.network.is_connected(),
                     'auto_connect': p[4],
                     'version': ELECTRUM_VERSION,
                     'wallets': {k: w.is_up_to_date()
-                                for k, w in self.wallets.items()},
+                                for k, w in wallets.items()},
+                    'sync_progress': {k: w.get_sync_progress()
+                                      for k, w in wallets.items()},
+                    'unloaded_wallets': unloaded,
                     'current_wallet': current_wallet_path,
                     'fee_per_kb': self.config.fee_per_kb(),
                 }
@@ -227,10 +392,25 @@ class Daemon(DaemonThread):
         return response
 
     def load_wallet(self, path, password):
+        with self.get_wallet_lock(path):
+            with self.wallets_lock:
+                wallet = self.wallets.get(path)
+            if wallet is None:
+                wallet = self._load_wallet(path, password)
+                if wallet is None:
+                    return
+                self.request_index.add_wallet(wallet)
+                with self.wallets_lock:
+                    self.wallets[path] = wallet
+                    unloaded = self.unloaded_wallets.pop(path, None)
+                if unloaded:
+                    self.forget_unloaded_wallet(unloaded)
+                    self.print_error("reloaded", path)
+        self.wallet_last_used[path] = time.time()
+        return wallet
+
+    def _load_wallet(self, path, password):
         # wizard will be launched if we return
-        if path in self.wallets:
-            wallet = self.wallets[path]
-            return wallet
         storage = WalletStorage(path, manual_upgrades=True)
         if not storage.file_exists():
             return
@@ -244,19 +424,119 @@ class Daemon(DaemonThread):
             return
         wallet = Wallet(storage)
         wallet.start_threads(self.network)
-        self.wallets[path] = wallet
         return wallet
 
     def add_wallet(self, wallet):
         path = wallet.storage.path
-        self.wallets[path] = wallet
+        self.request_index.add_wallet(wallet)
+        with self.wallets_lock:
+            self.wallets[path] = wallet
+        self.wallet_last_used[path] = time.time()
 
     def get_wallet(self, path):
-        return self.wallets.get(path)
+        '''Returns a loaded wallet, reloading it if it was unloaded from the pool'''
+        with self.wallets_lock:
+            wallet = self.wallets.get(path)
+            unloaded = path in self.unloaded_wallets
+        if wallet is None and unloaded:
+            wallet = self.load_wallet(path, None)
+        if wallet is not None:
+            self.wallet_last_used[path] = time.time()
+        return wallet
 
     def stop_wallet(self, path):
-        wallet = self.wallets.pop(path)
-        wallet.stop_threads()
+        with self.wallets_lock:
+            wallet = self.wallets.pop(path, None)
+            unloaded = self.unloaded_wallets.pop(path, None)
+        self.request_index.remove_wallet(path)
+        if unloaded:
+            self.forget_unloaded_wallet(unloaded)
+        if wallet is None:
+            return
+        # wait for commands running on it
+        with self.get_wallet_lock(path):
+            wallet.stop_threads()
+
+    def get_pool_size(self, wallets):
+        size = 0
+        for path in wallets:
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def maintain_wallet_pool(self):
+        # wallets unloaded earlier, that received a notification
+        with self.wallets_lock:
+            paths = self.wallets_to_reload
+            self.wallets_to_reload = set()
+        for path in paths:
+            self.get_wallet(path)
+        if time.time() - self.pool_time < WALLET_POOL_INTERVAL:
+            return
+        self.pool_time = time.time()
+        if self.gui:
+            # wallets are open in windows
+            return
+        max_count = self.config.get('max_wallets', 0)
+        max_size = self.config.get('max_wallets_size', 0) * 1000000
+        if not max_count and not max_size:
+            return
+        with self.wallets_lock:
+            wallets = dict(self.wallets)
+        current = getattr(self, 'cmd_runner', None) and self.cmd_runner.wallet
+        count = len(wallets)
+        size = self.get_pool_size(wallets) if max_size else 0
+        idle = [path for path, wallet in wallets.items()
+                if time.time() - self.wallet_last_used.get(path, 0) > WALLET_IDLE_TIME
+                and wallet is not current
+                and not wallet.storage.is_encrypted()
+                and wallet.is_up_to_date()]
+        idle.sort(key=lambda path: self.wallet_last_used.get(path, 0))
+        for path in idle:
+            if (not max_count or count <= max_count) and (not max_size or size <= max_size):
+                break
+            if self.unload_wallet(path):
+                count -= 1
+                size -= self.get_pool_size([path]) if max_size else 0
+
+    def unload_wallet(self, path):
+        '''Stop an idle wallet and keep watching its addresses.
+        Returns False if a command is running on it.'''
+        lock = self.get_wallet_lock(path)
+        if not lock.acquire(False):
+            return False
+        try:
+            with self.wallets_lock:
+                wallet = self.wallets[path]
+            addresses = wallet.get_addresses()
+            statuses = {}
+            if wallet.synchronizer:
+                statuses = {addr: wallet.synchronizer.get_address_status(addr)
+                            for addr in addresses}
+            unloaded = UnloadedWallet(path, statuses, self.reload_wallet_later)
+            # get_wallet reloads it from now on, once we release the lock
+            with self.wallets_lock:
+                self.wallets.pop(path)
+                self.unloaded_wallets[path] = unloaded
+            wallet.stop_threads()
+            if self.network:
+                unloaded.callback = self.network.subscribe_to_addresses(addresses, unloaded.on_address_status)
+        finally:
+            lock.release()
+        self.print_error("unloaded", path)
+        return True
+
+    def forget_unloaded_wallet(self, unloaded):
+        unloaded.active = False
+        if self.network and unloaded.callback:
+            self.network.unsubscribe(unloaded.callback)
+            unloaded.callback = None
+
+    def reload_wallet_later(self, path):
+        with self.wallets_lock:
+            self.wallets_to_reload.add(path)
 
     def run_cmdline(self, config_options):
         password = config_options.get('password')
@@ -269,10 +549,11 @@ class Daemon(DaemonThread):
         cmd = known_commands[cmdname]
         if cmd.requires_wallet:
             path = config.get_wallet_path()
-            wallet = self.wallets.get(path)
+            wallet = self.get_wallet(path)
             if wallet is None:
                 return {'error': 'Wallet "%s" is not loaded. Use "electrum daemon load_wallet"'%os.path.basename(path) }
         else:
+            path = None
             wallet = None
         # arguments passed to function
         args = map(lambda x: config.get(x), cmd.params)
@@ -282,16 +563,27 @@ class Daemon(DaemonThread):
         kwargs = {}
         for x in cmd.options:
             kwargs[x] = (config_options.get(x) if x in ['password', 'new_password'] else config.get(x))
-        cmd_runner = Commands(config, wallet, self.network)
+        cmd_runner = Commands(config, wallet, self.network, daemon=self)
         func = getattr(cmd_runner, cmd.name)
-        result = func(*args, **kwargs)
-        return result
+        return self.run_command(cmd.name, func, args, kwargs, path)
 
     def run(self):
         while self.is_running():
             self.server.handle_request() if self.server else time.sleep(0.1)
-        for k, wallet in self.wallets.items():
-            wallet.stop_threads()
+            self.maintain_wallet_pool()
+        if self.server:
+            self.server.server_close()
+        if self.consolidator:
+            self.consolidator.stop()
+            self.consolidator.join()
+        with self.wallets_lock:
+            wallets = list(self.wallets.items())
+        for k, wallet in wallets:
+            with self.get_wallet_lock(k):
+                wallet.stop_threads()
+        if self.notifier:
+            self.notifier.stop()
+            self.notifier.join()
         if self.network:
             self.print_error("shutting down network")
             self.network.stop()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import threading
+import time
+import traceback
+import sys
+from collections import deque
+
+from . import util
+
+
+# repeated events are delivered at most once per window (seconds)
+COALESCE_WINDOW = 0.2
+# events that describe the current state; only the last one in a
+# window is delivered. Other events (e.g. 'new_transaction',
+# 'verified') are each delivered, in order.
+COALESCED_EVENTS = {'updated', 'status', 'interfaces', 'servers', 'banner',
+                    'fee', 'fee_histogram', 'on_quotes', 'on_history'}
+# weight of a new sample in the latency average
+EWMA_ALPHA = 0.1
+
+
+class EventDispatcher(threading.Thread, util.PrintError):
+    '''
+    Delivers events to the callbacks registered for them, on its own
+    thread. The first event of a coalesced kind is delivered at once;
+    repeats within COALESCE_WINDOW are merged into one delivery at the
+    end of the window, with the latest arguments.
+    '''
+
+    def __init__(self, get_callbacks, window=COALESCE_WINDOW, coalesced=COALESCED_EVENTS):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.get_callbacks = get_callbacks
+        self.window = window
+        self.coalesced = set(coalesced)
+        self.cond = threading.Condition()
+        self.queue = deque()   # (event, args, time)
+        self.pending = {}      # event -> (args, time, due time)
+        self.last_sent = {}    # event -> time of the last delivery
+        self.stopped = False
+        # stats
+        self.delivered = 0
+        self.merged = 0
+        self.max_depth = 0
+        self.latency = 0
+        self.max_latency = 0
+
+    def put(self, event, args):
+        now = time.time()
+        with self.cond:
+            if self.stopped:
+                deliver_now = True
+            else:
+                deliver_now = False
+                if event in self.coalesced:
+                    if event in self.pending:
+                        args0, t, due = self.pending[event]
+                        self.pending[event] = (args, t, due)
+                        self.merged += 1
+                        return
+                    due = max(now, self.last_sent.get(event, 0) + self.window)
+                    self.pending[event] = (args, now, due)
+                else:
+                    self.queue.append((event, args, now))
+                self.max_depth = max(self.max_depth, len(self.queue) + len(self.pending))
+                self.cond.notify()
+        if deliver_now:
+            self.deliver(event, args, now)
+
+    def stop(self):
+        '''Deliver what is queued, then exit'''
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def get_stats(self):
+        with self.cond:
+            depth = len(self.queue) + len(self.pending)
+        return {
+            'queue_depth': depth,
+            'max_queue_depth': self.max_depth,
+            'delivered': self.delivered,
+            'coalesced': self.merged,
+            'latency': round(self.latency, 4),
+            'max_latency': round(self.max_latency, 4),
+        }
+
+    def next_items(self):
+        '''Wait for events that are due. Returns None once stopped and empty'''
+        with self.cond:
+            while True:
+                now = time.time()
+                due = [event for event, item in self.pending.items()
+                       if item[2] <= now or self.stopped]
+                if self.queue or due:
+                    break
+                if self.stopped:
+                    return None
+                timeout = min(item[2] for item in self.pending.values()) - now if self.pending else None
+                self.cond.wait(timeout)
+            items = list(self.queue)
+            self.queue.clear()
+            for event in due:
+                args, t, due_time = self.pending.pop(event)
+                self.last_sent[event] = now
+                items.append((event, args, t))
+        return items
+
+    def run(self):
+        while True:
+            items = self.next_items()
+            if items is None:
+                return
+            for event, args, t in items:
+                self.deliver(event, args, t)
+
+    def deliver(self, event, args, t):
+        latency = time.time() - t
+        self.latency = (1 - EWMA_ALPHA) * self.latency + EWMA_ALPHA * latency
+        self.max_latency = max(self.max_latency, latency)
+        for callback in self.get_callbacks(event):
+            try:
+                callback(event, *args)
+            except BaseException:
+                traceback.print_exc(file=sys.stderr)
+                self.print_error("callback failed for", event)
+        self.delivered += 1
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Headers snapshots: a copy of the main chain headers up to some height,
+# that can be imported by another instance.  Chunks may be left out
+# below the hard-coded checkpoints.
+#
+# Format:
+#   magic (4 bytes), version (1 byte), genesis hash (32 bytes),
+#   height (4 bytes),
+#   one flag byte per chunk (1 if the chunk is included, 0 if missing),
+#   the included chunks, 80 bytes per header,
+#   sha256 of all of the above (32 bytes).
+# Integers are little endian; hashes are in internal byte order.
+# Version 1 also had a list of checkpoints, that was not used.
+
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+from . import constants
+from . import util
+from .util import bfh
+from .bitcoin import hash_encode
+from .blockchain import (MAX_TARGET, PARALLEL_HASH_MIN, deserialize_header,
+                         hash_headers, verify_raw_headers)
+
+
+MAGIC = b'ELHS'
+VERSION = 2
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def chunk_size(index, height):
+    return min(2016, height + 1 - index * 2016)
+
+
+def export_snapshot(b, path, height=None):
+    '''Write the headers of blockchain b up to height to path'''
+    b.commit()
+    if height is None:
+        height = b.height()
+    if not 0 <= height <= b.height():
+        raise SnapshotError('height must be between 0 and %d' % b.height())
+    num_chunks = height // 2016 + 1
+    flags = bytearray(num_chunks)
+    chunks = []
+    with b.lock:
+        with open(b.path(), 'rb') as f:
+            for index in range(num_chunks):
+                n = chunk_size(index, height)
+                f.seek(index * 2016 * 80)
+                data = f.read(n * 80)
+                if any(data[i:i+80] == bytes(80) for i in range(0, n * 80, 80)):
+                    continue
+                flags[index] = 1
+                chunks.append(data)
+    s = bytearray()
+    s += MAGIC + bytes([VERSION])
+    s += bfh(constants.net.GENESIS)[::-1]
+    s += height.to_bytes(4, 'little')
+    s += flags
+    s += b''.join(chunks)
+    s += hashlib.sha256(s).digest()
+    temp_path = "%s.tmp.%s" % (path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(s)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return {
+        'height': height,
+        'chunks': num_chunks,
+        'missing_chunks': num_chunks - sum(flags),
+    }
+
+
+def read_snapshot(path):
+    '''Parse a snapshot file.
+    Returns height, and a dict of chunks'''
+    with open(path, 'rb') as f:
+        s = f.read()
+    if len(s) < 81 or s[0:4] != MAGIC:
+        raise SnapshotError('not a headers snapshot')
+    if hashlib.sha256(s[:-32]).digest() != s[-32:]:
+        raise SnapshotError('checksum mismatch')
+    if s[4] != VERSION:
+        raise SnapshotError('unknown snapshot version %d' % s[4])
+    if hash_encode(s[5:37]) != constants.net.GENESIS:
+        raise SnapshotError('snapshot is for another network')
+    height = int.from_bytes(s[37:41], 'little')
+    pos = 41
+    num_chunks = height // 2016 + 1
+    flags = s[pos:pos+num_chunks]
+    pos += num_chunks
+    if len(flags) != num_chunks or any(f not in (0, 1) for f in flags):
+        raise SnapshotError('invalid snapshot flags')
+    size = sum(chunk_size(index, height) * 80 for index in range(num_chunks) if flags[index])
+    if pos + size != len(s) - 32:
+        raise SnapshotError('invalid snapshot length')
+    chunks = {}
+    for index in range(num_chunks):
+        if flags[index]:
+            size = chunk_size(index, height) * 80
+            chunks[index] = s[pos:pos+size]
+            pos += size
+    return height, chunks
+
+
+def verify_snapshot(b, height, chunks, processes=None):
+    '''Verify the chunks of a snapshot against each other and against our
+    checkpoints. Chunks may only be missing below our checkpoints, and
+    the snapshot must end at a checkpoint or above them.
+    Raises SnapshotError.'''
+    trusted = constants.net.CHECKPOINTS
+    num_chunks = height // 2016 + 1
+    if height < len(trusted) * 2016 - 1 and height % 2016 != 2015:
+        # a partial chunk below the checkpoints could be on another chain
+        raise SnapshotError('snapshot tip %d is not at a checkpoint' % height)
+    if height < len(trusted) * 2016 and height // 2016 not in chunks:
+        raise SnapshotError('chunk %d is missing' % (height // 2016))
+    indexes = sorted(chunks.keys())
+    data = b''.join(chunks[i] for i in indexes)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes > 1 and len(data) > PARALLEL_HASH_MIN:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            hashes = hash_headers(data, executor, processes)
+    else:
+        hashes = hash_headers(data)
+    chunk_hashes = {}
+    pos = 0
+    for index in indexes:
+        n = len(chunks[index]) // 80
+        chunk_hashes[index] = hashes[pos:pos+n]
+        pos += n
+    targets = {}
+    for index in range(num_chunks):
+        if index not in chunks:
+            if index >= len(trusted):
+                raise SnapshotError('chunk %d is missing' % index)
+            continue
+        chunk = chunks[index]
+        # hash of the previous header
+        if index == 0:
+            prev_hash = bytes(32)
+        elif index - 1 in chunks:
+            prev_hash = chunk_hashes[index - 1][-1]
+        elif index - 1 < len(trusted):
+            prev_hash = bfh(trusted[index - 1][0])[::-1]
+        else:
+            raise SnapshotError('cannot verify chunk %d' % index)
+        # target of the previous chunk
+        if constants.net.TESTNET:
+            target, bits = 0, None
+        else:
+            if index == 0:
+                target = MAX_TARGET
+            elif index - 1 < len(trusted):
+                target = trusted[index - 1][1]
+            else:
+                target = targets[index - 1]
+            bits = b.target_to_bits(target)
+        try:
+            verify_raw_headers(chunk, chunk_hashes[index], prev_hash, target, bits)
+        except BaseException as e:
+            raise SnapshotError('chunk %d: %s' % (index, e))
+        if index == 0 and hash_encode(chunk_hashes[0][0]) != constants.net.GENESIS:
+            raise SnapshotError('genesis mismatch')
+        if len(chunk) == 2016 * 80:
+            if index < len(trusted) and hash_encode(chunk_hashes[index][-1]) != trusted[index][0]:
+                raise SnapshotError('chunk %d does not match checkpoint' % index)
+            if not constants.net.TESTNET and index >= len(trusted):
+                first = deserialize_header(chunk[0:80], index * 2016)
+                last = deserialize_header(chunk[-80:], index * 2016 + 2015)
+                targets[index] = b.compute_target(first, last)
+
+
+def import_snapshot(b, path, processes=None):
+    '''Verify the snapshot at path, and replace the headers file of
+    blockchain b with it. b must be the main chain, without forks, and
+    not in use by a running network.'''
+    height, chunks = read_snapshot(path)
+    if height <= b.height():
+        raise SnapshotError('local headers are already at height %d' % b.height())
+    if b.children:
+        # their headers files start within ours
+        raise SnapshotError('cannot import while there are forks of the main chain')
+    verify_snapshot(b, height, chunks, processes)
+    num_chunks = height // 2016 + 1
+    temp_path = "%s.tmp.%s" % (b.path(), os.getpid())
+    with open(temp_path, 'wb') as f:
+        for index in range(num_chunks):
+            data = chunks.get(index)
+            f.write(data if data is not None else bytes(chunk_size(index, height) * 80))
+        f.flush()
+        os.fsync(f.fileno())
+    b.replace_headers_file(temp_path)
+    util.print_error('imported headers snapshot', path, height)
+    return {
+        'height': height,
+        'chunks': num_chunks,
+        'missing_chunks': num_chunks - len(chunks),
+    }
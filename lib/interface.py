@@ -246,12 +246,18 @@ class TcpConnection(threading.Thread, util.PrintError):
         self.queue.put((self.server, socket))
 
 
+# requests answered without much work on the server side; their
+# response time is used as round trip time
+RTT_METHODS = {'server.version', 'server.ping', 'server.banner',
+               'blockchain.block.get_header', 'blockchain.relayfee'}
+
+
 class Interface(util.PrintError):
     """The Interface class handles a socket connected to a single remote
     Electrum server.  Its exposed API is:
 
     - Member functions close(), fileno(), get_responses(), has_timed_out(),
-      ping_required(), queue_request(), send_requests()
+      ping_required(), queue_request(), send_requests(), get_rtt_samples()
     - Member variable server.
     """
 
@@ -266,6 +272,8 @@ class Interface(util.PrintError):
         self.debug = False
         self.unsent_requests = []
         self.unanswered_requests = {}
+        self.send_times = {}
+        self.rtt_samples = []
         self.last_send = time.time()
         self.closed_remotely = False
 
@@ -312,6 +320,7 @@ class Interface(util.PrintError):
             if self.debug:
                 self.print_error("-->", request)
             self.unanswered_requests[request[2]] = request
+            self.send_times[request[2]] = self.last_send
         return True
 
     def ping_required(self):
@@ -327,6 +336,12 @@ class Interface(util.PrintError):
 
         return False
 
+    def get_rtt_samples(self):
+        '''Returns and clears the round trip times measured since the
+        last call.'''
+        samples, self.rtt_samples = self.rtt_samples, []
+        return samples
+
     def get_responses(self):
         '''Call if there is data available on the socket.  Returns a list of
         (request, response) pairs.  Notifications are singleton
@@ -355,6 +370,9 @@ class Interface(util.PrintError):
                 responses.append((None, response))
             else:
                 request = self.unanswered_requests.pop(wire_id, None)
+                send_time = self.send_times.pop(wire_id, None)
+                if request and send_time and request[0] in RTT_METHODS:
+                    self.rtt_samples.append(time.time() - send_time)
                 if request:
                     responses.append((request, response))
                 else:
@@ -24,12 +24,18 @@
 # SOFTWARE.
 
 from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, SimpleJSONRPCRequestHandler
-from base64 import b64decode
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import time
 
 from . import util
 
 
+# idle keep-alive connections are closed after this many seconds
+KEEPALIVE_TIMEOUT = 10
+
+
 class RPCAuthCredentialsInvalid(Exception):
     def __str__(self):
         return 'Authentication failed (bad credentials)'
@@ -48,16 +54,58 @@ class RPCAuthUnsupportedType(Exception):
 # based on http://acooke.org/cute/BasicHTTPA0.html by andrew cooke
 class VerifyingJSONRPCServer(SimpleJSONRPCServer):
 
-    def __init__(self, *args, rpc_user, rpc_password, **kargs):
+    def __init__(self, *args, rpc_user, rpc_password, workers=None, **kargs):
 
         self.rpc_user = rpc_user
         self.rpc_password = rpc_password
+        # compared with the Authorization header as is, instead of decoding it
+        credentials = util.to_bytes('%s:%s' % (rpc_user, rpc_password), 'utf8')
+        self.expected_auth = 'Basic ' + util.to_string(b64encode(credentials), 'ascii')
+        # requests are handled by a pool of worker threads, if workers is set
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers else None
+        # idle keep-alive connections hold their worker, so at most
+        # workers - 1 of them are kept, and one worker is always left
+        # for new connections
+        self.keepalive_slots = threading.Semaphore(max(workers - 1, 0)) if workers else None
+        self.local = threading.local()
 
         class VerifyingRequestHandler(SimpleJSONRPCRequestHandler):
+            # keep connections open between requests; only with worker
+            # threads, as a connection holds its thread while open
+            protocol_version = 'HTTP/1.1' if workers else 'HTTP/1.0'
+            timeout = KEEPALIVE_TIMEOUT
+            has_slot = False
+            send_close = False
+
+            def keep_alive(myself):
+                '''Whether the connection can stay open after this request'''
+                if not myself.has_slot:
+                    myself.has_slot = self.keepalive_slots.acquire(False)
+                return myself.has_slot
+
+            def end_headers(myself):
+                if myself.send_close:
+                    myself.send_header('Connection', 'close')
+                SimpleJSONRPCRequestHandler.end_headers(myself)
+
+            def finish(myself):
+                SimpleJSONRPCRequestHandler.finish(myself)
+                if myself.has_slot:
+                    myself.has_slot = False
+                    self.keepalive_slots.release()
+
             def parse_request(myself):
+                # requests after the first one on a connection wait for
+                # nothing; time them from when they are read
+                if getattr(myself, 'keepalive', False):
+                    self.local.accept_time = time.time()
+                myself.keepalive = True
                 # first, call the original implementation which returns
                 # True if all OK so far
                 if SimpleJSONRPCRequestHandler.parse_request(myself):
+                    if not myself.close_connection and not myself.keep_alive():
+                        myself.close_connection = True
+                        myself.send_close = True
                     # Do not authenticate OPTIONS-requests
                     if myself.command.strip() == 'OPTIONS':
                         return True
@@ -76,6 +124,30 @@ class VerifyingJSONRPCServer(SimpleJSONRPCServer):
         SimpleJSONRPCServer.__init__(
             self, requestHandler=VerifyingRequestHandler, *args, **kargs)
 
+    def process_request(self, request, client_address):
+        if self.executor is None:
+            self.local.accept_time = time.time()
+            return SimpleJSONRPCServer.process_request(self, request, client_address)
+        self.executor.submit(self.process_request_worker, request, client_address, time.time())
+
+    def process_request_worker(self, request, client_address, accept_time):
+        self.local.accept_time = accept_time
+        try:
+            self.finish_request(request, client_address)
+        except BaseException:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def get_accept_time(self):
+        '''Time at which the request being handled by this thread was accepted'''
+        return getattr(self.local, 'accept_time', time.time())
+
+    def server_close(self):
+        SimpleJSONRPCServer.server_close(self)
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
     def authenticate(self, headers):
         if self.rpc_password == '':
             # RPC authentication is disabled
@@ -89,10 +161,6 @@ class VerifyingJSONRPCServer(SimpleJSONRPCServer):
         if basic != 'Basic':
             raise RPCAuthUnsupportedType()
 
-        encoded = util.to_bytes(encoded, 'utf8')
-        credentials = util.to_string(b64decode(encoded), 'utf8')
-        (username, _, password) = credentials.partition(':')
-        if not (util.constant_time_compare(username, self.rpc_user)
-                and util.constant_time_compare(password, self.rpc_password)):
+        if not util.constant_time_compare(auth_string, self.expected_auth):
             time.sleep(0.050)
             raise RPCAuthCredentialsInvalid()
@@ -45,12 +45,19 @@ from .bitcoin import COIN
 from . import constants
 from .interface import Connection, Interface
 from . import blockchain
+from .tx_cache import TxCache
+from .tx_store import TxStore
+from .server_stats import ServerStats
+from .event_dispatcher import EventDispatcher
 from .version import ELECTRUM_VERSION, PROTOCOL_VERSION
 from .i18n import _
 
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+SERVER_STATS_INTERVAL = 60
+# number of header chunks requested concurrently while catching up
+CHUNK_WINDOW = 4
 
 
 def parse_servers(result):
@@ -97,10 +104,12 @@ def filter_protocol(hostmap, protocol = 's'):
             eligible.append(serialize_server(host, port, protocol))
     return eligible
 
-def pick_random_server(hostmap = None, protocol = 's', exclude_set = set()):
+def pick_random_server(hostmap = None, protocol = 's', exclude_set = set(), server_stats = None):
     if hostmap is None:
         hostmap = constants.net.DEFAULT_SERVERS
     eligible = list(set(filter_protocol(hostmap, protocol)) - exclude_set)
+    if server_stats:
+        return server_stats.choose(eligible)
     return random.choice(eligible) if eligible else None
 
 from .simple_config import SimpleConfig
@@ -212,6 +221,14 @@ class Network(util.DaemonThread):
         self.sub_cache = {}                     # note: needs self.interface_lock
         # callbacks set by the GUI
         self.callbacks = defaultdict(list)      # note: needs self.callback_lock
+        self.events = EventDispatcher(self.get_callbacks)
+        self.events.start()
+        # raw transactions and verified merkle branches shared by wallets
+        self.tx_cache = TxCache(self.config)
+        # parsed transactions held by wallets, and requests in flight
+        self.tx_store = TxStore()
+        self.server_stats = ServerStats(self.config)
+        self.server_stats_time = time.time()
 
         dir_path = os.path.join( self.config.path, 'certs')
         util.make_dir(dir_path)
@@ -230,8 +247,9 @@ class Network(util.DaemonThread):
         self.interface = None              # note: needs self.interface_lock
         self.interfaces = {}               # note: needs self.interface_lock
         self.auto_connect = self.config.get('auto_connect', True)
-        self.connecting = set()
-        self.requested_chunks = set()
+        self.connecting = {}  # server -> time of connection attempt
+        self.requested_chunks = {}  # index -> (server, blockchain)
+        self.chunk_buffer = {}      # index -> (server, blockchain, hexdata), received out of order
         self.socket_queue = queue.Queue()
         self.start_network(deserialize_server(self.default_server)[2],
                            deserialize_proxy(self.config.get('proxy')))
@@ -259,10 +277,16 @@ class Network(util.DaemonThread):
                 if callback in callbacks:
                     callbacks.remove(callback)
 
-    def trigger_callback(self, event, *args):
+    def get_callbacks(self, event):
         with self.callback_lock:
-            callbacks = self.callbacks[event][:]
-        [callback(event, *args) for callback in callbacks]
+            return self.callbacks[event][:]
+
+    def trigger_callback(self, event, *args):
+        '''Callbacks are called from the event dispatcher thread'''
+        self.events.put(event, args)
+
+    def get_event_stats(self):
+        return self.events.get_stats()
 
     def read_recent_servers(self):
         if not self.config.path:
@@ -415,13 +439,14 @@ class Network(util.DaemonThread):
             if server == self.default_server:
                 self.print_error("connecting to %s as new interface" % server)
                 self.set_status('connecting')
-            self.connecting.add(server)
+            self.connecting[server] = time.time()
             c = Connection(server, self.socket_queue, self.config.path)
 
     def start_random_interface(self):
         with self.interface_lock:
             exclude_set = self.disconnected_servers.union(set(self.interfaces))
-        server = pick_random_server(self.get_servers(), self.protocol, exclude_set)
+        server = pick_random_server(self.get_servers(), self.protocol, exclude_set,
+                                    self.server_stats)
         if server:
             self.start_interface(server)
 
@@ -505,7 +530,7 @@ class Network(util.DaemonThread):
             self.close_interface(self.interface)
         assert self.interface is None
         assert not self.interfaces
-        self.connecting = set()
+        self.connecting = {}
         # Get a new queue - no old pending connections thanks!
         self.socket_queue = queue.Queue()
 
@@ -539,12 +564,13 @@ class Network(util.DaemonThread):
             self.notify('updated')
 
     def switch_to_random_interface(self):
-        '''Switch to a random connected server other than the current one'''
+        '''Switch to a random connected server other than the current one,
+        preferring fast and reliable servers'''
         servers = self.get_interfaces()    # Those in connected state
         if self.default_server in servers:
             servers.remove(self.default_server)
         if servers:
-            self.switch_to_interface(random.choice(servers))
+            self.switch_to_interface(self.server_stats.choose(servers))
 
     @with_interface_lock
     def switch_lagging_interface(self):
@@ -554,7 +580,7 @@ class Network(util.DaemonThread):
             header = self.blockchain().read_header(self.get_local_height())
             filtered = list(map(lambda x:x[0], filter(lambda x: x[1].tip_header==header, self.interfaces.items())))
             if filtered:
-                choice = random.choice(filtered)
+                choice = self.server_stats.choose(filtered)
                 self.switch_to_interface(choice)
 
     @with_interface_lock
@@ -647,6 +673,9 @@ class Network(util.DaemonThread):
             self.on_block_headers(interface, response)
         elif method == 'blockchain.block.get_header':
             self.on_get_header(interface, response)
+        elif method == 'blockchain.transaction.get':
+            if error is None and len(params) == 1:
+                self.tx_cache.add_tx(params[0], result)
 
         for callback in callbacks:
             callback(response)
@@ -658,6 +687,8 @@ class Network(util.DaemonThread):
 
     def process_responses(self, interface):
         responses = interface.get_responses()
+        for rtt in interface.get_rtt_samples():
+            self.server_stats.record_rtt(interface.server, rtt)
         for request, response in responses:
             if request:
                 method, params, message_id = request
@@ -738,14 +769,26 @@ class Network(util.DaemonThread):
                         self.subscriptions[k] = l
                     # check cached response for subscriptions
                     r = self.sub_cache.get(k)
+                else:
+                    r = self.get_cached_response(method, params)
 
                 if r is not None:
-                    self.print_error("cache hit", k)
+                    self.print_error("cache hit", self.get_index(method, params))
                     callback(r)
                 else:
                     message_id = self.queue_request(method, params)
                     self.unanswered_requests[message_id] = method, params, callback
 
+    def get_cached_response(self, method, params):
+        if method == 'blockchain.transaction.get' and len(params) == 1:
+            result = self.tx_cache.get_tx(params[0])
+        elif method == 'blockchain.transaction.get_merkle':
+            result = self.tx_cache.get_merkle(*params)
+        else:
+            return
+        if result is not None:
+            return {'method': method, 'params': params, 'result': result}
+
     def unsubscribe(self, callback):
         '''Unsubscribe a callback to free object references to enable GC.'''
         # Note: we can't unsubscribe from the server, so if we receive
@@ -761,6 +804,7 @@ class Network(util.DaemonThread):
         '''A connection to server either went down, or was never made.
         We distinguish by whether it is in self.interfaces.'''
         self.disconnected_servers.add(server)
+        self.server_stats.record_error(server)
         if server == self.default_server:
             self.set_status('disconnected')
         if server in self.interfaces:
@@ -770,6 +814,17 @@ class Network(util.DaemonThread):
             for b in self.blockchains.values():
                 if b.catch_up == server:
                     b.catch_up = None
+        # chunks requested from this server will not arrive; request them
+        # again from the interface catching up
+        lost = [index for index, (s, b) in self.requested_chunks.items() if s == server]
+        for index in lost:
+            s, b = self.requested_chunks.pop(index)
+            catch_up = self.get_catch_up_interface(b)
+            if catch_up is not None:
+                self.request_chunk(catch_up, index, b)
+        for index, (s, b, hexdata) in list(self.chunk_buffer.items()):
+            if s == server:
+                self.chunk_buffer.pop(index)
 
     def new_interface(self, server, socket):
         # todo: get tip first, then decide which checkpoint to use.
@@ -795,9 +850,10 @@ class Network(util.DaemonThread):
         # Responses to connection attempts?
         while not self.socket_queue.empty():
             server, socket = self.socket_queue.get()
-            if server in self.connecting:
-                self.connecting.remove(server)
+            start_time = self.connecting.pop(server, None)
             if socket:
+                if start_time is not None:
+                    self.server_stats.record_connect(server, time.time() - start_time)
                 self.new_interface(server, socket)
             else:
                 self.connection_down(server)
@@ -808,11 +864,15 @@ class Network(util.DaemonThread):
             interfaces = list(self.interfaces.values())
         for interface in interfaces:
             if interface.has_timed_out():
+                self.server_stats.record_timeout(interface.server)
                 self.connection_down(interface.server)
             elif interface.ping_required():
                 self.queue_request('server.ping', [], interface)
 
         now = time.time()
+        if now - self.server_stats_time > SERVER_STATS_INTERVAL:
+            self.update_server_stats(interfaces)
+            self.server_stats_time = now
         # nodes
         with self.interface_lock:
             if len(self.interfaces) + len(self.connecting) < self.num_server:
@@ -839,21 +899,57 @@ class Network(util.DaemonThread):
                 if self.config.is_fee_estimates_update_required():
                     self.request_fee_estimates()
 
-    def request_chunk(self, interface, index):
-        if index in self.requested_chunks:
+    def update_server_stats(self, interfaces):
+        '''Record how far behind the best known tip each server is,
+        and save the stats'''
+        tips = [i.tip for i in interfaces if i.tip]
+        for interface in interfaces:
+            if interface.tip:
+                self.server_stats.record_lag(interface.server, max(tips) - interface.tip)
+        self.server_stats.save()
+
+    def get_server_stats(self):
+        '''Stats of the servers we are connected to'''
+        return {server: self.server_stats.get(server)
+                for server in self.get_interfaces()}
+
+    def request_chunk(self, interface, index, blockchain=None):
+        if index in self.requested_chunks or index in self.chunk_buffer:
             return
         interface.print_error("requesting chunk %d" % index)
-        self.requested_chunks.add(index)
+        if blockchain is None:
+            blockchain = interface.blockchain
+        self.requested_chunks[index] = (interface.server, blockchain)
         height = index * 2016
         self.queue_request('blockchain.block.headers', [height, 2016],
                            interface)
 
+    def request_chunks_ahead(self, interface, index):
+        '''Request chunk index from the catching-up interface, and the
+        chunks following it (up to the chunk window) from other interfaces
+        that have them.  Chunks are verified in order as they arrive.'''
+        blockchain = interface.blockchain
+        self.request_chunk(interface, index)
+        window = self.config.get('chunk_window', CHUNK_WINDOW)
+        with self.interface_lock:
+            helpers = [i for i in self.interfaces.values() if i != interface]
+        helpers.append(interface)
+        for i in range(index + 1, index + window):
+            if i * 2016 > interface.tip:
+                break
+            eligible = [x for x in helpers if x.tip >= i * 2016]
+            helper = eligible[i % len(eligible)]
+            self.request_chunk(helper, i, blockchain)
+
+    def get_catch_up_interface(self, blockchain):
+        with self.interface_lock:
+            return self.interfaces.get(blockchain.catch_up)
+
     def on_block_headers(self, interface, response):
         '''Handle receiving a chunk of block headers'''
         error = response.get('error')
         result = response.get('result')
         params = response.get('params')
-        blockchain = interface.blockchain
         if result is None or params is None or error is not None:
             interface.print_error(error or 'bad response')
             return
@@ -865,21 +961,56 @@ class Network(util.DaemonThread):
             return
         else:
             interface.print_error("received chunk %d" % index)
-        self.requested_chunks.remove(index)
+        server, blockchain = self.requested_chunks.pop(index)
         hexdata = result['hex']
-        connect = blockchain.connect_chunk(index, hexdata)
-        if not connect:
-            self.connection_down(interface.server)
+        if index >= len(blockchain.checkpoints) and index * 2016 > blockchain.height() + 1:
+            # arrived before its predecessor; keep it until that one is connected
+            self.chunk_buffer[index] = (server, blockchain, hexdata)
             return
-        # If not finished, get the next chunk
-        if index >= len(blockchain.checkpoints) and blockchain.height() < interface.tip:
-            self.request_chunk(interface, index+1)
+        # connect it along with the buffered chunks that follow it
+        run = [(interface, hexdata)]
+        while True:
+            item = self.chunk_buffer.pop(index + len(run), None)
+            if item is None:
+                break
+            server, b, hexdata = item
+            with self.interface_lock:
+                helper = self.interfaces.get(server)
+            if b != blockchain or helper is None:
+                break
+            run.append((helper, hexdata))
+        n = blockchain.connect_chunks(index, [hexdata for helper, hexdata in run])
+        if n < len(run):
+            # the chunks after the bad one may still connect
+            for i in range(n + 1, len(run)):
+                helper, hexdata = run[i]
+                self.chunk_buffer[index + i] = (helper.server, blockchain, hexdata)
+            self.on_bad_chunk(run[n][0], blockchain, index + n)
+            if n == 0:
+                return
+        # If not finished, get the next chunks
+        catch_up = self.get_catch_up_interface(blockchain) or interface
+        if index < len(blockchain.checkpoints):
+            # requested by the verifier, not part of a catch up
+            pass
+        elif blockchain.height() < catch_up.tip:
+            self.request_chunks_ahead(catch_up, (blockchain.height() + 1) // 2016)
         else:
-            interface.mode = 'default'
-            interface.print_error('catch up done', blockchain.height())
+            catch_up.mode = 'default'
+            catch_up.print_error('catch up done', blockchain.height())
             blockchain.catch_up = None
         self.notify('updated')
 
+    def on_bad_chunk(self, interface, blockchain, index):
+        catch_up = self.get_catch_up_interface(blockchain)
+        if catch_up is None or catch_up == interface:
+            self.connection_down(interface.server)
+        else:
+            # a helper served a chunk that does not connect to the chain we
+            # are catching up; ask the interface we are following instead
+            interface.print_error("chunk %d does not connect" % index)
+            self.request_chunk(catch_up, index, blockchain)
+
     def on_get_header(self, interface, response):
         '''Handle receiving a single block header'''
         header = response.get('result')
@@ -1000,7 +1131,7 @@ class Network(util.DaemonThread):
         # If not finished, get the next header
         if next_height is not None:
             if interface.mode == 'catch_up' and interface.tip > next_height + 50:
-                self.request_chunk(interface, next_height // 2016)
+                self.request_chunks_ahead(interface, next_height // 2016)
             else:
                 self.request_header(interface, next_height)
         else:
@@ -1041,6 +1172,17 @@ class Network(util.DaemonThread):
         for interface in rout:
             self.process_responses(interface)
 
+    def commit_headers(self, force=False):
+        '''Write the headers saved since the last commit to disk, if the
+        blockchain's batch is full or old enough (or always if force)'''
+        with self.blockchains_lock:
+            chains = list(self.blockchains.values())
+        for b in chains:
+            if force:
+                b.commit()
+            else:
+                b.maybe_commit()
+
     def init_headers_file(self):
         b = self.blockchains[0]
         filename = b.path()
@@ -1061,7 +1203,11 @@ class Network(util.DaemonThread):
             self.maintain_requests()
             self.run_jobs()    # Synchronizer and Verifier
             self.process_pending_sends()
+            self.commit_headers()
         self.stop_network()
+        self.commit_headers(force=True)
+        self.server_stats.save()
+        self.events.stop()
         self.on_stop()
 
     def on_notify_header(self, interface, header_dict):
@@ -1104,14 +1250,14 @@ class Network(util.DaemonThread):
         else:
             chain = self.blockchains[0]
             if chain.catch_up is None:
-                chain.catch_up = interface
+                chain.catch_up = interface.server
                 interface.mode = 'catch_up'
                 interface.blockchain = chain
                 with self.blockchains_lock:
                     self.print_error("switching to catchup mode", tip,  self.blockchains)
                 self.request_header(interface, 0)
             else:
-                self.print_error("chain already catching up with", chain.catch_up.server)
+                self.print_error("chain already catching up with", chain.catch_up)
 
     @with_interface_lock
     def blockchain(self):
@@ -1200,7 +1346,10 @@ class Network(util.DaemonThread):
         msgs = [
             ('blockchain.scripthash.subscribe', [x])
             for x in hash2address.keys()]
-        self.send(msgs, self.map_scripthash_to_address(callback))
+        cb = self.map_scripthash_to_address(callback)
+        self.send(msgs, cb)
+        # what to pass to unsubscribe
+        return cb
 
     def request_address_history(self, address, callback):
         h = bitcoin.address_to_scripthash(address)
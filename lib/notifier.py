@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import json
+import threading
+import time
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from . import util
+from .bitcoin import is_address
+
+
+# number of threads posting notifications
+NOTIFY_WORKERS = 4
+# maximum number of notifications posted in one request
+BATCH_SIZE = 100
+# notifications kept per URL while it cannot be reached
+MAX_QUEUE = 10000
+# http timeout (seconds)
+TIMEOUT = 5
+# delay before the first retry, doubled after each failure (seconds)
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 600
+# pending notifications are saved that often (seconds)
+SAVE_INTERVAL = 5
+
+
+class Notifier(util.DaemonThread):
+    '''
+    Posts the status of watched addresses to http URLs when it changes.
+    Notifications are queued per URL and posted by a pool of workers,
+    one object per request. With the 'notify_batch' option, up to
+    BATCH_SIZE of them are posted at a time, always as a list. Failed
+    posts are retried with exponential backoff. Registrations and pending notifications are saved in the
+    config directory, and restored when the daemon restarts.
+    '''
+
+    def __init__(self, config, network):
+        util.DaemonThread.__init__(self)
+        self.config = config
+        self.network = network
+        self.cond = threading.Condition()
+        self.watched = {}    # address -> set of URLs
+        self.statuses = {}   # address -> last status notified
+        self.queue = {}      # URL -> list of notifications
+        self.failures = {}   # URL -> number of consecutive failures
+        self.retry_time = {}
+        self.busy = set()    # URLs being posted to
+        self.stats = {'delivered': 0, 'failed': 0, 'dropped': 0}
+        self.modified = False
+        # held while saving, so that saves from add() and from the
+        # thread do not share the temporary file, or go back in time
+        self.save_lock = threading.Lock()
+        self.save_time = time.time()
+        self.local = threading.local()
+        self.batch = bool(config.get('notify_batch', False))
+        self.executor = ThreadPoolExecutor(max_workers=config.get('notify_workers', NOTIFY_WORKERS))
+        self.read()
+
+    def stop(self):
+        util.DaemonThread.stop(self)
+        with self.cond:
+            self.cond.notify()
+
+    def path(self):
+        return os.path.join(self.config.path, 'notifier')
+
+    def read(self):
+        if not self.config.path:
+            return
+        try:
+            with open(self.path(), 'r', encoding='utf-8') as f:
+                d = json.loads(f.read())
+            self.watched = {addr: set(urls) for addr, urls in d['watched'].items()}
+            self.statuses = d['statuses']
+            self.queue = d['queue']
+        except FileNotFoundError:
+            pass
+        except BaseException as e:
+            self.print_error("cannot read", self.path(), e)
+
+    def save(self):
+        if not self.config.path:
+            return
+        with self.save_lock:
+            with self.cond:
+                if not self.modified:
+                    return
+                s = json.dumps({
+                    'watched': {addr: sorted(urls) for addr, urls in self.watched.items()},
+                    'statuses': self.statuses,
+                    'queue': self.queue,
+                })
+                self.modified = False
+            temp_path = self.path() + '.tmp'
+            try:
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    f.write(s)
+                os.replace(temp_path, self.path())
+            except OSError as e:
+                self.print_error("cannot save", e)
+            self.save_time = time.time()
+
+    def add(self, addresses, url):
+        '''Watch addresses; returns the number of new registrations.'''
+        u = urllib.parse.urlsplit(url)
+        if u.scheme not in ['http', 'https'] or not u.netloc:
+            raise BaseException('Invalid URL: %s' % url)
+        for addr in addresses:
+            if not is_address(addr):
+                raise BaseException('Invalid address: %s' % addr)
+        new = []
+        count = 0
+        with self.cond:
+            for addr in addresses:
+                urls = self.watched.get(addr)
+                if urls is None:
+                    urls = self.watched[addr] = set()
+                    new.append(addr)
+                elif url not in urls and addr in self.statuses:
+                    self._enqueue(url, {'address': addr, 'status': self.statuses[addr]})
+                if url not in urls:
+                    urls.add(url)
+                    count += 1
+            self.modified = True
+            self.cond.notify()
+        self.save()
+        if new:
+            self.network.subscribe_to_addresses(new, self.on_address_status)
+        return count
+
+    def remove(self, addresses, url):
+        count = 0
+        with self.cond:
+            for addr in addresses:
+                urls = self.watched.get(addr)
+                if urls is None or url not in urls:
+                    continue
+                urls.remove(url)
+                count += 1
+                if not urls:
+                    # the server keeps sending its notifications; they are ignored
+                    self.watched.pop(addr)
+                    self.statuses.pop(addr, None)
+            self.modified = True
+        self.save()
+        return count
+
+    def get_stats(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats['addresses'] = len(self.watched)
+            stats['pending'] = sum(len(events) for events in self.queue.values())
+            stats['failing_urls'] = len(self.failures)
+        return stats
+
+    def _enqueue(self, url, event):
+        events = self.queue.setdefault(url, [])
+        events.append(event)
+        if len(events) > MAX_QUEUE:
+            events.pop(0)
+            self.stats['dropped'] += 1
+
+    def on_address_status(self, response):
+        # called from the network thread: only queue the notifications
+        if response.get('error'):
+            return
+        addr = response['params'][0]
+        status = response.get('result')
+        with self.cond:
+            urls = self.watched.get(addr)
+            if not urls:
+                return
+            if addr in self.statuses and self.statuses[addr] == status:
+                return
+            self.statuses[addr] = status
+            for url in urls:
+                self._enqueue(url, {'address': addr, 'status': status})
+            self.modified = True
+            self.cond.notify()
+
+    def next_batches(self):
+        now = time.time()
+        batches = []
+        size = BATCH_SIZE if self.batch else 1
+        for url, events in self.queue.items():
+            if events and url not in self.busy and self.retry_time.get(url, 0) <= now:
+                self.busy.add(url)
+                batches.append((url, events[:size]))
+        return batches
+
+    def post(self, url, data):
+        u = urllib.parse.urlsplit(url)
+        path = (u.path or '/') + ('?' + u.query if u.query else '')
+        connections = self.local.__dict__.setdefault('connections', {})
+        key = (u.scheme, u.netloc)
+        for attempt in range(2):
+            connection = connections.get(key)
+            reused = connection is not None
+            if connection is None:
+                cls = http.client.HTTPSConnection if u.scheme == 'https' else http.client.HTTPConnection
+                connection = connections[key] = cls(u.netloc, timeout=TIMEOUT)
+            try:
+                connection.request('POST', path, data, {'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connections.pop(key)
+                # the server may have closed a kept-alive connection
+                if reused:
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+                connections.pop(key)
+            if response.status >= 300:
+                raise Exception('HTTP error %d' % response.status)
+            return
+
+    def deliver(self, url, batch):
+        data = json.dumps(batch if self.batch else batch[0]).encode('utf8')
+        try:
+            self.post(url, data)
+        except BaseException as e:
+            self.print_error("cannot notify", url, e)
+            with self.cond:
+                n = self.failures[url] = self.failures.get(url, 0) + 1
+                self.retry_time[url] = time.time() + min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (n - 1))
+                self.stats['failed'] += 1
+        else:
+            with self.cond:
+                # the batch is at the head of the queue, unless
+                # notifications were dropped in the meantime
+                events = self.queue.get(url, [])
+                n = 0
+                while n < len(events) and n < len(batch) and events[n] is batch[n]:
+                    n += 1
+                del events[:n]
+                if not events:
+                    self.queue.pop(url, None)
+                self.failures.pop(url, None)
+                self.retry_time.pop(url, None)
+                self.stats['delivered'] += len(batch)
+                self.modified = True
+        finally:
+            with self.cond:
+                self.busy.discard(url)
+                self.cond.notify()
+
+    def run(self):
+        with self.cond:
+            addresses = list(self.watched)
+        if addresses:
+            self.network.subscribe_to_addresses(addresses, self.on_address_status)
+        while self.is_running():
+            with self.cond:
+                batches = self.next_batches()
+                if not batches:
+                    retry = min((t for url, t in self.retry_time.items() if url not in self.busy),
+                                default=time.time() + 1)
+                    self.cond.wait(max(0, min(1, retry - time.time())))
+            for url, batch in batches:
+                self.executor.submit(self.deliver, url, batch)
+            if time.time() - self.save_time > SAVE_INTERVAL:
+                self.save()
+        self.executor.shutdown()
+        self.save()
+        self.on_stop()
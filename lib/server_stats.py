@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import json
+import random
+import threading
+import time
+
+from . import util
+
+
+# weight of a new sample in the moving averages
+EWMA_ALPHA = 0.2
+# assumed round trip time of servers we have no samples for (seconds)
+DEFAULT_RTT = 0.5
+# probability of ignoring the stats when picking a server
+EXPLORATION = 0.1
+# counters are halved once they reach this, so that old events fade out
+MAX_COUNT = 100
+
+
+class ServerStats(util.PrintError):
+    '''
+    Per-server connection statistics, persisted in the config
+    directory: connect time and round trip time (moving averages),
+    number of connections, errors and timeouts, and how many blocks
+    the server was behind the best known tip.
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.stats = self.read()
+        self.modified = False
+
+    def path(self):
+        return os.path.join(self.config.path, 'server_stats')
+
+    def read(self):
+        if not self.config.path:
+            return {}
+        try:
+            with open(self.path(), 'r', encoding='utf-8') as f:
+                stats = json.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+        return stats if type(stats) is dict else {}
+
+    def save(self):
+        if not self.config.path:
+            return
+        with self.lock:
+            if not self.modified:
+                return
+            s = json.dumps(self.stats, indent=4, sort_keys=True)
+            self.modified = False
+        try:
+            with open(self.path(), 'w', encoding='utf-8') as f:
+                f.write(s)
+        except OSError as e:
+            self.print_error('cannot save server stats', e)
+
+    def _get(self, server):
+        self.modified = True
+        return self.stats.setdefault(server, {
+            'connect_time': None,
+            'rtt': None,
+            'connections': 0,
+            'errors': 0,
+            'timeouts': 0,
+            'lag': 0,
+            'last_seen': None,
+        })
+
+    def _average(self, d, key, value):
+        d[key] = value if d[key] is None else (1 - EWMA_ALPHA) * d[key] + EWMA_ALPHA * value
+
+    def _increment(self, d, key):
+        d[key] += 1
+        if d[key] >= MAX_COUNT:
+            for k in ['connections', 'errors', 'timeouts']:
+                d[k] //= 2
+
+    def record_connect(self, server, duration):
+        with self.lock:
+            d = self._get(server)
+            self._average(d, 'connect_time', duration)
+            self._increment(d, 'connections')
+            d['last_seen'] = int(time.time())
+
+    def record_rtt(self, server, rtt):
+        with self.lock:
+            self._average(self._get(server), 'rtt', rtt)
+
+    def record_error(self, server):
+        with self.lock:
+            self._increment(self._get(server), 'errors')
+
+    def record_timeout(self, server):
+        with self.lock:
+            self._increment(self._get(server), 'timeouts')
+
+    def record_lag(self, server, lag):
+        with self.lock:
+            self._get(server)['lag'] = lag
+
+    def get(self, server):
+        with self.lock:
+            d = self.stats.get(server)
+            return dict(d) if d else None
+
+    def score(self, server):
+        '''Higher is better'''
+        with self.lock:
+            d = self.stats.get(server)
+            if d is None:
+                return 0.5 / DEFAULT_RTT
+            rtt = d['rtt'] if d['rtt'] is not None else DEFAULT_RTT
+            # errors include timeouts
+            reliability = (d['connections'] + 1) / (d['connections'] + d['errors'] + 2)
+            return reliability / (max(rtt, 0.01) * (1 + max(d['lag'], 0)))
+
+    def choose(self, servers):
+        '''Pick a server, preferring fast and reliable ones'''
+        servers = list(servers)
+        if not servers:
+            return None
+        if random.random() < EXPLORATION:
+            return random.choice(servers)
+        weights = [self.score(s) for s in servers]
+        x = random.uniform(0, sum(weights))
+        for server, weight in zip(servers, weights):
+            x -= weight
+            if x <= 0:
+                break
+        return server
@@ -24,12 +24,19 @@
 # SOFTWARE.
 from threading import Lock
 import hashlib
+import heapq
+import itertools
 
 # from .bitcoin import Hash, hash_encode
 from .transaction import Transaction
 from .util import ThreadJob, bh2u
 
 
+# maximum number of subscriptions, history and transaction requests
+# waiting for a response
+SYNC_MAX_IN_FLIGHT = 1000
+
+
 class Synchronizer(ThreadJob):
     '''The synchronizer keeps the wallet up-to-date with its set of
     addresses and their transactions.  It subscribes over the network
@@ -38,6 +45,12 @@ class Synchronizer(ThreadJob):
     we don't have the full history of, and requests binary transaction
     data of any transactions the wallet doesn't have.
 
+    Subscriptions and transaction requests are queued by priority, and
+    sent so that at most sync_max_in_flight requests are pending:
+    addresses with unconfirmed transactions first, then by most recent
+    use, unused addresses counting as current; unconfirmed transactions
+    first, then by decreasing height.
+
     External interface: __init__() and add() member functions.
     '''
 
@@ -49,6 +62,16 @@ class Synchronizer(ThreadJob):
         self.requested_tx = {}
         self.requested_histories = {}
         self.requested_addrs = set()
+        self.max_in_flight = network.config.get('sync_max_in_flight', SYNC_MAX_IN_FLIGHT)
+        self.counter = itertools.count()
+        self.addr_queue = []  # heap of (-priority, n, addr)
+        self.queued_addrs = set()
+        self.tx_queue = []  # heap of (-priority, n, tx_hash)
+        self.queued_tx = {}  # tx_hash -> tx_height
+        self.num_subscribed = 0
+        # addr -> (history, status): the wallet replaces the history list
+        # of an address when it changes, so the status is recomputed only then
+        self.status_cache = {}
         self.lock = Lock()
 
         self.initialized = False
@@ -62,7 +85,19 @@ class Synchronizer(ThreadJob):
 
     def is_up_to_date(self):
         return (not self.requested_tx and not self.requested_histories
-                and not self.requested_addrs)
+                and not self.requested_addrs
+                and not self.queued_tx and not self.queued_addrs)
+
+    def get_progress(self):
+        return {
+            'addresses_subscribed': self.num_subscribed,
+            'addresses_pending': len(self.queued_addrs) + len(self.requested_addrs),
+            'histories_pending': len(self.requested_histories),
+            'txs_pending': len(self.queued_tx) + len(self.requested_tx),
+        }
+
+    def num_in_flight(self):
+        return len(self.requested_addrs) + len(self.requested_histories) + len(self.requested_tx)
 
     def release(self):
         self.network.unsubscribe(self.on_address_status)
@@ -77,6 +112,59 @@ class Synchronizer(ThreadJob):
             self.requested_addrs |= addresses
             self.network.subscribe_to_addresses(addresses, self.on_address_status)
 
+    def address_priority(self, addr):
+        history = self.wallet.history.get(addr)
+        if not history or history == ['*']:
+            return self.network.get_local_height()
+        heights = [height for tx_hash, height in history]
+        if min(heights) <= 0:
+            return float('inf')
+        return max(heights)
+
+    def queue_address(self, addr):
+        if addr in self.queued_addrs:
+            return
+        self.queued_addrs.add(addr)
+        priority = self.address_priority(addr)
+        heapq.heappush(self.addr_queue, (-priority, next(self.counter), addr))
+
+    def queue_tx(self, tx_hash, tx_height):
+        self.queued_tx[tx_hash] = tx_height
+        priority = float('inf') if tx_height <= 0 else tx_height
+        heapq.heappush(self.tx_queue, (-priority, next(self.counter), tx_hash))
+
+    def send_requests(self):
+        room = self.max_in_flight - self.num_in_flight()
+        if room <= 0:
+            return
+        # leave room for transactions, if some are waiting
+        addr_room = (room + 1) // 2 if self.queued_tx else room
+        addresses = set()
+        while self.addr_queue and len(addresses) < addr_room:
+            priority, n, addr = heapq.heappop(self.addr_queue)
+            self.queued_addrs.discard(addr)
+            addresses.add(addr)
+        self.subscribe_to_addresses(addresses)
+        room -= len(addresses)
+        tx_hashes = []
+        shared = []
+        while self.tx_queue and len(tx_hashes) < room:
+            priority, n, tx_hash = heapq.heappop(self.tx_queue)
+            tx_height = self.queued_tx.pop(tx_hash)
+            if tx_hash in self.wallet.transactions:
+                continue
+            # another wallet has it
+            tx = self.network.tx_store.get(tx_hash)
+            if tx is not None:
+                shared.append((tx_hash, tx, tx_height))
+                continue
+            self.requested_tx[tx_hash] = tx_height
+            tx_hashes.append(tx_hash)
+        if tx_hashes:
+            self.network.tx_store.get_transactions(self.network, tx_hashes, self.on_tx_response)
+        for tx_hash, tx, tx_height in shared:
+            self.receive_tx(tx_hash, tx, tx_height)
+
     def get_status(self, h):
         if not h:
             return None
@@ -85,6 +173,15 @@ class Synchronizer(ThreadJob):
             status += tx_hash + ':%d:' % height
         return bh2u(hashlib.sha256(status.encode('ascii')).digest())
 
+    def get_address_status(self, addr):
+        history = self.wallet.history.get(addr, [])
+        cached = self.status_cache.get(addr)
+        if cached is not None and cached[0] is history:
+            return cached[1]
+        status = self.get_status(history)
+        self.status_cache[addr] = (history, status)
+        return status
+
     def on_address_status(self, response):
         if self.wallet.synchronizer is None and self.initialized:
             return  # we have been killed, this was just an orphan callback
@@ -92,8 +189,7 @@ class Synchronizer(ThreadJob):
         if not params:
             return
         addr = params[0]
-        history = self.wallet.history.get(addr, [])
-        if self.get_status(history) != result:
+        if self.get_address_status(addr) != result:
             # note that at this point 'result' can be None;
             # if we had a history for addr but now the server is telling us
             # there is no history
@@ -103,6 +199,7 @@ class Synchronizer(ThreadJob):
         # remove addr from list only after it is added to requested_histories
         if addr in self.requested_addrs:  # Notifications won't be in
             self.requested_addrs.remove(addr)
+            self.num_subscribed += 1
 
     def on_address_history(self, response):
         if self.wallet.synchronizer is None and self.initialized:
@@ -133,6 +230,7 @@ class Synchronizer(ThreadJob):
         else:
             # Store received history
             self.wallet.receive_history_callback(addr, hist, tx_fees)
+            self.status_cache[addr] = (hist, server_status)
             # Request transactions we don't have
             self.request_missing_txs(hist)
         # Remove request; this allows up_to_date to be True
@@ -145,37 +243,42 @@ class Synchronizer(ThreadJob):
         if not params:
             return
         tx_hash = params[0]
-        tx = Transaction(result)
-        try:
-            tx.deserialize()
-        except Exception:
-            self.print_msg("cannot deserialize transaction, skipping", tx_hash)
-            return
-        if tx_hash != tx.txid():
-            self.print_error("received tx does not match expected txid ({} != {})"
-                             .format(tx_hash, tx.txid()))
+        if tx_hash not in self.requested_tx:
             return
+        # parsed only once, if several wallets requested it
+        tx = self.network.tx_store.get(tx_hash)
+        if tx is None or tx.raw != result:
+            tx = Transaction(result)
+            try:
+                tx.deserialize()
+            except Exception:
+                self.print_msg("cannot deserialize transaction, skipping", tx_hash)
+                return
+            if tx_hash != tx.txid():
+                self.print_error("received tx does not match expected txid ({} != {})"
+                                 .format(tx_hash, tx.txid()))
+                return
+            tx = self.network.tx_store.add(tx_hash, tx)
         tx_height = self.requested_tx.pop(tx_hash)
+        self.receive_tx(tx_hash, tx, tx_height)
+
+    def receive_tx(self, tx_hash, tx, tx_height):
         self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
         self.print_error("received tx %s height: %d bytes: %d" %
                          (tx_hash, tx_height, len(tx.raw)))
         # callbacks
         self.network.trigger_callback('new_transaction', tx)
-        if not self.requested_tx:
+        if not self.requested_tx and not self.queued_tx:
             self.network.trigger_callback('updated')
 
     def request_missing_txs(self, hist):
         # "hist" is a list of [tx_hash, tx_height] lists
-        transaction_hashes = []
         for tx_hash, tx_height in hist:
-            if tx_hash in self.requested_tx:
+            if tx_hash in self.requested_tx or tx_hash in self.queued_tx:
                 continue
             if tx_hash in self.wallet.transactions:
                 continue
-            transaction_hashes.append(tx_hash)
-            self.requested_tx[tx_hash] = tx_height
-
-        self.network.get_transactions(transaction_hashes, self.on_tx_response)
+            self.queue_tx(tx_hash, tx_height)
 
     def initialize(self):
         '''Check the initial state of the wallet.  Subscribe to all its
@@ -190,9 +293,11 @@ class Synchronizer(ThreadJob):
                 continue
             self.request_missing_txs(history)
 
-        if self.requested_tx:
-            self.print_error("missing tx", self.requested_tx)
-        self.subscribe_to_addresses(set(self.wallet.get_addresses()))
+        if self.queued_tx:
+            self.print_error("missing tx", self.queued_tx)
+        for addr in self.wallet.get_addresses():
+            self.queue_address(addr)
+        self.send_requests()
         self.initialized = True
 
     def run(self):
@@ -204,7 +309,9 @@ class Synchronizer(ThreadJob):
         with self.lock:
             addresses = self.new_addresses
             self.new_addresses = set()
-        self.subscribe_to_addresses(addresses)
+        for addr in addresses:
+            self.queue_address(addr)
+        self.send_requests()
 
         # 3. Detect if situation has changed
         up_to_date = self.is_up_to_date()
@@ -0,0 +1,362 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from lib import blockchain
+from lib import constants
+from lib import headers_snapshot
+from lib.blockchain import Blockchain, serialize_header, deserialize_header, hash_header
+from lib.simple_config import SimpleConfig
+from lib.bitcoin import hash_encode
+from lib.util import bfh, bh2u
+
+from . import SequentialTestCase
+
+
+def make_headers(prev_header, count, salt=0):
+    headers = []
+    for i in range(count):
+        height = prev_header['block_height'] + 1
+        header = {
+            'version': 0x20000000,
+            'prev_block_hash': hash_header(prev_header),
+            'merkle_root': '%064x' % (height * 1000 + salt),
+            'timestamp': 1296688602 + height * 600,
+            'bits': 0x207fffff,
+            'nonce': salt,
+            'block_height': height,
+        }
+        headers.append(header)
+        prev_header = header
+    return headers
+
+
+class TestBlockchain(SequentialTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_regtest()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        super().setUp()
+        self.electrum_path = tempfile.mkdtemp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        blockchain.blockchains.clear()
+        open(Blockchain(self.config, 0, None).path(), 'wb').close()
+        blockchain.read_blockchains(self.config)
+        self.genesis = deserialize_header(bfh(
+            '0100000000000000000000000000000000000000000000000000000000000000'
+            '000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa'
+            '4b1e5e4adae5494dffff7f2002000000'), 0)
+
+    def tearDown(self):
+        super().tearDown()
+        blockchain.blockchains.clear()
+        shutil.rmtree(self.electrum_path)
+
+    def _save(self, b, headers):
+        for header in headers:
+            self.assertTrue(b.can_connect(header))
+            b.save_header(header)
+
+    def test_genesis(self):
+        self.assertEqual(constants.net.GENESIS, hash_header(self.genesis))
+
+    def test_read_header_and_get_hash(self):
+        b = blockchain.blockchains[0]
+        headers = [self.genesis] + make_headers(self.genesis, 30)
+        self._save(b, headers)
+        self.assertEqual(30, b.height())
+        for header in headers:
+            height = header['block_height']
+            self.assertEqual(header, b.read_header(height))
+            self.assertEqual(hash_header(header), b.get_hash(height))
+        self.assertIsNone(b.read_header(31))
+        self.assertEqual('00' * 32, b.get_hash(31))
+        # hashes are recomputed from the file by a new instance
+        b.commit()
+        b = Blockchain(self.config, 0, None)
+        for header in headers:
+            self.assertEqual(hash_header(header), b.get_hash(header['block_height']))
+
+    def test_overwrite_invalidates_hashes(self):
+        b = blockchain.blockchains[0]
+        headers = [self.genesis] + make_headers(self.genesis, 10)
+        self._save(b, headers)
+        self.assertEqual(hash_header(headers[10]), b.get_hash(10))
+        other = make_headers(headers[4], 3, salt=1)
+        b.write(bfh(''.join(serialize_header(h) for h in other)), 5 * 80)
+        self.assertEqual(7, b.height())
+        self.assertEqual(hash_header(headers[4]), b.get_hash(4))
+        self.assertEqual(hash_header(other[0]), b.get_hash(5))
+        self.assertEqual(hash_header(other[2]), b.get_hash(7))
+        self.assertEqual('00' * 32, b.get_hash(8))
+
+    def test_fork_and_swap(self):
+        b = blockchain.blockchains[0]
+        headers = [self.genesis] + make_headers(self.genesis, 10)
+        self._save(b, headers)
+        fork_headers = make_headers(headers[5], 8, salt=1)
+        self.assertFalse(b.can_connect(fork_headers[0]))
+        fork = b.fork(fork_headers[0])
+        blockchain.blockchains[fork.checkpoint] = fork
+        self._save(fork, fork_headers[1:])
+        # the fork is now longer and became the main chain
+        main = blockchain.blockchains[0]
+        self.assertIs(fork, main)
+        self.assertEqual(13, main.height())
+        for header in headers[:6] + fork_headers:
+            self.assertEqual(hash_header(header), main.get_hash(header['block_height']))
+        other = blockchain.blockchains[6]
+        self.assertEqual(10, other.height())
+        for header in headers:
+            self.assertEqual(hash_header(header), other.get_hash(header['block_height']))
+            self.assertEqual(header, other.read_header(header['block_height']))
+
+    def test_swap_drops_maps_of_old_files(self):
+        b = blockchain.blockchains[0]
+        headers = [self.genesis] + make_headers(self.genesis, 10)
+        self._save(b, headers)
+        fork_headers = make_headers(headers[5], 8, salt=1)
+        fork = b.fork(fork_headers[0])
+        blockchain.blockchains[fork.checkpoint] = fork
+        write = Blockchain.write
+        def write_and_read(chain, data, offset, *args, **kwargs):
+            write(chain, data, offset, *args, **kwargs)
+            # a reader maps the file before the identities are swapped
+            chain.read_header(chain.checkpoint)
+        with mock.patch.object(Blockchain, 'write', write_and_read):
+            self._save(fork, fork_headers[1:])
+        main = blockchain.blockchains[0]
+        other = blockchain.blockchains[6]
+        self.assertIs(fork, main)
+        for header in headers[:6] + fork_headers:
+            self.assertEqual(header, main.read_header(header['block_height']))
+        for header in headers:
+            self.assertEqual(header, other.read_header(header['block_height']))
+
+    def test_headers_committed_in_batches(self):
+        b = blockchain.blockchains[0]
+        headers = [self.genesis] + make_headers(self.genesis, 10)
+        self._save(b, headers)
+        self.assertEqual(0, os.path.getsize(b.path()))
+        self.assertEqual(headers[10], b.read_header(10))
+        b.commit()
+        self.assertEqual(11 * 80, os.path.getsize(b.path()))
+        self.assertEqual(headers[10], b.read_header(10))
+        # the batch is written once it is full
+        more = make_headers(headers[-1], blockchain.COMMIT_HEADERS)
+        self._save(b, more)
+        self.assertEqual(b.size() * 80, os.path.getsize(b.path()))
+
+    def test_truncate_unverified(self):
+        b = blockchain.blockchains[0]
+        headers = [self.genesis] + make_headers(self.genesis, 10)
+        self._save(b, headers)
+        b.commit()
+        # a torn write: a header that does not connect, and a partial one
+        bad = make_headers(headers[7], 1, salt=1)[0]
+        bad['block_height'] = 11
+        with open(b.path(), 'ab') as f:
+            f.write(bfh(serialize_header(bad)))
+            f.write(b'\x00' * 40)
+        blockchain.blockchains.clear()
+        blockchain.read_blockchains(self.config)
+        b = blockchain.blockchains[0]
+        self.assertEqual(10, b.height())
+        self.assertEqual(11 * 80, os.path.getsize(b.path()))
+        self.assertEqual(hash_header(headers[10]), b.get_hash(10))
+
+    def test_verify_chunk(self):
+        b = blockchain.blockchains[0]
+        headers = [self.genesis] + make_headers(self.genesis, 2015)
+        data = bfh(''.join(serialize_header(h) for h in headers))
+        self.assertTrue(b.connect_chunk(0, bh2u(data)))
+        self.assertEqual(2015, b.height())
+        self.assertEqual(hash_header(headers[-1]), b.get_hash(2015))
+        more = make_headers(headers[-1], 2016)
+        more[100]['prev_block_hash'] = '00' * 32
+        data = bfh(''.join(serialize_header(h) for h in more))
+        self.assertFalse(b.connect_chunk(1, bh2u(data)))
+        self.assertEqual(2015, b.height())
+
+    def test_connect_chunks(self):
+        b = blockchain.blockchains[0]
+        headers = [self.genesis] + make_headers(self.genesis, 3 * 2016 - 1)
+        chunks = [bh2u(bfh(''.join(serialize_header(h) for h in headers[i:i+2016])))
+                  for i in range(0, len(headers), 2016)]
+        bad = make_headers(headers[2015], 2016, salt=1)
+        bad[5]['prev_block_hash'] = '00' * 32
+        bad = bh2u(bfh(''.join(serialize_header(h) for h in bad)))
+        # hashed together, connected up to the bad chunk
+        self.assertEqual(1, b.connect_chunks(0, [chunks[0], bad, chunks[2]]))
+        self.assertEqual(2015, b.height())
+        self.assertEqual(2, b.connect_chunks(1, chunks[1:]))
+        self.assertEqual(3 * 2016 - 1, b.height())
+        self.assertEqual(hash_header(headers[-1]), b.get_hash(3 * 2016 - 1))
+        self.assertEqual(0, b.connect_chunks(3, ['not hex']))
+
+    def test_verify_raw_headers(self):
+        headers = make_headers(self.genesis, 3000)
+        data = bfh(''.join(serialize_header(h) for h in headers))
+        hashes = blockchain.hash_raw_headers(data)
+        self.assertEqual([hash_header(h) for h in headers], [hash_encode(h) for h in hashes])
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            self.assertEqual(hashes, blockchain.hash_headers(data, executor, 3))
+            # one chunk is hashed in this process
+            with mock.patch.object(executor, 'map', side_effect=Exception('used the executor')):
+                self.assertEqual(hashes[:2016], blockchain.hash_headers(data[:80 * 2016], executor, 3))
+        prev_hash = bfh(constants.net.GENESIS)[::-1]
+        blockchain.verify_raw_headers(data, hashes, prev_hash, (1 << 256) - 1, 0x207fffff)
+        with self.assertRaises(Exception):
+            blockchain.verify_raw_headers(data, hashes, prev_hash, (1 << 256) - 1, 0x1d00ffff)
+        with self.assertRaises(Exception):
+            blockchain.verify_raw_headers(data, hashes, prev_hash, 1 << 200, 0x207fffff)
+        with self.assertRaises(Exception):
+            blockchain.verify_raw_headers(data, hashes, bytes(32), (1 << 256) - 1, 0x207fffff)
+
+    def test_swap_moves_forks_of_swapped_chains(self):
+        main = blockchain.blockchains[0]
+        headers = [self.genesis] + make_headers(self.genesis, 10)
+        self._save(main, headers)
+
+        def fork(parent, header):
+            b = parent.fork(header)
+            blockchain.blockchains[b.checkpoint] = b
+            return b
+        below = fork(main, make_headers(headers[2], 1, salt=3)[0])
+        above = fork(main, make_headers(headers[7], 1, salt=2)[0])
+        fork_headers = make_headers(headers[5], 8, salt=1)
+        new = fork(main, fork_headers[0])
+        self._save(new, fork_headers[1:4])
+        child_header = make_headers(fork_headers[2], 1, salt=4)[0]
+        child = fork(new, child_header)
+        self.assertEqual(8, main.get_max_child())
+        self.assertEqual(9, new.get_max_child())
+        self._save(new, fork_headers[4:])
+
+        self.assertIs(new, blockchain.blockchains[0])
+        self.assertIs(main, blockchain.blockchains[6])
+        self.assertEqual(13, new.height())
+        self.assertEqual(10, main.height())
+        self.assertEqual(0, main.parent_id)
+        self.assertEqual(6, above.parent_id)
+        self.assertEqual(0, below.parent_id)
+        self.assertEqual(0, child.parent_id)
+        self.assertEqual(8, main.get_max_child())
+        self.assertEqual(9, new.get_max_child())
+        self.assertEqual(headers[7], above.read_header(7))
+        self.assertEqual(headers[2], below.read_header(2))
+        self.assertEqual(child_header, child.read_header(9))
+        self.assertEqual(fork_headers[2], child.read_header(8))
+        self.assertEqual(headers[5], main.read_header(5))
+        self.assertEqual(fork_headers[0], new.read_header(6))
+
+        # files are named after the new tree
+        for b in blockchain.blockchains.values():
+            b.commit()
+        blockchain.blockchains.clear()
+        blockchain.read_blockchains(self.config)
+        self.assertEqual([0, 3, 6, 8, 9], sorted(blockchain.blockchains.keys()))
+        self.assertEqual(13, blockchain.blockchains[0].height())
+        self.assertEqual(6, blockchain.blockchains[8].parent_id)
+        self.assertEqual(0, blockchain.blockchains[9].parent_id)
+        self.assertEqual(headers[7], blockchain.blockchains[8].read_header(7))
+
+    def test_headers_snapshot(self):
+        b = blockchain.blockchains[0]
+        headers = [self.genesis] + make_headers(self.genesis, 2100)
+        self._save(b, headers)
+        path = os.path.join(self.electrum_path, 'snapshot')
+        r = headers_snapshot.export_snapshot(b, path)
+        self.assertEqual({'height': 2100, 'chunks': 2, 'missing_chunks': 0}, r)
+        # import into an empty instance
+        other_path = tempfile.mkdtemp()
+        try:
+            config = SimpleConfig({'electrum_path': other_path})
+            other = Blockchain(config, 0, None)
+            open(other.path(), 'wb').close()
+            other.update_size()
+            r = headers_snapshot.import_snapshot(other, path, processes=1)
+            self.assertEqual(2100, r['height'])
+            self.assertEqual(2100, other.height())
+            for height in [0, 2015, 2016, 2100]:
+                self.assertEqual(headers[height], other.read_header(height))
+                self.assertEqual(hash_header(headers[height]), other.get_hash(height))
+            # not shorter than the snapshot
+            with self.assertRaises(headers_snapshot.SnapshotError):
+                headers_snapshot.import_snapshot(other, path, processes=1)
+            # not with forks
+            other.children.append(Blockchain(config, 2000, 0))
+            with open(other.path(), 'r+b') as f:
+                f.truncate(1000 * 80)
+            other.update_size()
+            with self.assertRaisesRegex(headers_snapshot.SnapshotError, 'forks'):
+                headers_snapshot.import_snapshot(other, path, processes=1)
+        finally:
+            shutil.rmtree(other_path)
+        # corrupted file
+        with open(path, 'r+b') as f:
+            f.seek(1000)
+            f.write(b'\xff')
+        with self.assertRaises(headers_snapshot.SnapshotError):
+            headers_snapshot.read_snapshot(path)
+
+    def _write_snapshot(self, path, s):
+        with open(path, 'wb') as f:
+            f.write(s + hashlib.sha256(s).digest())
+
+    def test_truncated_snapshot(self):
+        b = blockchain.blockchains[0]
+        headers = [self.genesis] + make_headers(self.genesis, 2100)
+        self._save(b, headers)
+        path = os.path.join(self.electrum_path, 'snapshot')
+        headers_snapshot.export_snapshot(b, path)
+        with open(path, 'rb') as f:
+            s = f.read()[:-32]
+        prefix = s[:41]
+        # flags cut off, with a valid checksum
+        self._write_snapshot(path, prefix[:37] + (100 * 2016).to_bytes(4, 'little') + bytes(10))
+        with self.assertRaisesRegex(headers_snapshot.SnapshotError, 'flags'):
+            headers_snapshot.read_snapshot(path)
+        # headers cut off
+        self._write_snapshot(path, s[:-80])
+        with self.assertRaisesRegex(headers_snapshot.SnapshotError, 'length'):
+            headers_snapshot.read_snapshot(path)
+        self._write_snapshot(path, s)
+        self.assertEqual(2100, headers_snapshot.read_snapshot(path)[0])
+
+    def test_snapshot_checked_against_checkpoints(self):
+        b = blockchain.blockchains[0]
+        headers = [self.genesis] + make_headers(self.genesis, 4100)
+        self._save(b, headers)
+        path = os.path.join(self.electrum_path, 'snapshot')
+        checkpoints = [[hash_header(headers[2015]), 0], [hash_header(headers[4031]), 0]]
+        other_path = tempfile.mkdtemp()
+        try:
+            config = SimpleConfig({'electrum_path': other_path})
+            other = Blockchain(config, 0, None)
+            open(other.path(), 'wb').close()
+            other.update_size()
+            with mock.patch.object(constants.net, 'CHECKPOINTS', checkpoints):
+                # the tip of a partial chunk cannot be checked
+                headers_snapshot.export_snapshot(b, path, 3000)
+                with self.assertRaisesRegex(headers_snapshot.SnapshotError, 'checkpoint'):
+                    headers_snapshot.import_snapshot(other, path, processes=1)
+                headers_snapshot.export_snapshot(b, path, 4031)
+                r = headers_snapshot.import_snapshot(other, path, processes=1)
+                self.assertEqual(4031, r['height'])
+            with mock.patch.object(constants.net, 'CHECKPOINTS', checkpoints[:1] + [['00' * 32, 0]]):
+                with self.assertRaisesRegex(headers_snapshot.SnapshotError, 'does not match checkpoint'):
+                    headers_snapshot.verify_snapshot(other, *headers_snapshot.read_snapshot(path), processes=1)
+        finally:
+            shutil.rmtree(other_path)
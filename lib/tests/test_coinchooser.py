@@ -0,0 +1,110 @@
+from lib import coinchooser
+from lib.bitcoin import TYPE_ADDRESS
+from lib.transaction import Transaction
+from lib.coinchooser import CoinChooserBranchAndBound, CoinChooserPrivacy
+
+from . import SequentialTestCase
+
+
+def make_coins(values, height=100):
+    coins = []
+    for i, value in enumerate(values):
+        coins.append({
+            'type': 'p2pkh',
+            'address': '1KSezYMhAJMWqFbVFB2JshYg69UpmEXR4D',
+            'x_pubkeys': ['02' + '%064x' % (i + 1)],
+            'num_sig': 1,
+            'signatures': [None],
+            'prevout_hash': '%064x' % (i + 1),
+            'prevout_n': 0,
+            'value': value,
+            'height': height,
+        })
+    return coins
+
+
+class BranchAndBoundChooser(CoinChooserBranchAndBound):
+    # one bucket per coin
+    def keys(self, coins):
+        return [coin['prevout_hash'] for coin in coins]
+
+
+class TestBranchAndBound(SequentialTestCase):
+
+    outputs = [(TYPE_ADDRESS, '1Hz5UTGtdGmMwaoaTfJDqqsH3uUfwBAAyd', 1000000)]
+    change_addrs = ['1NwrYQFK8dZbYcjsvoxHuNzhCQwJeM4Nm5']
+
+    def fee_estimator(self, size):
+        return size * 10
+
+    def make_tx(self, chooser, values):
+        return chooser.make_tx(make_coins(values), self.outputs, self.change_addrs,
+                               self.fee_estimator, 546)
+
+    def test_branch_and_bound(self):
+        chooser = BranchAndBoundChooser()
+        self.assertEqual([0, 4], chooser.branch_and_bound([9, 7, 5, 3, 1], 10, 10))
+        self.assertEqual([1, 3], chooser.branch_and_bound([9, 7, 5, 3], 10, 10))
+        self.assertEqual([1, 4], chooser.branch_and_bound([9, 7, 5, 3, 1], 8, 10))
+        self.assertEqual([0], chooser.branch_and_bound([9, 7, 5], 8, 10))
+        self.assertIsNone(chooser.branch_and_bound([9, 7, 5], 10, 11))
+        self.assertIsNone(chooser.branch_and_bound([3, 2], 10, 20))
+        # duplicates are not explored twice
+        self.assertEqual([0, 1, 2], chooser.branch_and_bound([4] * 20, 12, 12))
+
+    def test_changeless_tx(self):
+        # 1000000 + fee for one input spends 1001920 exactly
+        values = [3000000, 1001920 + 200, 600000, 420000, 2500000]
+        tx = self.make_tx(BranchAndBoundChooser(), values)
+        self.assertEqual(1, len(tx.inputs()))
+        self.assertEqual(1001920 + 200, tx.input_value())
+        self.assertEqual(self.outputs, tx.outputs())
+        # the privacy chooser creates change
+        tx = self.make_tx(coinchooser.CoinChooserPrivacy(), values)
+        self.assertEqual(2, len(tx.outputs()))
+
+    def test_changeless_tx_mixed_inputs(self):
+        # a segwit coin that needs change, and a legacy coin that pays
+        # for a legacy transaction exactly
+        coins = make_coins([3000000, 1001920])
+        coins[0] = dict(coins[0], type='p2wpkh', address='bc1qwqdg6squsna38e46795at95yu9atm8azzmyvckulcc7kytlcckxswvvzej')
+        tx = BranchAndBoundChooser().make_tx(coins, self.outputs, self.change_addrs, self.fee_estimator, 546)
+        self.assertEqual(1001920, tx.input_value())
+        self.assertEqual(self.outputs, tx.outputs())
+        self.assertFalse(tx.is_segwit())
+
+    def test_fallback(self):
+        values = [3000000, 2500000]
+        tx = self.make_tx(BranchAndBoundChooser(), values)
+        self.assertEqual(1, len(tx.inputs()))
+        self.assertEqual(2, len(tx.outputs()))
+
+    def test_registered(self):
+        chooser = coinchooser.get_coin_chooser({'coin_chooser': 'BranchAndBound'})
+        self.assertIsInstance(chooser, CoinChooserBranchAndBound)
+        self.assertIsInstance(chooser, CoinChooserPrivacy)
+
+
+class TestIncrementalSelection(SequentialTestCase):
+
+    def test_input_weight(self):
+        coins = make_coins([1000, 2000])
+        coins.append(dict(coins[0], type='p2wpkh', address='bc1qwqdg6squsna38e46795at95yu9atm8azzmyvckulcc7kytlcckxswvvzej'))
+        coins.append({'type': 'address', 'address': '3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy',
+                      'prevout_hash': '%064x' % 9, 'prevout_n': 1, 'value': 1, 'height': 1,
+                      'num_sig': 1, 'signatures': [None]})
+        for witness in [False, True]:
+            for coin in coins:
+                self.assertEqual(Transaction.estimated_input_weight(coin, witness),
+                                 coinchooser.input_weight(coin, witness))
+
+    def test_strip_unneeded(self):
+        chooser = BranchAndBoundChooser()
+        buckets = chooser.bucketize_coins(make_coins([5, 1, 7, 3]))
+        sufficient_funds = lambda t: t.value >= 9
+        self.assertEqual([5, 7], [b.value for b in coinchooser.strip_unneeded(buckets, sufficient_funds)])
+        start = coinchooser.totals(buckets[:1])
+        self.assertEqual(5, start.value)
+        self.assertEqual(buckets[0].weight, start.weight)
+        self.assertEqual(1, start.legacy_inputs)
+        self.assertEqual([7], [b.value for b in coinchooser.strip_unneeded(buckets[1:], sufficient_funds, start)])
@@ -1,7 +1,8 @@
+import json
 import unittest
 from decimal import Decimal
 
-from lib.commands import Commands
+from lib.commands import Commands, paginate
 
 
 class TestCommands(unittest.TestCase):
@@ -31,3 +32,108 @@ class TestCommands(unittest.TestCase):
         self.assertEqual("2asd", Commands._setconfig_normalize_value('rpcpassword', '2asd'))
         self.assertEqual("['file:///var/www/','https://electrum.org']",
             Commands._setconfig_normalize_value('rpcpassword', "['file:///var/www/','https://electrum.org']"))
+
+
+class MockWallet:
+
+    def __init__(self):
+        self.receiving = ['addr%d' % i for i in range(7)]
+        self.change = ['addr%d' % i for i in range(7, 10)]
+        self.addresses = self.receiving + self.change
+        self.history = [('tx%d' % i, i, 10 - i, 1500000000 + i, 1000, 1000 * (i + 1)) for i in range(1, 8)]
+        self.history.append(('mempool', 0, 0, None, -500, 7500))
+        self.views = {}
+        self.built = []
+
+    def get_receiving_addresses(self):
+        return self.receiving
+
+    def get_change_addresses(self):
+        return self.change
+
+    def is_mine(self, addr):
+        return addr in self.addresses
+
+    def is_deterministic(self):
+        return True
+
+    def get_address_index(self, addr):
+        return (addr in self.change, self.addresses.index(addr) - (7 if addr in self.change else 0))
+
+    def get_view(self, name, build):
+        if name not in self.views:
+            self.built.append(name)
+            self.views[name] = build()
+        return self.views[name]
+
+    def get_history(self):
+        return self.history
+
+    def get_history_item(self, tx_hash, height, conf, timestamp, value, balance, **kwargs):
+        return {'txid': tx_hash, 'height': height}
+
+
+class TestPagination(unittest.TestCase):
+
+    def test_paginate(self):
+        items = iter(range(10))
+        self.assertEqual(([0, 1, 2], '2'), paginate(items, str, 3))
+        self.assertEqual(([3, 4, 5], '5'), paginate(range(10), str, 3, '2'))
+        self.assertEqual(([6, 7, 8, 9], None), paginate(range(10), str, 4, '5'))
+        self.assertEqual(([7, 8, 9], None), paginate(range(10), str, None, '6'))
+        self.assertEqual(([], None), paginate(range(10), str, 3, '9'))
+        with self.assertRaises(BaseException):
+            paginate(range(10), str, 3, 'x')
+        with self.assertRaises(BaseException):
+            paginate(range(10), str, 0)
+
+    def test_pages_are_generated_lazily(self):
+        consumed = []
+        def items():
+            for i in range(1000):
+                consumed.append(i)
+                yield i
+        self.assertEqual(([0, 1], '1'), paginate(items(), str, 2))
+        self.assertEqual(3, len(consumed))
+
+    def test_listaddresses(self):
+        commands = Commands(None, MockWallet(), None)
+        self.assertEqual(10, len(commands.listaddresses()))
+        result = commands.listaddresses(limit=4)
+        self.assertEqual({'items': ['addr0', 'addr1', 'addr2', 'addr3'], 'cursor': 'addr3'}, result)
+        cursor, items = None, []
+        while True:
+            result = commands.listaddresses(limit=3, cursor=cursor)
+            items += result['items']
+            cursor = result['cursor']
+            if cursor is None:
+                break
+        self.assertEqual(MockWallet().addresses, items)
+        self.assertEqual(['addr8', 'addr9'], commands.listaddresses(cursor='addr7')['items'])
+        with self.assertRaises(BaseException):
+            commands.listaddresses(cursor='unknown')
+
+    def test_history(self):
+        commands = Commands(None, MockWallet(), None)
+        result = json.loads(commands.history(from_height=5, limit=2))
+        self.assertEqual([{'txid': 'tx5', 'height': 5}, {'txid': 'tx6', 'height': 6}], result['items'])
+        self.assertEqual('tx6', result['cursor'])
+        result = json.loads(commands.history(from_height=5, limit=2, cursor='tx6'))
+        self.assertEqual(['tx7', 'mempool'], [x['txid'] for x in result['items']])
+        self.assertIsNone(result['cursor'])
+
+    def test_history_pages_seek_to_cursor(self):
+        wallet = MockWallet()
+        commands = Commands(None, wallet, None)
+        cursor, txids = None, []
+        while True:
+            result = json.loads(commands.history(limit=3, cursor=cursor))
+            txids += [x['txid'] for x in result['items']]
+            cursor = result['cursor']
+            if cursor is None:
+                break
+        self.assertEqual([x[0] for x in wallet.history], txids)
+        # the history is built once for all the pages
+        self.assertEqual(['history'], wallet.built)
+        with self.assertRaises(BaseException):
+            commands.history(limit=3, cursor='unknown')
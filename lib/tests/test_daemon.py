@@ -0,0 +1,247 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from lib.daemon import Daemon, UnloadedWallet, CommandStats, RequestIndex
+
+from . import SequentialTestCase
+
+
+class MockStorage:
+
+    def __init__(self, path):
+        self.path = path
+
+    def is_encrypted(self):
+        return False
+
+
+class MockSynchronizer:
+
+    def get_address_status(self, addr):
+        return 'status_' + addr
+
+
+class MockWallet:
+
+    def __init__(self, path):
+        self.storage = MockStorage(path)
+        self.synchronizer = MockSynchronizer()
+        self.stopped = False
+        self.request_ids = {'id_' + path: 'a'}
+
+    def get_addresses(self):
+        return ['a', 'b']
+
+    def is_up_to_date(self):
+        return True
+
+    def stop_threads(self):
+        self.stopped = True
+
+
+class MockNetwork:
+
+    def __init__(self):
+        self.subscriptions = []
+
+    def subscribe_to_addresses(self, addresses, callback):
+        cb = lambda response: callback(response)
+        self.subscriptions.append((addresses, cb))
+        return cb
+
+    def unsubscribe(self, callback):
+        self.subscriptions = [s for s in self.subscriptions if s[1] is not callback]
+
+
+class PoolDaemon(Daemon):
+    # only the state needed by the wallet pool
+
+    def __init__(self, config):
+        self.config = config
+        self.gui = None
+        self.network = MockNetwork()
+        self.wallets = {}
+        self.wallets_lock = threading.RLock()
+        self.wallet_locks = {}
+        self.wallet_last_used = {}
+        self.unloaded_wallets = {}
+        self.wallets_to_reload = set()
+        self.pool_time = 0
+        self.request_index = RequestIndex()
+        self.loaded = []
+
+    def _load_wallet(self, path, password):
+        self.loaded.append(path)
+        return MockWallet(path)
+
+
+class TestUnloadedWallet(SequentialTestCase):
+
+    def test_reload_on_status_change(self):
+        changed = []
+        w = UnloadedWallet('path', {'a': 'x', 'b': None}, changed.append)
+        w.on_address_status({'params': ['a'], 'result': 'x'})
+        w.on_address_status({'params': ['b'], 'result': None})
+        w.on_address_status({'params': ['a'], 'error': 'timeout'})
+        self.assertEqual([], changed)
+        w.on_address_status({'params': ['b'], 'result': 'y'})
+        w.on_address_status({'params': ['a'], 'result': 'z'})
+        self.assertEqual(['path'], changed)
+
+
+class TestWalletPool(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.daemon = PoolDaemon({'max_wallets': 2})
+        now = time.time()
+        for i in range(4):
+            path = 'w%d' % i
+            self.daemon.add_wallet(MockWallet(path))
+            self.daemon.wallet_last_used[path] = now - 100 * (10 - i)
+        # recently used
+        self.daemon.wallet_last_used['w0'] = now
+
+    def test_least_recently_used_are_unloaded(self):
+        wallets = dict(self.daemon.wallets)
+        self.daemon.maintain_wallet_pool()
+        self.assertEqual({'w0', 'w3'}, set(self.daemon.wallets))
+        self.assertEqual({'w1', 'w2'}, set(self.daemon.unloaded_wallets))
+        self.assertTrue(wallets['w1'].stopped)
+        self.assertFalse(wallets['w3'].stopped)
+        addresses, callback = self.daemon.network.subscriptions[0]
+        self.assertEqual(['a', 'b'], addresses)
+        self.assertEqual({'a': 'status_a', 'b': 'status_b'}, self.daemon.unloaded_wallets['w1'].statuses)
+
+    def test_busy_wallet_is_kept(self):
+        with self.daemon.get_wallet_lock('w1'):
+            self.daemon.maintain_wallet_pool()
+        # the next least recently used instead
+        self.assertEqual({'w0', 'w1'}, set(self.daemon.wallets))
+        self.assertEqual({'w2', 'w3'}, set(self.daemon.unloaded_wallets))
+
+    def test_reload(self):
+        self.daemon.maintain_wallet_pool()
+        # on demand
+        self.assertIsNotNone(self.daemon.get_wallet('w1'))
+        self.assertEqual(['w1'], self.daemon.loaded)
+        self.assertNotIn('w1', self.daemon.unloaded_wallets)
+        self.assertIsNone(self.daemon.get_wallet('unknown'))
+        # on notification
+        unloaded = self.daemon.unloaded_wallets['w2']
+        unloaded.on_address_status({'params': ['a'], 'result': 'new'})
+        self.daemon.maintain_wallet_pool()
+        self.assertEqual(['w1', 'w2'], self.daemon.loaded)
+        self.assertEqual({}, self.daemon.unloaded_wallets)
+        self.assertFalse(unloaded.active)
+
+    def test_request_index(self):
+        self.daemon.maintain_wallet_pool()
+        # requests of unloaded wallets are still indexed
+        self.assertEqual(('w1', 'a'), self.daemon.request_index.get('id_w1'))
+        self.assertIsNone(self.daemon.request_index.get('id_unknown'))
+        self.daemon.get_wallet('w1')
+        self.assertIs(self.daemon.request_index, self.daemon.wallets['w1'].request_index)
+        self.daemon.stop_wallet('w1')
+        self.assertIsNone(self.daemon.request_index.get('id_w1'))
+        self.assertEqual(('w2', 'a'), self.daemon.request_index.get('id_w2'))
+        self.assertEqual(['w1'], self.daemon.loaded)
+
+    def test_get_wallet_while_unloading(self):
+        results = []
+        stopping = threading.Event()
+        release = threading.Event()
+        wallet = self.daemon.wallets['w1']
+        def stop_threads():
+            stopping.set()
+            release.wait(5)
+            wallet.stopped = True
+        wallet.stop_threads = stop_threads
+        t = threading.Thread(target=self.daemon.unload_wallet, args=('w1',))
+        t.start()
+        stopping.wait(5)
+        # waits for the unload to finish, and reloads it
+        t2 = threading.Thread(target=lambda: results.append(self.daemon.get_wallet('w1')))
+        t2.start()
+        time.sleep(0.1)
+        self.assertEqual([], results)
+        release.set()
+        t.join()
+        t2.join()
+        self.assertTrue(wallet.stopped)
+        self.assertEqual(['w1'], self.daemon.loaded)
+        self.assertIsNot(wallet, results[0])
+        self.assertEqual('w1', results[0].storage.path)
+
+    def test_reload_unsubscribes(self):
+        for i in range(2):
+            self.daemon.wallet_last_used['w1'] = 0
+            self.daemon.pool_time = 0
+            self.daemon.maintain_wallet_pool()
+            self.assertIn('w1', self.daemon.unloaded_wallets)
+            self.assertEqual(2, len(self.daemon.network.subscriptions))
+            for path in list(self.daemon.unloaded_wallets):
+                self.daemon.get_wallet(path)
+            self.assertEqual([], self.daemon.network.subscriptions)
+        self.daemon.wallet_last_used['w1'] = 0
+        self.daemon.pool_time = 0
+        self.daemon.maintain_wallet_pool()
+        self.assertEqual(1, len(self.daemon.network.subscriptions))
+        self.daemon.stop_wallet('w1')
+        self.assertEqual([], self.daemon.network.subscriptions)
+
+    def test_size_budget(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            daemon = PoolDaemon({'max_wallets_size': 1})
+            for i in range(3):
+                path = os.path.join(tmpdir, 'w%d' % i)
+                with open(path, 'wb') as f:
+                    f.write(b'\0' * 400000)
+                daemon.add_wallet(MockWallet(path))
+                daemon.wallet_last_used[path] = i
+            daemon.maintain_wallet_pool()
+            self.assertEqual([os.path.join(tmpdir, 'w0')], list(daemon.unloaded_wallets))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestRunCommand(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.daemon = PoolDaemon({})
+        self.daemon.server = None
+        self.daemon.command_stats = CommandStats()
+        self.running = []
+        self.events = []
+        self.release = threading.Event()
+
+    def command(self, name):
+        self.running.append(name)
+        self.events.append(('start', name))
+        self.release.wait(5)
+        self.events.append(('end', name))
+        self.running.remove(name)
+        return name
+
+    def start(self, name, path):
+        t = threading.Thread(target=self.daemon.run_command,
+                             args=(name, self.command, (name,), {}, path))
+        t.start()
+        time.sleep(0.1)
+        return t
+
+    def test_commands_on_same_wallet_are_serialized(self):
+        threads = [self.start('a', 'w1'), self.start('b', 'w1'), self.start('c', 'w2')]
+        # c runs along with a; b waits for a
+        self.assertEqual(['a', 'c'], self.running)
+        self.release.set()
+        for t in threads:
+            t.join()
+        self.assertLess(self.events.index(('end', 'a')), self.events.index(('start', 'b')))
+        self.assertEqual({'a', 'b', 'c'}, set(self.daemon.get_command_stats()))
+        self.assertGreater(self.daemon.get_command_stats()['b']['max_queue_time'], 0.1)
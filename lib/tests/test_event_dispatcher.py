@@ -0,0 +1,57 @@
+import threading
+import time
+
+from lib.event_dispatcher import EventDispatcher
+
+from . import SequentialTestCase
+
+
+class TestEventDispatcher(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.received = []
+        self.lock = threading.Lock()
+        self.dispatcher = EventDispatcher(lambda event: [self.on_event], window=0.05)
+        self.dispatcher.start()
+
+    def tearDown(self):
+        self.dispatcher.stop()
+        super().tearDown()
+
+    def on_event(self, event, *args):
+        with self.lock:
+            self.received.append((event, args, threading.current_thread()))
+
+    def test_repeated_events_are_coalesced(self):
+        for i in range(100):
+            self.dispatcher.put('updated', ())
+            self.dispatcher.put('fee', (i,))
+        self.dispatcher.stop()
+        events = [(event, args) for event, args, thread in self.received]
+        # the first one may or may not have been delivered already
+        self.assertIn(events.count(('updated', ())), [1, 2])
+        fees = [e for e in events if e[0] == 'fee']
+        self.assertIn(len(fees), [1, 2])
+        self.assertEqual(('fee', (99,)), fees[-1])
+        self.assertEqual(200 - len(events), self.dispatcher.get_stats()['coalesced'])
+
+    def test_events_with_payload_are_all_delivered(self):
+        for i in range(100):
+            self.dispatcher.put('new_transaction', (i,))
+        self.dispatcher.stop()
+        self.assertEqual([('new_transaction', (i,)) for i in range(100)],
+                         [(event, args) for event, args, thread in self.received])
+        self.assertTrue(all(thread is self.dispatcher for event, args, thread in self.received))
+        stats = self.dispatcher.get_stats()
+        self.assertEqual(100, stats['delivered'])
+        self.assertEqual(0, stats['queue_depth'])
+
+    def test_window(self):
+        self.dispatcher.put('updated', ())
+        time.sleep(0.02)
+        self.dispatcher.put('updated', ())
+        time.sleep(0.01)
+        self.assertEqual(1, len(self.received))
+        time.sleep(0.1)
+        self.assertEqual(2, len(self.received))
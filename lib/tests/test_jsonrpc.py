@@ -0,0 +1,119 @@
+import base64
+import http.client
+import json
+import threading
+import time
+
+import jsonrpclib
+
+from lib.jsonrpc import VerifyingJSONRPCServer
+from lib.daemon import CommandStats
+
+from . import SequentialTestCase
+
+
+class TestVerifyingJSONRPCServer(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = VerifyingJSONRPCServer(('127.0.0.1', 0), logRequests=False,
+                                             rpc_user='user', rpc_password='pass', workers=4)
+        self.server.timeout = 0.05
+        self.release = threading.Event()
+        self.server.register_function(self.slow, 'slow')
+        self.server.register_function(lambda x: x + 1, 'fast')
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+        host, port = self.server.socket.getsockname()
+        self.url = 'http://user:pass@%s:%d' % (host, port)
+
+    def tearDown(self):
+        self.release.set()
+        self.running = False
+        self.thread.join()
+        self.server.server_close()
+        super().tearDown()
+
+    def serve(self):
+        while self.running:
+            self.server.handle_request()
+
+    def slow(self):
+        self.release.wait(5)
+        return 'slow'
+
+    def test_slow_request_does_not_block_others(self):
+        results = []
+        t = threading.Thread(target=lambda: results.append(jsonrpclib.Server(self.url).slow()))
+        t.start()
+        time.sleep(0.1)
+        self.assertEqual(2, jsonrpclib.Server(self.url).fast(1))
+        self.assertEqual([], results)
+        self.release.set()
+        t.join()
+        self.assertEqual(['slow'], results)
+
+    def post(self, connection, data, password='pass'):
+        auth = base64.b64encode(('user:%s' % password).encode('ascii')).decode('ascii')
+        connection.request('POST', '/', json.dumps(data),
+                           {'Authorization': 'Basic ' + auth, 'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        return response, response.read()
+
+    def test_keepalive_and_batch(self):
+        host, port = self.server.socket.getsockname()
+        connection = http.client.HTTPConnection(host, port)
+        for i in range(3):
+            response, body = self.post(connection, {'jsonrpc': '2.0', 'id': i, 'method': 'fast', 'params': [i]})
+            self.assertEqual(11, response.version)
+            self.assertEqual(i + 1, json.loads(body.decode('utf8'))['result'])
+        sock = connection.sock
+        batch = [{'jsonrpc': '2.0', 'id': i, 'method': 'fast', 'params': [i]} for i in range(10)]
+        response, body = self.post(connection, batch)
+        # same connection
+        self.assertIs(sock, connection.sock)
+        results = {r['id']: r['result'] for r in json.loads(body.decode('utf8'))}
+        self.assertEqual({i: i + 1 for i in range(10)}, results)
+        response, body = self.post(connection, batch, password='wrong')
+        self.assertEqual(401, response.status)
+        connection.close()
+
+    def test_idle_connections_do_not_block_others(self):
+        host, port = self.server.socket.getsockname()
+        connections = []
+        for i in range(4):
+            connection = http.client.HTTPConnection(host, port)
+            response, body = self.post(connection, {'jsonrpc': '2.0', 'id': i, 'method': 'fast', 'params': [i]})
+            self.assertEqual(i + 1, json.loads(body.decode('utf8'))['result'])
+            connections.append(connection)
+        # only 3 of them are kept open, one worker is left
+        self.assertEqual(['keep-alive'] * 3 + ['close'],
+                         [c.sock and 'keep-alive' or 'close' for c in connections])
+        t0 = time.time()
+        self.assertEqual(2, jsonrpclib.Server(self.url).fast(1))
+        self.assertLess(time.time() - t0, 1)
+        # a connection that was closed can make further requests
+        response, body = self.post(connections[3], {'jsonrpc': '2.0', 'id': 0, 'method': 'fast', 'params': [5]})
+        self.assertEqual(6, json.loads(body.decode('utf8'))['result'])
+        for connection in connections:
+            connection.close()
+
+    def test_bad_credentials(self):
+        host, port = self.server.socket.getsockname()
+        with self.assertRaises(Exception):
+            jsonrpclib.Server('http://user:wrong@%s:%d' % (host, port)).fast(1)
+
+
+class TestCommandStats(SequentialTestCase):
+
+    def test_record(self):
+        stats = CommandStats()
+        stats.record('getbalance', 0.5, 1.0)
+        stats.record('getbalance', 0.1, 3.0)
+        d = stats.get()['getbalance']
+        self.assertEqual(2, d['count'])
+        self.assertEqual(0.3, d['avg_queue_time'])
+        self.assertEqual(0.5, d['max_queue_time'])
+        self.assertEqual(2.0, d['avg_exec_time'])
+        self.assertEqual(3.0, d['max_exec_time'])
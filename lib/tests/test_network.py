@@ -0,0 +1,169 @@
+import threading
+
+from lib.network import Network
+
+from . import SequentialTestCase
+
+
+class MockBlockchain:
+
+    def __init__(self, height):
+        self._height = height
+        self.checkpoints = []
+        self.catch_up = None
+        self.connected = []
+        self.batches = []
+
+    def height(self):
+        return self._height
+
+    def connect_chunk(self, index, hexdata):
+        if hexdata == 'bad' or index * 2016 != self._height + 1:
+            return False
+        self.connected.append(index)
+        self._height = (index + 1) * 2016 - 1
+        return True
+
+    def connect_chunks(self, index, hexdatas):
+        self.batches.append(len(hexdatas))
+        for i, hexdata in enumerate(hexdatas):
+            if not self.connect_chunk(index + i, hexdata):
+                return i
+        return len(hexdatas)
+
+
+class MockInterface:
+
+    def __init__(self, server, tip, blockchain):
+        self.server = server
+        self.tip = tip
+        self.blockchain = blockchain
+        self.mode = 'catch_up'
+
+    def print_error(self, *msg):
+        pass
+
+
+class MockServerStats:
+
+    def record_error(self, server):
+        pass
+
+
+class MockNetwork(Network):
+    # only the state needed to catch up with chunks
+
+    def __init__(self, config):
+        self.config = config
+        self.interface_lock = threading.RLock()
+        self.interfaces = {}
+        self.blockchains_lock = threading.Lock()
+        self.blockchains = {}
+        self.requested_chunks = {}
+        self.chunk_buffer = {}
+        self.disconnected_servers = set()
+        self.server_stats = MockServerStats()
+        self.default_server = None
+        self.requests = []
+
+    def queue_request(self, method, params, interface=None):
+        self.requests.append((interface.server, params[0] // 2016))
+
+    def close_interface(self, interface):
+        self.interfaces.pop(interface.server)
+
+    def notify(self, key):
+        pass
+
+
+class TestCatchUpWithChunks(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.network = MockNetwork({'chunk_window': 5})
+        self.blockchain = MockBlockchain(2015)
+        self.network.blockchains[0] = self.blockchain
+        tip = 10 * 2016
+        self.a = MockInterface('a', tip, self.blockchain)
+        self.b = MockInterface('b', tip, self.blockchain)
+        self.c = MockInterface('c', 4 * 2016, self.blockchain)
+        for i in [self.a, self.b, self.c]:
+            self.network.interfaces[i.server] = i
+        self.blockchain.catch_up = 'a'
+        self.network.request_chunks_ahead(self.a, 1)
+
+    def receive(self, server, index, hexdata=None):
+        response = {'params': [index * 2016, 2016], 'result': {'hex': hexdata or str(index)}}
+        self.network.on_block_headers(self.network.interfaces[server], response)
+
+    def servers(self):
+        return {index: s for index, (s, b) in self.network.requested_chunks.items()}
+
+    def test_request_chunks_ahead(self):
+        # c does not have chunk 5
+        self.assertEqual({1: 'a', 2: 'a', 3: 'b', 4: 'c', 5: 'a'}, self.servers())
+        self.assertEqual([('a', 1), ('a', 2), ('b', 3), ('c', 4), ('a', 5)], self.network.requests)
+
+    def test_out_of_order_chunks_are_buffered(self):
+        self.receive('c', 4)
+        self.receive('b', 3)
+        self.assertEqual([3, 4], sorted(self.network.chunk_buffer))
+        self.receive('a', 1)
+        self.assertEqual([1], self.blockchain.connected)
+        self.assertEqual([3, 4], sorted(self.network.chunk_buffer))
+        self.receive('a', 2)
+        self.assertEqual([1, 2, 3, 4], self.blockchain.connected)
+        self.assertEqual({}, self.network.chunk_buffer)
+        # the next window
+        self.assertEqual({5: 'a', 6: 'b', 7: 'a', 8: 'b', 9: 'a'}, self.servers())
+
+    def test_bad_chunk_from_helper(self):
+        self.receive('a', 1)
+        self.receive('a', 2)
+        self.receive('b', 3, 'bad')
+        # requested again from the interface we are catching up with
+        self.assertEqual('a', self.servers()[3])
+        self.assertEqual(('a', 3), self.network.requests[-1])
+        self.assertIn('b', self.network.interfaces)
+        self.receive('a', 3)
+        self.assertEqual([1, 2, 3], self.blockchain.connected)
+
+    def test_buffered_chunks_connect_in_one_batch(self):
+        self.receive('c', 4)
+        self.receive('b', 3)
+        self.receive('a', 2)
+        self.receive('a', 1)
+        self.assertEqual([4], self.blockchain.batches)
+        self.assertEqual([1, 2, 3, 4], self.blockchain.connected)
+
+    def test_bad_chunk_in_batch(self):
+        self.receive('c', 4)
+        self.receive('b', 3, 'bad')
+        self.receive('a', 2)
+        self.receive('a', 1)
+        self.assertEqual([1, 2], self.blockchain.connected)
+        # chunk 3 is requested from a, chunk 4 waits for it
+        self.assertEqual('a', self.servers()[3])
+        self.assertEqual([4], list(self.network.chunk_buffer))
+        self.receive('a', 3)
+        self.assertEqual([1, 2, 3, 4], self.blockchain.connected)
+
+    def test_bad_chunk_from_catch_up_interface(self):
+        self.receive('a', 1, 'bad')
+        self.assertNotIn('a', self.network.interfaces)
+        self.assertEqual({'a'}, self.network.disconnected_servers)
+        self.assertIsNone(self.blockchain.catch_up)
+
+    def test_helper_disconnects(self):
+        self.receive('c', 4)
+        self.network.connection_down('b')
+        # b's request goes to a, c's buffered chunk is kept
+        self.assertEqual({1: 'a', 2: 'a', 3: 'a', 5: 'a'}, self.servers())
+        self.assertEqual([4], list(self.network.chunk_buffer))
+        self.network.connection_down('c')
+        self.assertEqual({}, self.network.chunk_buffer)
+        for index in [1, 2, 3]:
+            self.receive('a', index)
+        self.assertEqual([1, 2, 3], self.blockchain.connected)
+        # chunk 4 again, from a
+        self.assertEqual('a', self.servers()[4])
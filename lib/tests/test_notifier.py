@@ -0,0 +1,186 @@
+import http.server
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from lib import notifier
+from lib.notifier import Notifier
+
+from . import SequentialTestCase
+
+
+ADDRESSES = ['1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2',
+             '3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy',
+             'bc1qar0srrr7xfkvy5l643lydnw9re59gtzzwf5mdq']
+
+
+class MockConfig:
+
+    def __init__(self, path, options=None):
+        self.path = path
+        self.options = options or {}
+
+    def get(self, key, default=None):
+        return self.options.get(key, default)
+
+
+class MockNetwork:
+
+    def __init__(self):
+        self.subscribed = []
+
+    def subscribe_to_addresses(self, addresses, callback):
+        self.subscribed.append(list(addresses))
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        server = self.server
+        with server.lock:
+            server.connections.add(self.client_address)
+            if server.fail:
+                server.fail -= 1
+                status = 500
+            else:
+                server.received.append(json.loads(data.decode('utf8')))
+                status = 200
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestNotifier(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.retry_delay = notifier.RETRY_DELAY
+        notifier.RETRY_DELAY = 0.05
+        self.path = tempfile.mkdtemp()
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        self.server.lock = threading.Lock()
+        self.server.received = []
+        self.server.connections = set()
+        self.server.fail = 0
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.url = 'http://127.0.0.1:%d/hook?key=1' % self.server.server_port
+        self.network = MockNetwork()
+        self.notifier = self.start_notifier()
+
+    def tearDown(self):
+        self.notifier.stop()
+        self.notifier.join()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        shutil.rmtree(self.path)
+        notifier.RETRY_DELAY = self.retry_delay
+        super().tearDown()
+
+    def start_notifier(self, options=None):
+        n = Notifier(MockConfig(self.path, options), self.network)
+        n.start()
+        return n
+
+    def status(self, addr, status):
+        self.notifier.on_address_status({'params': [addr], 'result': status})
+
+    def received(self):
+        events = []
+        for data in self.server.received:
+            events += data if isinstance(data, list) else [data]
+        return events
+
+    def wait_delivered(self, n):
+        for i in range(100):
+            if self.notifier.get_stats()['delivered'] >= n:
+                return
+            time.sleep(0.02)
+        self.fail('not delivered: %r' % self.notifier.get_stats())
+
+    def test_notifications(self):
+        self.notifier.add(ADDRESSES, self.url)
+        self.assertEqual([ADDRESSES], self.network.subscribed)
+        with self.notifier.cond:
+            for addr in ADDRESSES:
+                self.status(addr, 'a')
+        self.wait_delivered(3)
+        # one object per request, in order
+        self.assertEqual([{'address': addr, 'status': 'a'} for addr in ADDRESSES], self.server.received)
+        # unchanged
+        self.status(ADDRESSES[0], 'a')
+        self.status(ADDRESSES[0], 'b')
+        self.wait_delivered(4)
+        self.assertEqual({'address': ADDRESSES[0], 'status': 'b'}, self.server.received[-1])
+        self.assertEqual(4, len(self.received()))
+        # same connection
+        self.assertEqual(1, len(self.server.connections))
+        with self.assertRaises(BaseException):
+            self.notifier.add(['notanaddress'], self.url)
+        with self.assertRaises(BaseException):
+            self.notifier.add(ADDRESSES, 'ftp://example.com')
+
+    def test_batches(self):
+        self.notifier.stop()
+        self.notifier.join()
+        self.notifier = self.start_notifier({'notify_batch': True})
+        self.notifier.add(ADDRESSES, self.url)
+        with self.notifier.cond:
+            # delivered in one batch
+            for addr in ADDRESSES:
+                self.status(addr, 'a')
+        self.wait_delivered(3)
+        self.assertEqual([[{'address': addr, 'status': 'a'} for addr in ADDRESSES]], self.server.received)
+        # a single notification is a list too
+        self.status(ADDRESSES[0], 'b')
+        self.wait_delivered(4)
+        self.assertEqual([{'address': ADDRESSES[0], 'status': 'b'}], self.server.received[-1])
+
+    def test_retry(self):
+        self.server.fail = 2
+        self.notifier.add(ADDRESSES[:1], self.url)
+        self.status(ADDRESSES[0], 'a')
+        self.wait_delivered(1)
+        self.assertEqual([{'address': ADDRESSES[0], 'status': 'a'}], self.received())
+        stats = self.notifier.get_stats()
+        self.assertEqual(2, stats['failed'])
+        self.assertEqual(0, stats['pending'])
+
+    def test_registrations_and_queue_are_saved(self):
+        self.server.fail = 1000
+        self.notifier.add(ADDRESSES, self.url)
+        self.status(ADDRESSES[1], 'a')
+        self.notifier.stop()
+        self.notifier.join()
+        self.network.subscribed = []
+        self.server.fail = 0
+        self.notifier = self.start_notifier()
+        self.wait_delivered(1)
+        self.assertEqual([{'address': ADDRESSES[1], 'status': 'a'}], self.received())
+        self.assertEqual([ADDRESSES], self.network.subscribed)
+        self.notifier.remove(ADDRESSES[1:], self.url)
+        self.status(ADDRESSES[1], 'b')
+        self.assertEqual(0, self.notifier.get_stats()['pending'])
+        self.assertEqual(1, self.notifier.get_stats()['addresses'])
+
+    def test_concurrent_saves(self):
+        urls = ['%s&n=%d' % (self.url, i) for i in range(8)]
+        threads = [threading.Thread(target=self.notifier.add, args=(ADDRESSES, url)) for url in urls]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        with open(os.path.join(self.path, 'notifier'), 'r', encoding='utf-8') as f:
+            d = json.loads(f.read())
+        self.assertEqual(sorted(urls), d['watched'][ADDRESSES[0]])
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'notifier.tmp')))
@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from lib import server_stats
+from lib.server_stats import ServerStats
+
+from . import SequentialTestCase
+
+
+class MockConfig:
+
+    def __init__(self, path):
+        self.path = path
+
+
+class TestServerStats(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.electrum_path = tempfile.mkdtemp()
+        self.stats = ServerStats(MockConfig(self.electrum_path))
+
+    def tearDown(self):
+        shutil.rmtree(self.electrum_path)
+        super().tearDown()
+
+    def test_moving_average(self):
+        self.stats.record_rtt('s', 1.0)
+        self.assertEqual(1.0, self.stats.get('s')['rtt'])
+        self.stats.record_rtt('s', 2.0)
+        self.assertAlmostEqual(1.2, self.stats.get('s')['rtt'])
+        self.stats.record_connect('s', 0.5)
+        self.stats.record_connect('s', 1.5)
+        d = self.stats.get('s')
+        self.assertAlmostEqual(0.7, d['connect_time'])
+        self.assertEqual(2, d['connections'])
+        self.assertIsNotNone(d['last_seen'])
+
+    def test_counters_are_halved(self):
+        for i in range(10):
+            self.stats.record_connect('s', 0.1)
+        for i in range(server_stats.MAX_COUNT):
+            self.stats.record_error('s')
+        d = self.stats.get('s')
+        self.assertEqual(5, d['connections'])
+        self.assertEqual(server_stats.MAX_COUNT // 2, d['errors'])
+
+    def test_score(self):
+        unknown = self.stats.score('unknown')
+        self.stats.record_rtt('fast', 0.1)
+        self.stats.record_rtt('slow', 1.0)
+        self.assertGreater(self.stats.score('fast'), unknown)
+        self.assertGreater(unknown, self.stats.score('slow'))
+        self.stats.record_rtt('errors', 0.1)
+        self.stats.record_error('errors')
+        self.assertLess(self.stats.score('errors'), self.stats.score('fast'))
+        self.stats.record_rtt('behind', 0.1)
+        self.stats.record_lag('behind', 2)
+        self.assertAlmostEqual(self.stats.score('fast') / 3, self.stats.score('behind'))
+
+    def test_choose(self):
+        self.assertIsNone(self.stats.choose([]))
+        self.stats.record_rtt('fast', 0.01)
+        self.stats.record_rtt('slow', 10.0)
+        servers = ['slow', 'fast']
+        with mock.patch('random.random', return_value=1.0):
+            with mock.patch('random.uniform', side_effect=lambda a, b: b / 2):
+                self.assertEqual('fast', self.stats.choose(servers))
+        # exploration ignores the stats
+        with mock.patch('random.random', return_value=0.0):
+            with mock.patch('random.choice', side_effect=lambda l: l[0]):
+                self.assertEqual('slow', self.stats.choose(servers))
+
+    def test_save_and_load(self):
+        self.stats.record_rtt('s', 0.3)
+        self.stats.record_lag('s', 1)
+        self.stats.save()
+        self.assertFalse(self.stats.modified)
+        loaded = ServerStats(MockConfig(self.electrum_path))
+        self.assertEqual(self.stats.get('s'), loaded.get('s'))
+        # corrupt or unexpected files are ignored
+        for data in ['{not json', '[1, 2]']:
+            with open(os.path.join(self.electrum_path, 'server_stats'), 'w') as f:
+                f.write(data)
+            self.assertIsNone(ServerStats(MockConfig(self.electrum_path)).get('s'))
+        shutil.rmtree(self.electrum_path)
+        self.assertIsNone(ServerStats(MockConfig(self.electrum_path)).get('s'))
+        os.mkdir(self.electrum_path)
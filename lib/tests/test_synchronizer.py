@@ -0,0 +1,167 @@
+from lib import synchronizer
+from lib.synchronizer import Synchronizer
+from lib.tx_store import TxStore
+
+from . import SequentialTestCase
+
+
+class MockNetwork:
+
+    def __init__(self, config=None):
+        self.config = config or {}
+        self.history_requests = []
+        self.subscribed = []
+        self.tx_requests = []
+        self.tx_store = TxStore()
+        self.events = []
+
+    def get_local_height(self):
+        return 1000
+
+    def subscribe_to_addresses(self, addresses, callback):
+        self.subscribed.append(addresses)
+
+    def request_address_history(self, addr, callback):
+        self.history_requests.append(addr)
+
+    def get_transactions(self, tx_hashes, callback):
+        self.tx_requests.append(tx_hashes)
+
+    def trigger_callback(self, event, *args):
+        self.events.append(event)
+
+
+class MockWallet:
+
+    def __init__(self, history):
+        self.history = history
+        self.transactions = {}
+        self.synchronizer = None
+        self.addresses = list(history.keys())
+
+    def get_addresses(self):
+        return self.addresses
+
+    def synchronize(self):
+        pass
+
+    def is_up_to_date(self):
+        return False
+
+    def set_up_to_date(self, up_to_date):
+        pass
+
+    def receive_history_callback(self, addr, hist, tx_fees):
+        self.history[addr] = hist
+
+    def receive_tx_callback(self, tx_hash, tx, tx_height):
+        self.transactions[tx_hash] = tx
+
+
+class CountingSynchronizer(Synchronizer):
+
+    status_count = 0
+
+    def get_status(self, h):
+        self.status_count += 1
+        return super().get_status(h)
+
+
+class TestSynchronizer(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.hist = [('%064x' % i, 100 + i) for i in range(1000)]
+        self.wallet = MockWallet({'addr': self.hist})
+        self.network = MockNetwork()
+        self.sync = CountingSynchronizer(self.wallet, self.network)
+        self.wallet.synchronizer = self.sync
+        self.status = Synchronizer.get_status(None, self.hist)
+
+    def test_status_is_cached(self):
+        for i in range(10):
+            self.sync.on_address_status({'params': ['addr'], 'result': self.status})
+        self.assertEqual(1, self.sync.status_count)
+        self.assertEqual([], self.network.history_requests)
+
+    def test_status_is_updated_with_history(self):
+        new_hist = self.hist + [('%064x' % 5000, 0)]
+        new_status = Synchronizer.get_status(None, new_hist)
+        self.sync.on_address_status({'params': ['addr'], 'result': new_status})
+        self.assertEqual(['addr'], self.network.history_requests)
+        result = [{'tx_hash': tx_hash, 'height': height} for tx_hash, height in new_hist]
+        self.sync.on_address_history({'params': ['addr'], 'result': result})
+        count = self.sync.status_count
+        self.sync.on_address_status({'params': ['addr'], 'result': new_status})
+        self.assertEqual(count, self.sync.status_count)
+        self.assertEqual(['addr'], self.network.history_requests)
+        # history replaced by the wallet itself
+        self.wallet.history['addr'] = []
+        self.sync.on_address_status({'params': ['addr'], 'result': new_status})
+        self.assertEqual(['addr', 'addr'], self.network.history_requests)
+
+
+class TestSyncScheduler(SequentialTestCase):
+
+    def test_in_flight_budget_and_priorities(self):
+        history = {
+            'old': [('%064x' % 1, 10)],
+            'recent': [('%064x' % 2, 900)],
+            'unconfirmed': [('%064x' % 3, 500), ('%064x' % 4, 0)],
+        }
+        wallet = MockWallet(history)
+        wallet.addresses += ['unused%d' % i for i in range(10)]
+        network = MockNetwork({'sync_max_in_flight': 4})
+        sync = Synchronizer(wallet, network)
+        wallet.synchronizer = sync
+        # half of the budget goes to transactions, which are waiting
+        self.assertEqual([{'unconfirmed', 'unused0'}], network.subscribed)
+        self.assertEqual([['%064x' % 4, '%064x' % 2]], network.tx_requests)
+        self.assertEqual({'addresses_subscribed': 0, 'addresses_pending': 13,
+                          'histories_pending': 0, 'txs_pending': 4}, sync.get_progress())
+        sync.run()
+        self.assertEqual(1, len(network.subscribed))
+        sync.on_address_status({'params': ['unused0'], 'result': None})
+        sync.run()
+        self.assertEqual(['unused1'], list(network.subscribed[1]))
+        self.assertEqual(1, sync.get_progress()['addresses_subscribed'])
+        # drain everything
+        for i in range(20):
+            for addr in list(sync.requested_addrs):
+                sync.on_address_status({'params': [addr], 'result': sync.get_address_status(addr)})
+            sync.requested_tx.clear()
+            sync.run()
+        subscribed = [addr for addresses in network.subscribed for addr in addresses]
+        self.assertEqual(13, len(set(subscribed)))
+        self.assertEqual([{'unused3', 'unused2'}, {'unused4', 'unused5', 'unused6', 'unused7'},
+                          {'unused8', 'unused9', 'recent', 'old'}], network.subscribed[2:])
+        self.assertEqual(['%064x' % 3, '%064x' % 1], network.tx_requests[1])
+        self.assertTrue(sync.is_up_to_date())
+
+
+class TestSharedTransactions(SequentialTestCase):
+
+    raw_tx = '010000000118231a31d2df84f884ced6af11dc24306319577d4d7c340124a7e2dd9c314077000000004847304402200b6c45891aed48937241907bc3e3868ee4c792819821fcde33311e5a3da4789a02205021b59692b652a01f5f009bd481acac2f647a7d9c076d71d85869763337882e01fdffffff016c95052a010000001976a9149c4891e7791da9e622532c97f43863768264faaf88ac00000000'
+    txid = '90ba90a5b115106d26663fce6c6215b8699c5d4b2672dd30756115f3337dddf9'
+
+    def make_synchronizer(self, network):
+        wallet = MockWallet({'addr': [(self.txid, 100)]})
+        sync = Synchronizer(wallet, network)
+        wallet.synchronizer = sync
+        return wallet, sync
+
+    def test_wallets_share_requests_and_transactions(self):
+        network = MockNetwork()
+        wallet1, sync1 = self.make_synchronizer(network)
+        wallet2, sync2 = self.make_synchronizer(network)
+        self.assertEqual([[self.txid]], network.tx_requests)
+        network.tx_store.on_tx_response({'params': [self.txid], 'result': self.raw_tx})
+        tx = wallet1.transactions[self.txid]
+        self.assertIs(tx, wallet2.transactions[self.txid])
+        self.assertEqual({}, sync1.requested_tx)
+        self.assertEqual({}, sync2.requested_tx)
+        # no request if a wallet has it
+        wallet3, sync3 = self.make_synchronizer(network)
+        self.assertIs(tx, wallet3.transactions[self.txid])
+        self.assertEqual(1, len(network.tx_requests))
+        self.assertEqual(3, network.events.count('new_transaction'))
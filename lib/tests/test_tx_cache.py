@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+
+from lib.simple_config import SimpleConfig
+from lib.tx_cache import TxCache, raw_tx_hash
+
+from . import SequentialTestCase
+
+
+RAW_TX = '01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff25033ca0030400001256124d696e656420627920425443204775696c640800000d41000007daffffffff01c00d1298000000001976a91427a1f12771de5cc3b73941664b2537c15316be4388ac00000000'
+TXID = '4328f9311c6defd9ae1bd7f4516b62acf64b361eb39dfcf09d9925c5fd5c61e8'
+RAW_SEGWIT_TX = '020000000001010000000000000000000000000000000000000000000000000000000000000000ffffffff0502cd010101ffffffff0240be402500000000232103f4e686cdfc96f375e7c338c40c9b85f4011bb843a3e62e46a1de424ef87e9385ac0000000000000000266a24aa21a9ede2f61c3f71d1defd3fa999dfa36953755c690689799962b48bebd836974e8cf90120000000000000000000000000000000000000000000000000000000000000000000000000'
+SEGWIT_TXID = 'fb5a57c24e640a6d8d831eb6e41505f3d54363c507da3733b098d820e3803301'
+
+
+class TestTxCache(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.electrum_path = tempfile.mkdtemp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.electrum_path)
+
+    def test_raw_tx_hash(self):
+        self.assertEqual(TXID, raw_tx_hash(RAW_TX))
+        self.assertEqual(SEGWIT_TXID, raw_tx_hash(RAW_SEGWIT_TX))
+
+    def test_add_and_get_tx(self):
+        cache = TxCache(self.config)
+        self.assertIsNone(cache.get_tx(TXID))
+        self.assertTrue(cache.add_tx(TXID, RAW_TX))
+        self.assertTrue(cache.add_tx(SEGWIT_TXID, RAW_SEGWIT_TX))
+        # shared between instances
+        cache = TxCache(self.config)
+        self.assertEqual(RAW_TX, cache.get_tx(TXID))
+        self.assertEqual(RAW_SEGWIT_TX, cache.get_tx(SEGWIT_TXID))
+
+    def test_hash_mismatch_not_cached(self):
+        cache = TxCache(self.config)
+        self.assertFalse(cache.add_tx(SEGWIT_TXID, RAW_TX))
+        self.assertIsNone(cache.get_tx(SEGWIT_TXID))
+
+    def test_corrupted_entry_removed(self):
+        cache = TxCache(self.config)
+        cache.add_tx(TXID, RAW_TX)
+        with open(cache._path('tx', TXID), 'wb') as f:
+            f.write(b'\x00' * 10)
+        self.assertIsNone(cache.get_tx(TXID))
+        self.assertFalse(os.path.exists(cache._path('tx', TXID)))
+
+    def test_merkle(self):
+        cache = TxCache(self.config)
+        merkle = {'block_height': 100, 'pos': 1, 'merkle': ['00' * 32]}
+        cache.add_merkle(TXID, 100, merkle)
+        self.assertEqual(merkle, cache.get_merkle(TXID, 100))
+        self.assertIsNone(cache.get_merkle(TXID, 101))
+        self.assertTrue(cache.remove_merkle(TXID, 100))
+        self.assertIsNone(cache.get_merkle(TXID, 100))
+
+    def test_eviction(self):
+        cache = TxCache(self.config)
+        cache.max_size = len(RAW_TX) // 2 + 10
+        cache.add_tx(TXID, RAW_TX)
+        os.utime(cache._path('tx', TXID), (0, 0))
+        cache.add_tx(SEGWIT_TXID, RAW_SEGWIT_TX)
+        self.assertIsNone(cache.get_tx(TXID))
+        self.assertEqual(RAW_SEGWIT_TX, cache.get_tx(SEGWIT_TXID))
@@ -0,0 +1,47 @@
+import gc
+
+from lib.transaction import Transaction
+from lib.tx_store import TxStore
+
+from . import SequentialTestCase
+
+
+class MockNetwork:
+
+    def __init__(self):
+        self.requests = []
+
+    def get_transactions(self, tx_hashes, callback):
+        self.requests.append((tx_hashes, callback))
+
+
+class TestTxStore(SequentialTestCase):
+
+    def test_transactions_are_shared_while_referenced(self):
+        store = TxStore()
+        tx = Transaction('00')
+        self.assertIs(tx, store.add('a', tx))
+        self.assertIs(tx, store.add('a', Transaction('00')))
+        self.assertIs(tx, store.get('a'))
+        self.assertEqual(1, store.get_stats()['shared'])
+        del tx
+        gc.collect()
+        self.assertIsNone(store.get('a'))
+        self.assertEqual(0, store.get_stats()['transactions'])
+
+    def test_requests_are_sent_once(self):
+        store = TxStore()
+        network = MockNetwork()
+        received = []
+        store.get_transactions(network, ['a', 'b'], lambda r: received.append((1, r['params'][0])))
+        store.get_transactions(network, ['b', 'c'], lambda r: received.append((2, r['params'][0])))
+        self.assertEqual([['a', 'b'], ['c']], [hashes for hashes, callback in network.requests])
+        self.assertEqual(1, store.get_stats()['requests_saved'])
+        callback = network.requests[0][1]
+        for tx_hash in ['b', 'a', 'c']:
+            callback({'params': [tx_hash], 'result': '00'})
+        self.assertEqual([(1, 'b'), (2, 'b'), (1, 'a'), (2, 'c')], received)
+        self.assertEqual(0, store.get_stats()['requests'])
+        # unsolicited
+        callback({'params': ['a'], 'result': '00'})
+        self.assertEqual(4, len(received))
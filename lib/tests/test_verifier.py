@@ -0,0 +1,143 @@
+import os
+from collections import defaultdict
+
+from lib import verifier
+from lib.verifier import SPV, InnerNodeOfSpvProofIsValidTx, could_be_tx
+from lib.transaction import Transaction
+from lib.util import bh2u
+
+from . import SequentialTestCase
+
+
+class MockBlockchain:
+
+    def __init__(self, height, missing=()):
+        self._height = height
+        self.missing = set(missing)
+        self.checkpoints = [None] * 2
+
+    def read_header(self, height):
+        if height > self._height or height in self.missing:
+            return None
+        return {'block_height': height}
+
+
+class MockInterface:
+
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+
+
+class MockNetwork:
+
+    def __init__(self, blockchain):
+        self.interface = MockInterface(blockchain)
+        self._blockchain = blockchain
+        self.sent = []
+        self.requested_chunks = []
+
+    def blockchain(self):
+        return self._blockchain
+
+    def get_local_height(self):
+        return self._blockchain._height
+
+    def send(self, messages, callback):
+        self.sent.append(messages)
+
+    def request_chunk(self, interface, index):
+        self.requested_chunks.append(index)
+
+
+class MockWallet:
+
+    def __init__(self, unverified):
+        self.unverified_tx = defaultdict(int, unverified)
+        self.verifier = None
+
+    def get_unverified_txs(self):
+        return dict(self.unverified_tx)
+
+    def is_up_to_date(self):
+        return True
+
+
+class TestSPV(SequentialTestCase):
+
+    def test_requests_are_batched_by_height(self):
+        unverified = {'%064x' % i: i for i in range(1, 251)}
+        unverified['%064x' % 1000] = 1000  # above the local height
+        unverified['%064x' % 1001] = 0     # unconfirmed
+        network = MockNetwork(MockBlockchain(500))
+        spv = SPV(network, MockWallet(unverified))
+        spv.run()
+        self.assertEqual(1, len(network.sent))
+        self.assertEqual(verifier.MERKLE_BATCH_SIZE, len(network.sent[0]))
+        heights = [params[1] for method, params in network.sent[0]]
+        self.assertEqual(list(range(1, verifier.MERKLE_BATCH_SIZE + 1)), heights)
+        spv.run()
+        spv.run()
+        spv.run()
+        requested = [params[0] for messages in network.sent for method, params in messages]
+        self.assertEqual(250, len(requested))
+        self.assertEqual(250, len(set(requested)))
+        self.assertFalse(spv.is_up_to_date())
+
+    def test_waits_for_missing_headers(self):
+        network = MockNetwork(MockBlockchain(5000, missing=[10]))
+        spv = SPV(network, MockWallet({'%064x' % 1: 10, '%064x' % 2: 20}))
+        spv.run()
+        self.assertEqual([0], network.requested_chunks)
+        self.assertEqual([['%064x' % 2, 20]], [params for method, params in network.sent[0]])
+        spv.run()
+        self.assertEqual(1, len(network.sent))
+        network.blockchain().missing.clear()
+        spv.run()
+        self.assertEqual([['%064x' % 1, 10]], [params for method, params in network.sent[1]])
+
+    def test_stale_entries_are_dropped(self):
+        wallet = MockWallet({'%064x' % 1: 10})
+        network = MockNetwork(MockBlockchain(5000))
+        spv = SPV(network, wallet)
+        # the tx got reorged to another height
+        wallet.unverified_tx['%064x' % 1] = 12
+        spv.add_unverified_tx('%064x' % 1, 12)
+        spv.run()
+        self.assertEqual([['%064x' % 1, 12]], [params for method, params in network.sent[0]])
+
+
+class TestInnerNodeCheck(SequentialTestCase):
+
+    # a 32 byte transaction with no inputs and one output
+    TX_32 = bytes.fromhex('01000000' '000100' '01' '1027000000000000' '0b' + '6a' * 11 + '00000000')
+
+    def _parses(self, raw):
+        try:
+            Transaction(bh2u(raw)).deserialize()
+        except BaseException:
+            return False
+        return True
+
+    def test_could_be_tx_never_rejects_a_parsable_tx(self):
+        self.assertEqual(32, len(self.TX_32))
+        self.assertTrue(self._parses(self.TX_32))
+        self.assertTrue(could_be_tx(self.TX_32))
+        with self.assertRaises(InnerNodeOfSpvProofIsValidTx):
+            SPV._raise_if_valid_tx(bh2u(self.TX_32))
+        for i in range(2000):
+            raw = os.urandom(32)
+            if not could_be_tx(raw):
+                self.assertFalse(self._parses(raw))
+            # also with the segwit marker set, which passes the first checks
+            raw = raw[:4] + b'\x00\x01' + raw[6:]
+            if not could_be_tx(raw):
+                self.assertFalse(self._parses(raw))
+
+    def test_could_be_tx_rejects_impossible_layouts(self):
+        self.assertFalse(could_be_tx(b'\x01\x00\x00\x00'))
+        # segwit marker missing
+        self.assertFalse(could_be_tx(bytes(4) + b'\x00\x02' + bytes(26)))
+        # one input does not fit in 32 bytes
+        self.assertFalse(could_be_tx(bytes(4) + b'\x01' + bytes(27)))
+        self.assertFalse(could_be_tx(bytes(4) + b'\xfd\x01\x00' + bytes(25)))
+        self.assertTrue(could_be_tx(bytes(4) + b'\x01' + bytes(46)))
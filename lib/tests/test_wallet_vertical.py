@@ -1,13 +1,18 @@
+import json
+import os
 import unittest
 from unittest import mock
 import shutil
 import tempfile
+import threading
 from typing import Sequence
 
 import lib
 from lib import storage, bitcoin, keystore, constants
 from lib.transaction import Transaction
 from lib.simple_config import SimpleConfig
+from lib.commands import Commands
+from lib.consolidation import ConsolidationPlanner, ConsolidationThread
 from lib.wallet import TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT, sweep
 from lib.util import bfh, bh2u
 
@@ -1602,3 +1607,225 @@ class TestWalletHistory_EvilGapLimit(TestCaseForTestnet):
                                    {})
         w.synchronize()
         self.assertEqual(9999788, sum(w.get_balance()))
+
+
+class TestPaymentRequests(TestCaseForTestnet):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.electrum_path = tempfile.mkdtemp()
+        cls.config = SimpleConfig({'electrum_path': cls.electrum_path})
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(cls.electrum_path)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_bulk_requests_and_payment_status(self, mock_write):
+        ks = keystore.from_seed('bitter grass shiver impose acquire brush forget axis eager alone wine silver', '', False)
+        wallet = WalletIntegrityHelper.create_standard_wallet(ks, gap_limit=2)
+        export = os.path.join(self.electrum_path, 'requests.json')
+        cmds = Commands(self.config, wallet, None)
+        out = cmds.addrequests([{'amount': '0.01'}, {'amount': '0.02', 'memo': 'second', 'expiration': 3600}], export=export)
+        self.assertEqual(wallet.get_receiving_addresses(), [r['address'] for r in out])
+        self.assertEqual(['0.01', '0.02'], [r['amount (BTC)'] for r in out])
+        with open(export, 'r', encoding='utf-8') as f:
+            exported = json.loads(f.read())
+        self.assertEqual([r['id'] for r in out], [r['id'] for r in exported])
+        self.assertTrue(all(r['bip70'] for r in exported))
+        self.assertEqual('second', wallet.labels[out[1]['address']])
+        self.assertEqual(out[1]['address'], wallet.get_request_address(out[1]['id']))
+        # no temporary file left
+        self.assertEqual(['requests.json'], os.listdir(self.electrum_path))
+        with self.assertRaisesRegex(BaseException, 'Not enough unused addresses'):
+            cmds.addrequests([{'amount': '0.01'}])
+        # paid, once the funding transaction is received
+        addr = out[0]['address']
+        self.assertEqual((False, None), wallet.get_payment_status(addr, 1000000))
+        funding_tx = Transaction('01000000014576dacce264c24d81887642b726f5d64aa7825b21b350c7b75a57f337da6845010000006b483045022100a3f8b6155c71a98ad9986edd6161b20d24fad99b6463c23b463856c0ee54826d02200f606017fd987696ebbe5200daedde922eee264325a184d5bbda965ba5160821012102e5c473c051dae31043c335266d0ef89c1daab2f34d885cc7706b267f3269c609ffffffff0240420f00000000001600148a28bddb7f61864bdcf58b2ad13d5aeb3abc3c42a2ddb90e000000001976a914c384950342cb6f8df55175b48586838b03130fad88ac00000000')
+        self.assertEqual({'items': [], 'cursor': None}, cmds.listunspent(limit=1))
+        wallet.receive_tx_callback(funding_tx.txid(), funding_tx, TX_HEIGHT_UNCONFIRMED)
+        self.assertEqual((True, 0), wallet.get_payment_status(addr, 1000000))
+        # the sorted views of paged commands follow the history
+        page = cmds.listunspent(limit=1)
+        self.assertEqual([funding_tx.txid()], [x['prevout_hash'] for x in page['items']])
+        self.assertEqual([funding_tx.txid()], [x['txid'] for x in json.loads(cmds.history(limit=5))['items']])
+        self.assertIsNone(page['cursor'])
+        self.assertEqual([], cmds.listunspent(cursor='%s:0' % funding_tx.txid())['items'])
+        wallet.remove_transaction(funding_tx.txid())
+        self.assertEqual((False, None), wallet.get_payment_status(addr, 1000000))
+        self.assertEqual([], cmds.listunspent(limit=1)['items'])
+        self.assertEqual(2, len(cmds.listrequests(limit=5)['items']))
+        wallet.remove_payment_request(addr, self.config)
+        self.assertIsNone(wallet.get_request_address(out[0]['id']))
+        self.assertEqual([out[1]['address']], [x['address'] for x in cmds.listrequests(limit=5)['items']])
+
+
+class TestConsolidation(TestCaseForTestnet):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.electrum_path = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(cls.electrum_path)
+
+    def make_funding_tx(self, outputs):
+        '''An unsigned transaction paying value to each address'''
+        raw = '02000000' + '01' + '11' * 32 + '00000000' + '00' + 'ffffffff'
+        raw += bitcoin.var_int(len(outputs))
+        for address, value in outputs:
+            script = bitcoin.address_to_script(address)
+            raw += bitcoin.int_to_hex(value, 8) + bitcoin.var_int(len(script) // 2) + script
+        return Transaction(raw + '00000000')
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_consolidate(self, mock_write):
+        ks = keystore.from_seed('bitter grass shiver impose acquire brush forget axis eager alone wine silver', '', False)
+        wallet = WalletIntegrityHelper.create_standard_wallet(ks, gap_limit=2)
+        addr0, addr1 = wallet.get_receiving_addresses()
+        outputs = [(addr0, 20000 + i) for i in range(230)]
+        outputs += [(addr0, 50)] * 10   # not worth spending
+        outputs += [(addr1, 20000)] * 10
+        tx = self.make_funding_tx(outputs)
+        wallet.receive_tx_callback(tx.txid(), tx, 100)
+        wallet.set_frozen_state([addr1], True)
+        config = SimpleConfig({'electrum_path': self.electrum_path, 'dynamic_fees': False, 'fee_per_kb': 1000})
+        planner = ConsolidationPlanner(wallet, config)
+        txs, summary = planner.plan()
+        self.assertEqual([100, 100, 30], [len(tx.inputs()) for tx in txs])
+        self.assertTrue(all(txin['address'] == addr0 for tx in txs for txin in tx.inputs()))
+        self.assertEqual(240, summary['coins'])
+        self.assertEqual(13, summary['coins_after'])
+        self.assertTrue(summary['fees_low'])
+        self.assertEqual(sum(tx.get_fee() for tx in txs), summary['fee'])
+        self.assertLess(0, summary['fee_saved'])
+        self.assertEqual(['after', 'before'], sorted(summary['selection_ms'].keys()))
+        # the smallest coins first
+        txs, summary = planner.plan(max_inputs=50, max_txs=1, measure=False)
+        self.assertEqual(sum(range(20000, 20050)) - txs[0].get_fee(), txs[0].output_value())
+        self.assertNotIn('selection_ms', summary)
+        # signed transactions, while fees are low
+        result = Commands(config, wallet, None).consolidate(imax=10, max_txs=2, create=True)
+        self.assertEqual(2, len(result['transactions']))
+        self.assertTrue(all(item['complete'] for item in result['transactions']))
+        config = SimpleConfig({'electrum_path': self.electrum_path, 'dynamic_fees': False, 'fee_per_kb': 10000})
+        with self.assertRaises(BaseException):
+            Commands(config, wallet, None).consolidate(imax=10, max_txs=1, create=True)
+        result = Commands(config, wallet, None).consolidate(imax=10, max_txs=1, create=True, fee_rate=2000)
+        self.assertEqual(2000, result['fee_rate'])
+
+    def make_wallet(self, num_coins):
+        ks = keystore.from_seed('bitter grass shiver impose acquire brush forget axis eager alone wine silver', '', False)
+        wallet = WalletIntegrityHelper.create_standard_wallet(ks, gap_limit=2)
+        addr0 = wallet.get_receiving_addresses()[0]
+        tx = self.make_funding_tx([(addr0, 20000 + i) for i in range(num_coins)])
+        wallet.receive_tx_callback(tx.txid(), tx, 100)
+        return wallet
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_password_only_needed_to_sign(self, mock_write):
+        wallet = self.make_wallet(5)
+        wallet.update_password(None, 'secret')
+        config = SimpleConfig({'electrum_path': self.electrum_path, 'dynamic_fees': False, 'fee_per_kb': 1000})
+        result = Commands(config, wallet, None).consolidate()
+        self.assertEqual(1, len(result['transactions']))
+        with self.assertRaisesRegex(BaseException, 'Password required'):
+            Commands(config, wallet, None).consolidate(create=True)
+        result = Commands(config, wallet, None).consolidate(create=True, password='secret')
+        self.assertTrue(result['transactions'][0]['complete'])
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_consolidation_thread(self, mock_write):
+        wallet = self.make_wallet(5)
+        config = SimpleConfig({'electrum_path': self.electrum_path, 'dynamic_fees': False,
+                               'fee_per_kb': 1000, 'consolidate_broadcast': True})
+        broadcast = []
+        daemon = mock.Mock()
+        daemon.wallets_lock = threading.RLock()
+        wallet.set_up_to_date(True)
+        daemon.wallets = {'w': wallet}
+        daemon.get_wallet_lock.return_value = threading.Lock()
+        daemon.network.broadcast_transaction = lambda tx: broadcast.append(tx) or (True, tx.txid())
+        thread = ConsolidationThread(daemon, config)
+        thread.running = True
+        thread.consolidate_wallets()
+        self.assertEqual(1, len(broadcast))
+        self.assertTrue(broadcast[0].is_complete())
+        self.assertIn(broadcast[0].txid(), wallet.transactions)
+        self.assertEqual(5, thread.get_stats()['w']['coins'])
+        # the coins are not spent again
+        txs, summary = ConsolidationPlanner(wallet, config).plan(measure=False)
+        self.assertEqual([], txs)
+
+    def run_thread(self, wallet, config):
+        broadcast = []
+        daemon = mock.Mock()
+        daemon.wallets_lock = threading.RLock()
+        wallet.set_up_to_date(True)
+        daemon.wallets = {'w': wallet}
+        daemon.get_wallet_lock.return_value = threading.Lock()
+        daemon.network.broadcast_transaction = lambda tx: broadcast.append(tx) or (True, tx.txid())
+        thread = ConsolidationThread(daemon, config)
+        thread.running = True
+        thread.consolidate_wallets()
+        return thread, broadcast
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_nothing_broadcast_without_saving(self, mock_write):
+        wallet = self.make_wallet(5)
+        # fees will not rise
+        config = SimpleConfig({'electrum_path': self.electrum_path, 'dynamic_fees': False, 'fee_per_kb': 1000,
+                               'consolidate_future_feerate': 1000, 'consolidate_broadcast': True})
+        txs, summary = ConsolidationPlanner(wallet, config).plan(measure=False)
+        self.assertEqual([], txs)
+        self.assertEqual(0, summary['fee_saved'])
+        thread, broadcast = self.run_thread(wallet, config)
+        self.assertEqual([], broadcast)
+        self.assertEqual(0, thread.get_stats()['w']['fee_saved'])
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_hardware_wallet_not_signed_by_thread(self, mock_write):
+        wallet = self.make_wallet(5)
+        config = SimpleConfig({'electrum_path': self.electrum_path, 'dynamic_fees': False,
+                               'fee_per_kb': 1000, 'consolidate_broadcast': True})
+        hw = mock.Mock(spec=keystore.Hardware_KeyStore)
+        with mock.patch.object(wallet, 'get_keystores', return_value=[hw]):
+            thread, broadcast = self.run_thread(wallet, config)
+        self.assertEqual([], broadcast)
+        # the plan is still reported
+        self.assertLess(0, thread.get_stats()['w']['fee_saved'])
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_merged_into_unused_addresses(self, mock_write):
+        wallet = self.make_wallet(40)
+        config = SimpleConfig({'electrum_path': self.electrum_path, 'dynamic_fees': False, 'fee_per_kb': 1000})
+        num_addresses = len(wallet.get_addresses())
+        txs, summary = ConsolidationPlanner(wallet, config).plan(max_inputs=2, measure=False)
+        self.assertEqual(20, len(txs))
+        addresses = [tx.outputs()[0][1] for tx in txs]
+        self.assertEqual(20, len(set(addresses)))
+        self.assertFalse(any(wallet.get_address_history(addr) for addr in addresses))
+        # new change addresses once the unused ones run out
+        self.assertLess(num_addresses, len(wallet.get_addresses()))
+        self.assertTrue(wallet.is_change(addresses[-1]))
+        # they are not used yet, and not created again
+        num_addresses = len(wallet.get_addresses())
+        ConsolidationPlanner(wallet, config).plan(max_inputs=2, measure=False)
+        self.assertEqual(num_addresses, len(wallet.get_addresses()))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_imported_wallet_does_not_reuse_addresses(self, mock_write):
+        wallet = WalletIntegrityHelper.create_imported_wallet(privkeys=True)
+        addr = wallet.import_private_key('p2wpkh:cPuQzcNEgbeYZ5at9VdGkCwkPA9r34gvEVJjuoz384rTfYpahfe7', pw=None)
+        tx = self.make_funding_tx([(addr, 20000 + i) for i in range(5)])
+        wallet.receive_tx_callback(tx.txid(), tx, 100)
+        config = SimpleConfig({'electrum_path': self.electrum_path, 'dynamic_fees': False, 'fee_per_kb': 1000})
+        txs, summary = ConsolidationPlanner(wallet, config).plan(measure=False)
+        self.assertEqual([], txs)
+        self.assertEqual(5, summary['coins_after'])
@@ -0,0 +1,104 @@
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+try:
+    import SimpleWebSocketServer
+except ImportError:
+    SimpleWebSocketServer = None
+
+from lib import storage, keystore, bitcoin
+from lib.simple_config import SimpleConfig
+from lib.transaction import Transaction
+from lib.daemon import RequestIndex
+if SimpleWebSocketServer:
+    from lib.websockets import WsClientThread
+
+from . import TestCaseForTestnet
+from .test_wallet_vertical import WalletIntegrityHelper
+
+
+class MockDaemon:
+
+    def __init__(self, wallet):
+        self.network = None
+        self.wallets_lock = threading.RLock()
+        self.wallets = {}
+        # unloaded from the pool
+        self.unloaded_wallets = {'w': None}
+        self.wallet = wallet
+        self.reloaded = []
+        self.request_index = RequestIndex()
+        self.request_index.add_wallet(wallet)
+
+    def get_wallet(self, path):
+        if path in self.unloaded_wallets:
+            self.unloaded_wallets.pop(path)
+            self.wallets[path] = self.wallet
+            self.reloaded.append(path)
+        return self.wallets.get(path)
+
+
+class MockWebSocket:
+
+    closed = False
+
+    def __init__(self):
+        self.messages = []
+
+    def sendMessage(self, message):
+        self.messages.append(message)
+
+
+@unittest.skipIf(SimpleWebSocketServer is None, 'SimpleWebSocketServer is not installed')
+class TestWsClientThread(TestCaseForTestnet):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.electrum_path = tempfile.mkdtemp()
+        cls.config = SimpleConfig({'electrum_path': cls.electrum_path})
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(cls.electrum_path)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_request_is_paid(self, mock_write):
+        ks = keystore.from_seed('bitter grass shiver impose acquire brush forget axis eager alone wine silver', '', False)
+        wallet = WalletIntegrityHelper.create_standard_wallet(ks, gap_limit=2)
+        wallet.storage.path = 'w'
+        daemon = MockDaemon(wallet)
+        addr = wallet.get_receiving_addresses()[0]
+        req = wallet.make_payment_request(addr, 100000, 'test', 3600)
+        wallet.add_payment_request(req, self.config)
+        self.assertEqual(('w', addr), daemon.request_index.get(req['id']))
+        thread = WsClientThread(self.config, daemon)
+        # unknown requests do not reload wallets
+        thread.subscribe(MockWebSocket(), 'unknown')
+        self.assertEqual([], daemon.reloaded)
+        self.assertEqual({}, dict(thread.subscriptions))
+        # found through the request index, the wallet is reloaded
+        ws = MockWebSocket()
+        thread.subscribe(ws, req['id'])
+        self.assertEqual(['w'], daemon.reloaded)
+        self.assertEqual({addr: {ws: ('w', 100000)}}, dict(thread.subscriptions))
+        self.assertEqual([], ws.messages)
+        # paid
+        script = bitcoin.address_to_script(addr)
+        raw = ('02000000' + '01' + '11' * 32 + '00000000' + '00' + 'ffffffff' + '01'
+               + bitcoin.int_to_hex(100000, 8) + bitcoin.var_int(len(script) // 2) + script + '00000000')
+        tx = Transaction(raw)
+        wallet.receive_tx_callback(tx.txid(), tx, 100)
+        thread.check_address(addr)
+        self.assertEqual(['paid'], ws.messages)
+        self.assertEqual({}, dict(thread.subscriptions))
+        self.assertEqual({}, thread.sockets)
+        # removed requests are not found
+        wallet.remove_payment_request(addr, self.config)
+        self.assertIsNone(daemon.request_index.get(req['id']))
+        thread.subscribe(ws, req['id'])
+        self.assertEqual({}, dict(thread.subscriptions))
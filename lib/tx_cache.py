@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import json
+import threading
+
+from . import util
+from .util import bfh, bh2u
+from .crypto import Hash
+from .transaction import Transaction
+
+
+# default size limit of the cache, in MB
+TX_CACHE_SIZE = 100
+
+
+def is_txid(txid):
+    return isinstance(txid, str) and len(txid) == 64 and all(c in '0123456789abcdef' for c in txid)
+
+
+def raw_tx_hash(raw):
+    '''txid of a serialized transaction, or None if it cannot be parsed'''
+    try:
+        raw_bytes = bfh(raw)
+    except (ValueError, TypeError):
+        return None
+    if raw_bytes[4:6] == b'\x00\x01':
+        # segwit marker and flag: the txid does not commit to the witness
+        try:
+            return Transaction(raw).txid()
+        except BaseException:
+            return None
+    return bh2u(Hash(raw_bytes)[::-1])
+
+
+class TxCache(util.PrintError):
+    '''
+    Raw transactions and confirmed merkle branches, shared by all
+    wallets. Files are stored under the config directory and evicted
+    least recently used first once the cache exceeds its size limit.
+    Transactions are only added if their hash matches the txid;
+    merkle branches should only be added once verified.
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.root = os.path.join(config.path, 'tx_cache')
+        self.lock = threading.Lock()
+        self.max_size = int(config.get('tx_cache_size', TX_CACHE_SIZE) * 1000000)
+        self.size = None  # computed lazily
+
+    def _path(self, kind, name):
+        return os.path.join(self.root, kind, name[0:2], name)
+
+    def _merkle_path(self, txid, height):
+        return self._path('merkle', '%s_%d' % (txid, height))
+
+    def _files(self):
+        for kind in ['tx', 'merkle']:
+            d = os.path.join(self.root, kind)
+            if not os.path.exists(d):
+                continue
+            for shard in os.listdir(d):
+                sd = os.path.join(d, shard)
+                for name in os.listdir(sd):
+                    yield os.path.join(sd, name)
+
+    def _get_size(self):
+        if self.size is None:
+            self.size = 0
+            for path in self._files():
+                try:
+                    self.size += os.path.getsize(path)
+                except OSError:
+                    pass
+        return self.size
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def _write(self, path, data):
+        with self.lock:
+            if os.path.exists(path):
+                return
+            size = self._get_size()
+            if size + len(data) > self.max_size:
+                self._evict(self.max_size * 9 // 10 - len(data))
+            util.make_dir(self.root)
+            util.make_dir(os.path.dirname(os.path.dirname(path)))
+            util.make_dir(os.path.dirname(path))
+            temp_path = "%s.tmp.%s" % (path, os.getpid())
+            try:
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+            except OSError as e:
+                self.print_error("cannot write", path, e)
+                return
+            self.size += len(data)
+
+    def _remove(self, path):
+        with self.lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                return False
+            if self.size is not None:
+                self.size -= size
+            return True
+
+    def _evict(self, target):
+        items = []
+        for path in self._files():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            items.append((st.st_mtime, st.st_size, path))
+        items.sort()
+        for mtime, size, path in items:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+        self.print_error("evicted; size is now", self.size)
+
+    def get_tx(self, txid):
+        if not is_txid(txid):
+            return None
+        data = self._read(self._path('tx', txid))
+        if data is None:
+            return None
+        raw = bh2u(data)
+        if raw_tx_hash(raw) != txid:
+            self.print_error("removing corrupted entry", txid)
+            self._remove(self._path('tx', txid))
+            return None
+        return raw
+
+    def add_tx(self, txid, raw):
+        if not is_txid(txid) or raw_tx_hash(raw) != txid:
+            self.print_error("hash mismatch, not caching", txid)
+            return False
+        self._write(self._path('tx', txid), bfh(raw))
+        return True
+
+    def get_merkle(self, txid, height):
+        if not is_txid(txid) or type(height) is not int:
+            return None
+        data = self._read(self._merkle_path(txid, height))
+        if data is None:
+            return None
+        try:
+            return json.loads(data.decode('utf8'))
+        except ValueError:
+            return None
+
+    def add_merkle(self, txid, height, merkle):
+        if not is_txid(txid) or type(height) is not int:
+            return
+        data = json.dumps(merkle).encode('utf8')
+        self._write(self._merkle_path(txid, height), data)
+
+    def remove_merkle(self, txid, height):
+        if not is_txid(txid) or type(height) is not int:
+            return False
+        return self._remove(self._merkle_path(txid, height))
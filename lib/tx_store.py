@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2018 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import threading
+import time
+import weakref
+
+from . import util
+
+
+# a transaction request is sent again if it has been waiting that long
+REQUEST_TIMEOUT = 60
+
+
+class TxStore(util.PrintError):
+    '''
+    Transactions held by the wallets of a daemon. The store keeps weak
+    references: a transaction is dropped once no wallet references it.
+    Wallets that have the same transaction share a single parsed
+    Transaction object, and concurrent requests for a transaction are
+    sent only once to the server.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.transactions = weakref.WeakValueDictionary()
+        self.requests = {}  # tx_hash -> (time sent, list of callbacks)
+        self.stats = {'shared': 0, 'requests_saved': 0}
+
+    def get(self, tx_hash):
+        return self.transactions.get(tx_hash)
+
+    def add(self, tx_hash, tx):
+        '''Returns the transaction already in the store, if any,
+        otherwise tx.'''
+        with self.lock:
+            existing = self.transactions.get(tx_hash)
+            if existing is not None:
+                if existing is not tx:
+                    self.stats['shared'] += 1
+                return existing
+            self.transactions[tx_hash] = tx
+            return tx
+
+    def get_transactions(self, network, tx_hashes, callback):
+        '''Request raw transactions, unless they are already requested.
+        callback is called with the response, like Network.get_transactions.'''
+        now = time.time()
+        to_send = []
+        with self.lock:
+            for tx_hash in tx_hashes:
+                request = self.requests.get(tx_hash)
+                if request and now - request[0] < REQUEST_TIMEOUT:
+                    request[1].append(callback)
+                    self.stats['requests_saved'] += 1
+                else:
+                    callbacks = request[1] if request else []
+                    callbacks.append(callback)
+                    self.requests[tx_hash] = (now, callbacks)
+                    to_send.append(tx_hash)
+        if to_send:
+            network.get_transactions(to_send, self.on_tx_response)
+
+    def on_tx_response(self, response):
+        params = response.get('params')
+        if not params:
+            return
+        with self.lock:
+            request = self.requests.pop(params[0], None)
+        if request is None:
+            return
+        for callback in request[1]:
+            callback(response)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['transactions'] = len(self.transactions)
+            stats['requests'] = len(self.requests)
+        return stats
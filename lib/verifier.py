@@ -20,14 +20,63 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import heapq
+import threading
+import time
+
 from .util import ThreadJob, bh2u
 from .bitcoin import Hash, hash_decode, hash_encode
-from .transaction import Transaction
+from .transaction import Transaction, PARTIAL_TXN_HEADER_MAGIC
+
+
+# maximum number of merkle requests sent per batch
+MERKLE_BATCH_SIZE = 100
+# maximum number of merkle requests in flight
+MAX_MERKLE_REQUESTS = 500
+# verified txs are written to the wallet file at most this often (seconds),
+# unless the wallet and the verifier are both up to date
+SAVE_INTERVAL = 30
 
 
 class InnerNodeOfSpvProofIsValidTx(Exception): pass
 
 
+def read_compact_size(raw: bytes, pos: int):
+    '''Returns (size, position after it), or None past the end'''
+    if pos >= len(raw):
+        return None
+    size = raw[pos]
+    n = {253: 2, 254: 4, 255: 8}.get(size, 0)
+    if n == 0:
+        return size, pos + 1
+    if pos + 1 + n > len(raw):
+        return None
+    return int.from_bytes(raw[pos+1:pos+1+n], 'little'), pos + 1 + n
+
+
+def could_be_tx(raw: bytes) -> bool:
+    '''Fast structural check, mirroring transaction.deserialize.
+    Returns False only if deserialize would certainly fail on raw.'''
+    if raw[:5] == PARTIAL_TXN_HEADER_MAGIC:
+        return True
+    # version, then the number of inputs
+    r = read_compact_size(raw, 4)
+    if r is None:
+        return False
+    n_vin, pos = r
+    if n_vin == 0:
+        # segwit marker
+        if raw[pos:pos+1] != b'\x01':
+            return False
+        r = read_compact_size(raw, pos + 1)
+        if r is None:
+            return False
+        n_vin, pos = r
+    # each input takes at least 41 bytes, then come the number
+    # of outputs (at least 1 byte) and the locktime (4 bytes)
+    return pos + 41 * n_vin + 5 <= len(raw)
+
+
 class SPV(ThreadJob):
     """ Simple Payment Verification """
 
@@ -37,6 +86,21 @@ class SPV(ThreadJob):
         self.blockchain = network.blockchain()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        # unverified txs, as a heap of (height, txid); entries that no
+        # longer match wallet.unverified_tx are dropped when popped
+        self.lock = threading.Lock()
+        self.queue = []
+        self.waiting_headers = {}  # chunk index -> list of (height, txid)
+        self.save_needed = False
+        self.save_time = time.time()
+        for tx_hash, tx_height in wallet.get_unverified_txs().items():
+            self.add_unverified_tx(tx_hash, tx_height)
+
+    def add_unverified_tx(self, tx_hash, tx_height):
+        if tx_height <= 0:
+            return
+        with self.lock:
+            heapq.heappush(self.queue, (tx_height, tx_hash))
 
     def run(self):
         interface = self.network.interface
@@ -45,30 +109,57 @@ class SPV(ThreadJob):
         blockchain = interface.blockchain
         if not blockchain:
             return
+        if self.network.blockchain() != self.blockchain:
+            self.blockchain = self.network.blockchain()
+            self.undo_verifications()
+        self.check_waiting_headers(blockchain)
         lh = self.network.get_local_height()
-        unverified = self.wallet.get_unverified_txs()
-        for tx_hash, tx_height in unverified.items():
+        unverified = self.wallet.unverified_tx
+        batch = []
+        with self.lock:
             # do not request merkle branch before headers are available
-            if (tx_height > 0) and (tx_height <= lh):
-                header = blockchain.read_header(tx_height)
-                if header is None:
+            while (self.queue and self.queue[0][0] <= lh
+                   and len(batch) < MERKLE_BATCH_SIZE
+                   and len(self.requested_merkle) < MAX_MERKLE_REQUESTS):
+                tx_height, tx_hash = heapq.heappop(self.queue)
+                if (unverified.get(tx_hash) != tx_height
+                        or tx_hash in self.requested_merkle
+                        or tx_hash in self.merkle_roots):
+                    continue
+                if blockchain.read_header(tx_height) is None:
                     index = tx_height // 2016
                     if index < len(blockchain.checkpoints):
                         self.network.request_chunk(interface, index)
-                else:
-                    if (tx_hash not in self.requested_merkle
-                            and tx_hash not in self.merkle_roots):
+                    self.waiting_headers.setdefault(index, []).append((tx_height, tx_hash))
+                    continue
+                batch.append((tx_hash, tx_height))
+                self.requested_merkle.add(tx_hash)
+        if batch:
+            command = 'blockchain.transaction.get_merkle'
+            self.network.send([(command, [tx_hash, tx_height]) for tx_hash, tx_height in batch],
+                              self.verify_merkle)
+            self.print_error('requested merkle for %d txs' % len(batch))
+        self.maybe_save()
 
-                        self.network.get_merkle_for_transaction(
-                                tx_hash,
-                                tx_height,
-                                self.verify_merkle)
-                        self.print_error('requested merkle', tx_hash)
-                        self.requested_merkle.add(tx_hash)
+    def check_waiting_headers(self, blockchain):
+        with self.lock:
+            for index in list(self.waiting_headers.keys()):
+                items = self.waiting_headers[index]
+                if blockchain.read_header(items[0][0]) is None:
+                    continue
+                del self.waiting_headers[index]
+                for item in items:
+                    heapq.heappush(self.queue, item)
 
-        if self.network.blockchain() != self.blockchain:
-            self.blockchain = self.network.blockchain()
-            self.undo_verifications()
+    def maybe_save(self):
+        if not self.save_needed:
+            return
+        if (not (self.is_up_to_date() and self.wallet.is_up_to_date())
+                and time.time() - self.save_time < SAVE_INTERVAL):
+            return
+        self.save_needed = False
+        self.save_time = time.time()
+        self.wallet.save_verified_tx(write=True)
 
     def verify_merkle(self, r):
         if self.wallet.verifier is None:
@@ -102,9 +193,14 @@ class SPV(ThreadJob):
             self.print_error(
                 "merkle verification failed for {} (merkle root mismatch {} != {})"
                 .format(tx_hash, header.get('merkle_root'), merkle_root))
+            if self.network.tx_cache.remove_merkle(tx_hash, params[1]):
+                # stale cached branch; request it again from the server
+                self.requested_merkle.discard(tx_hash)
+                self.add_unverified_tx(tx_hash, params[1])
             return
         # we passed all the tests
         self.merkle_roots[tx_hash] = merkle_root
+        self.network.tx_cache.add_merkle(tx_hash, params[1], merkle)
         try:
             # note: we could pop in the beginning, but then we would request
             # this proof again in case of verification failure from the same server
@@ -112,8 +208,7 @@ class SPV(ThreadJob):
         except KeyError: pass
         self.print_error("verified %s" % tx_hash)
         self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
-        if self.is_up_to_date() and self.wallet.is_up_to_date():
-            self.wallet.save_verified_tx(write=True)
+        self.save_needed = True
 
     @classmethod
     def hash_merkle_root(cls, merkle_s, target_hash, pos):
@@ -121,7 +216,8 @@ class SPV(ThreadJob):
         for i in range(len(merkle_s)):
             item = merkle_s[i]
             h = Hash(hash_decode(item) + h) if ((pos >> i) & 1) else Hash(h + hash_decode(item))
-            cls._raise_if_valid_tx(bh2u(h))
+            if could_be_tx(h):
+                cls._raise_if_valid_tx(bh2u(h))
         return hash_encode(h)
 
     @classmethod
@@ -153,4 +249,7 @@ class SPV(ThreadJob):
             pass
 
     def is_up_to_date(self):
-        return not self.requested_merkle
+        lh = self.network.get_local_height()
+        with self.lock:
+            return (not self.requested_merkle
+                    and not (self.queue and self.queue[0][0] <= lh))
@@ -194,6 +194,14 @@ class Abstract_Wallet(PrintError):
         # locks: if you need to take multiple ones, acquire them in the order they are defined here!
         self.lock = threading.RLock()
         self.transaction_lock = threading.RLock()
+        # address -> [(txid, value)] received, for payment requests.
+        # Access with self.lock and self.transaction_lock
+        self.received_index = {}
+        # sorted lists kept between the pages of commands, until the
+        # history or the payment requests change. Access with views_lock
+        self.views_lock = threading.Lock()
+        self.views = {}
+        self.views_version = 0
 
         # saved fields
         self.use_change            = storage.get('use_change', True)
@@ -203,6 +211,10 @@ class Abstract_Wallet(PrintError):
         self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
         self.fiat_value            = storage.get('fiat_value', {})
         self.receive_requests      = storage.get('payment_requests', {})
+        # request id -> address
+        self.request_ids = {r.get('id', addr): addr for addr, r in self.receive_requests.items()}
+        # the request index of the daemon, kept up to date if set
+        self.request_index = None
 
         # Verified transactions.  txid -> (height, timestamp, block_pos).  Access with self.lock.
         self.verified_tx = storage.get('verified_tx3', {})
@@ -315,6 +327,7 @@ class Abstract_Wallet(PrintError):
                 self.verified_tx = {}
                 self.transactions = {}
                 self.save_transactions()
+        self.invalidate_views()
 
     @profiler
     def check_history(self):
@@ -377,7 +390,17 @@ class Abstract_Wallet(PrintError):
     def is_up_to_date(self):
         with self.lock: return self.up_to_date
 
+    def get_sync_progress(self):
+        synchronizer = self.synchronizer
+        return synchronizer.get_progress() if synchronizer else None
+
     def set_label(self, name, text = None):
+        changed = self._set_label(name, text)
+        if changed:
+            self.storage.put('labels', self.labels)
+        return changed
+
+    def _set_label(self, name, text):
         changed = False
         old_text = self.labels.get(name)
         if text:
@@ -391,7 +414,6 @@ class Abstract_Wallet(PrintError):
                 changed = True
         if changed:
             run_hook('set_label', self, name, text)
-            self.storage.put('labels', self.labels)
         return changed
 
     def set_fiat_value(self, txid, ccy, text):
@@ -459,12 +481,16 @@ class Abstract_Wallet(PrintError):
         if tx_hash not in self.verified_tx:
             with self.lock:
                 self.unverified_tx[tx_hash] = tx_height
+            if self.verifier:
+                self.verifier.add_unverified_tx(tx_hash, tx_height)
+        self.invalidate_views()
 
     def add_verified_tx(self, tx_hash, info):
         # Remove from the unverified map and add to the verified map
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+        self.invalidate_views()
         height, conf, timestamp = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', tx_hash, height, conf, timestamp)
 
@@ -485,6 +511,8 @@ class Abstract_Wallet(PrintError):
                     if not header or header.get('timestamp') != timestamp:
                         self.verified_tx.pop(tx_hash, None)
                         txs.add(tx_hash)
+        if txs:
+            self.invalidate_views()
         return txs
 
     def get_local_height(self):
@@ -517,6 +545,24 @@ class Abstract_Wallet(PrintError):
             else:
                 return (1e9+1, 0)
 
+    def get_view(self, name, build):
+        '''Returns build(), computed again only after the history or the
+        payment requests of the wallet changed, or a new block'''
+        key = (self.views_version, self.get_local_height())
+        with self.views_lock:
+            item = self.views.get(name)
+        if item is not None and item[0] == key:
+            return item[1]
+        value = build()
+        with self.views_lock:
+            self.views[name] = (key, value)
+        return value
+
+    def invalidate_views(self):
+        with self.views_lock:
+            self.views_version += 1
+            self.views = {}
+
     def is_found(self):
         return self.history.values() != [[]] * len(self.history)
 
@@ -903,6 +949,8 @@ class Abstract_Wallet(PrintError):
                 self.spent_outpoints[prevout_hash][prevout_n] = tx_hash
                 add_value_from_prev_output()
             # add outputs
+            for addr in self.txo.get(tx_hash, {}):
+                self.received_index.pop(addr, None)
             self.txo[tx_hash] = d = {}
             for n, txo in enumerate(tx.outputs()):
                 v = txo[2]
@@ -912,6 +960,7 @@ class Abstract_Wallet(PrintError):
                     if d.get(addr) is None:
                         d[addr] = []
                     d[addr].append((n, v, is_coinbase))
+                    self.received_index.pop(addr, None)
                     # give v to txi that spends me
                     next_tx = self.spent_outpoints[tx_hash].get(n)
                     if next_tx is not None:
@@ -925,6 +974,7 @@ class Abstract_Wallet(PrintError):
             self._add_tx_to_local_history(tx_hash)
             # save
             self.transactions[tx_hash] = tx
+            self.invalidate_views()
             return True
 
     def remove_transaction(self, tx_hash):
@@ -958,7 +1008,9 @@ class Abstract_Wallet(PrintError):
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
             self.txi.pop(tx_hash, None)
-            self.txo.pop(tx_hash, None)
+            for addr in self.txo.pop(tx_hash, {}):
+                self.received_index.pop(addr, None)
+            self.invalidate_views()
 
     def receive_tx_callback(self, tx_hash, tx, tx_height):
         self.add_unverified_tx(tx_hash, tx_height)
@@ -975,6 +1027,9 @@ class Abstract_Wallet(PrintError):
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
             self.history[addr] = hist
+            with self.transaction_lock:
+                self.received_index.pop(addr, None)
+        self.invalidate_views()
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -1041,6 +1096,36 @@ class Abstract_Wallet(PrintError):
         # return last balance
         return balance
 
+    def get_history_item(self, tx_hash, height, conf, timestamp, value, balance, fx=None, show_addresses=False):
+        from .util import timestamp_to_datetime, Satoshis, Fiat
+        item = {
+            'txid':tx_hash,
+            'height':height,
+            'confirmations':conf,
+            'timestamp':timestamp,
+            'value': Satoshis(value),
+            'balance': Satoshis(balance)
+        }
+        item['date'] = timestamp_to_datetime(timestamp)
+        item['label'] = self.get_label(tx_hash)
+        if show_addresses:
+            tx = self.transactions.get(tx_hash)
+            item['inputs'] = list(map(lambda x: dict((k, x[k]) for k in ('prevout_hash', 'prevout_n')), tx.inputs()))
+            item['outputs'] = list(map(lambda x:{'address':x[0], 'value':Satoshis(x[1])}, tx.get_outputs()))
+        # fiat computations
+        if value is not None and fx and fx.is_enabled():
+            fiat_value = self.get_fiat_value(tx_hash, fx.ccy)
+            fiat_default = fiat_value is None
+            fiat_value = fiat_value if fiat_value is not None else value / Decimal(COIN) * self.price_at_timestamp(tx_hash, fx.timestamp_rate)
+            item['fiat_value'] = Fiat(fiat_value, fx.ccy)
+            item['fiat_default'] = fiat_default
+            if value < 0:
+                acquisition_price = - value / Decimal(COIN) * self.average_price(tx_hash, fx.timestamp_rate, fx.ccy)
+                liquidation_price = - fiat_value
+                item['acquisition_price'] = Fiat(acquisition_price, fx.ccy)
+                item['capital_gain'] = Fiat(liquidation_price - acquisition_price, fx.ccy)
+        return item
+
     @profiler
     def get_full_history(self, domain=None, from_timestamp=None, to_timestamp=None, fx=None, show_addresses=False):
         from .util import timestamp_to_datetime, Satoshis, Fiat
@@ -1056,43 +1141,19 @@ class Abstract_Wallet(PrintError):
                 continue
             if to_timestamp and (timestamp or time.time()) >= to_timestamp:
                 continue
-            item = {
-                'txid':tx_hash,
-                'height':height,
-                'confirmations':conf,
-                'timestamp':timestamp,
-                'value': Satoshis(value),
-                'balance': Satoshis(balance)
-            }
-            item['date'] = timestamp_to_datetime(timestamp)
-            item['label'] = self.get_label(tx_hash)
-            if show_addresses:
-                tx = self.transactions.get(tx_hash)
-                item['inputs'] = list(map(lambda x: dict((k, x[k]) for k in ('prevout_hash', 'prevout_n')), tx.inputs()))
-                item['outputs'] = list(map(lambda x:{'address':x[0], 'value':Satoshis(x[1])}, tx.get_outputs()))
             # value may be None if wallet is not fully synchronized
             if value is None:
                 continue
+            item = self.get_history_item(tx_hash, height, conf, timestamp, value, balance, fx, show_addresses)
             # fixme: use in and out values
             if value < 0:
                 expenditures += -value
             else:
                 income += value
-            # fiat computations
             if fx and fx.is_enabled():
-                date = timestamp_to_datetime(timestamp)
-                fiat_value = self.get_fiat_value(tx_hash, fx.ccy)
-                fiat_default = fiat_value is None
-                fiat_value = fiat_value if fiat_value is not None else value / Decimal(COIN) * self.price_at_timestamp(tx_hash, fx.timestamp_rate)
-                item['fiat_value'] = Fiat(fiat_value, fx.ccy)
-                item['fiat_default'] = fiat_default
+                fiat_value = item['fiat_value'].value
                 if value < 0:
-                    acquisition_price = - value / Decimal(COIN) * self.average_price(tx_hash, fx.timestamp_rate, fx.ccy)
-                    liquidation_price = - fiat_value
-                    item['acquisition_price'] = Fiat(acquisition_price, fx.ccy)
-                    cg = liquidation_price - acquisition_price
-                    item['capital_gain'] = Fiat(cg, fx.ccy)
-                    capital_gains += cg
+                    capital_gains += item['capital_gain'].value
                     fiat_expenditures += -fiat_value
                 else:
                     fiat_income += fiat_value
@@ -1301,6 +1362,10 @@ class Abstract_Wallet(PrintError):
     def start_threads(self, network):
         self.network = network
         if self.network is not None:
+            # share transactions with the other wallets of the daemon
+            with self.transaction_lock:
+                for tx_hash, tx in list(self.transactions.items()):
+                    self.transactions[tx_hash] = network.tx_store.add(tx_hash, tx)
             self.verifier = SPV(self.network, self)
             self.synchronizer = Synchronizer(self, network)
             network.add_jobs([self.verifier, self.synchronizer])
@@ -1538,13 +1603,21 @@ class Abstract_Wallet(PrintError):
                     choice = addr
         return choice
 
+    def get_addr_received(self, address):
+        '''Outputs received by address, as a list of (txid, value).
+        Kept in received_index until the history or outputs of address change.'''
+        with self.lock, self.transaction_lock:
+            r = self.received_index.get(address)
+            if r is None:
+                received, sent = self.get_addr_io(address)
+                r = [(txo.split(':')[0], v) for txo, (h, v, is_cb) in received.items()]
+                self.received_index[address] = r
+            return r
+
     def get_payment_status(self, address, amount):
         local_height = self.get_local_height()
-        received, sent = self.get_addr_io(address)
         l = []
-        for txo, x in received.items():
-            h, v, is_cb = x
-            txid, n = txo.split(':')
+        for txid, v in self.get_addr_received(address):
             info = self.verified_tx.get(txid)
             if info:
                 tx_height, timestamp, pos = info
@@ -1639,18 +1712,41 @@ class Abstract_Wallet(PrintError):
         self.storage.put('payment_requests', self.receive_requests)
 
     def add_payment_request(self, req, config):
-        addr = req['address']
-        if not bitcoin.is_address(addr):
-            raise Exception(_('Invalid Bitcoin address.'))
-        if not self.is_mine(addr):
-            raise Exception(_('Address not in wallet.'))
-
-        amount = req.get('amount')
-        message = req.get('memo')
-        self.receive_requests[addr] = req
+        return self.add_payment_requests([req], config)[0]
+
+    def add_payment_requests(self, reqs, config, write_files=True):
+        '''Add payment requests, saving them once. Files are written to
+        requests_dir if write_files is True.'''
+        for req in reqs:
+            addr = req['address']
+            if not bitcoin.is_address(addr):
+                raise Exception(_('Invalid Bitcoin address.'))
+            if not self.is_mine(addr):
+                raise Exception(_('Address not in wallet.'))
+        labels_changed = False
+        for req in reqs:
+            addr = req['address']
+            old = self.receive_requests.get(addr)
+            if old:
+                self.request_ids.pop(old.get('id', addr), None)
+                if self.request_index is not None:
+                    self.request_index.remove(old.get('id', addr))
+            self.receive_requests[addr] = req
+            self.request_ids[req.get('id', addr)] = addr
+            if self.request_index is not None:
+                self.request_index.add(req.get('id', addr), self.storage.path, addr)
+            labels_changed |= self._set_label(addr, req.get('memo')) # should be a default label
         self.storage.put('payment_requests', self.receive_requests)
-        self.set_label(addr, message) # should be a default label
+        self.invalidate_views()
+        if labels_changed:
+            self.storage.put('labels', self.labels)
+        if write_files:
+            reqs = [self.write_payment_request_files(req, config) for req in reqs]
+        return reqs
 
+    def write_payment_request_files(self, req, config):
+        addr = req['address']
+        amount = req.get('amount')
         rdir = config.get('requests_dir')
         if rdir and amount is not None:
             key = req.get('id', addr)
@@ -1674,6 +1770,9 @@ class Abstract_Wallet(PrintError):
         if addr not in self.receive_requests:
             return False
         r = self.receive_requests.pop(addr)
+        self.request_ids.pop(r.get('id', addr), None)
+        if self.request_index is not None:
+            self.request_index.remove(r.get('id', addr))
         rdir = config.get('requests_dir')
         if rdir:
             key = r.get('id', addr)
@@ -1682,9 +1781,13 @@ class Abstract_Wallet(PrintError):
                 if os.path.exists(n):
                     os.unlink(n)
         self.storage.put('payment_requests', self.receive_requests)
+        self.invalidate_views()
         return True
 
-    def get_sorted_requests(self, config):
+    def get_request_address(self, request_id):
+        return self.request_ids.get(request_id)
+
+    def get_sorted_request_keys(self):
         def f(addr):
             try:
                 return self.get_address_index(addr)
@@ -1692,7 +1795,10 @@ class Abstract_Wallet(PrintError):
                 return
         keys = map(lambda x: (f(x), x), self.receive_requests.keys())
         sorted_keys = sorted(filter(lambda x: x[0] is not None, keys))
-        return [self.get_payment_request(x[1], config) for x in sorted_keys]
+        return [x[1] for x in sorted_keys]
+
+    def get_sorted_requests(self, config):
+        return [self.get_payment_request(key, config) for key in self.get_sorted_request_keys()]
 
     def get_fingerprint(self):
         raise NotImplementedError()
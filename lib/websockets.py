@@ -23,7 +23,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import queue
-import threading, os, json
+import threading
 from collections import defaultdict
 try:
     from SimpleWebSocketServer import WebSocket, SimpleSSLWebSocketServer
@@ -32,7 +32,6 @@ except ImportError:
     sys.exit("install SimpleWebSocketServer")
 
 from . import util
-from . import bitcoin
 
 request_queue = queue.Queue()
 
@@ -42,92 +41,109 @@ class ElectrumWebSocket(WebSocket):
         assert self.data[0:3] == 'id:'
         util.print_error("message received", self.data)
         request_id = self.data[3:]
-        request_queue.put((self, request_id))
+        request_queue.put(('request', self, request_id))
 
     def handleConnected(self):
         util.print_error("connected", self.address)
 
     def handleClose(self):
         util.print_error("closed", self.address)
+        request_queue.put(('close', self, None))
 
 
 
 class WsClientThread(util.DaemonThread):
+    '''Tells payment pages when their request is paid. Requests are looked
+    up in the request index of the daemon, and their status is evaluated from
+    wallet state when a transaction pays to their address.'''
 
-    def __init__(self, config, network):
+    def __init__(self, config, daemon):
         util.DaemonThread.__init__(self)
-        self.network = network
+        self.daemon = daemon
+        self.network = daemon.network
         self.config = config
-        self.response_queue = queue.Queue()
-        self.subscriptions = defaultdict(list)
-
-    def make_request(self, request_id):
-        # read json file
-        rdir = self.config.get('requests_dir')
-        n = os.path.join(rdir, 'req', request_id[0], request_id[1], request_id, request_id + '.json')
-        with open(n, encoding='utf-8') as f:
-            s = f.read()
-        d = json.loads(s)
-        addr = d.get('address')
-        amount = d.get('amount')
-        return addr, amount
-
-    def reading_thread(self):
-        while self.is_running():
-            try:
-                ws, request_id = request_queue.get()
-            except queue.Empty:
-                continue
-            try:
-                addr, amount = self.make_request(request_id)
-            except:
+        self.subscriptions = defaultdict(dict)  # address -> {ws: (wallet path, amount)}
+        self.sockets = {}  # ws -> address
+
+    def find_request(self, request_id):
+        # through the request index of the daemon; only the wallet of
+        # the request is reloaded, if it was unloaded from the pool
+        item = self.daemon.request_index.get(request_id)
+        if item is None:
+            return None, None, None
+        path, addr = item
+        wallet = self.daemon.get_wallet(path)
+        if wallet is None:
+            return None, None, None
+        r = wallet.receive_requests.get(addr)
+        if not r or r.get('id', addr) != request_id:
+            return None, None, None
+        return path, addr, r.get('amount')
+
+    def subscribe(self, ws, request_id):
+        path, addr, amount = self.find_request(request_id)
+        if path is None or not amount:
+            return
+        self.unsubscribe(ws)
+        self.subscriptions[addr][ws] = (path, amount)
+        self.sockets[ws] = addr
+        self.check_address(addr)
+
+    def unsubscribe(self, ws):
+        addr = self.sockets.pop(ws, None)
+        if addr is None:
+            return
+        l = self.subscriptions[addr]
+        l.pop(ws, None)
+        if not l:
+            self.subscriptions.pop(addr)
+
+    def check_address(self, addr):
+        for ws, (path, amount) in list(self.subscriptions.get(addr, {}).items()):
+            if ws.closed:
+                self.unsubscribe(ws)
                 continue
-            l = self.subscriptions.get(addr, [])
-            l.append((ws, amount))
-            self.subscriptions[addr] = l
-            self.network.subscribe_to_addresses([addr], self.response_queue.put)
+            wallet = self.daemon.get_wallet(path)
+            if wallet is None:
+                # closed
+                self.unsubscribe(ws)
+            elif wallet.get_payment_status(addr, amount)[0]:
+                ws.sendMessage('paid')
+                self.unsubscribe(ws)
+
+    def on_new_transaction(self, event, tx):
+        request_queue.put(('tx', None, tx))
 
     def run(self):
-        threading.Thread(target=self.reading_thread).start()
+        self.network.register_callback(self.on_new_transaction, ['new_transaction'])
         while self.is_running():
             try:
-                r = self.response_queue.get(timeout=0.1)
+                kind, ws, data = request_queue.get(timeout=0.1)
             except queue.Empty:
                 continue
-            util.print_error('response', r)
-            method = r.get('method')
-            result = r.get('result')
-            if result is None:
-                continue    
-            if method == 'blockchain.scripthash.subscribe':
-                addr = r.get('params')[0]
-                scripthash = bitcoin.address_to_scripthash(addr)
-                self.network.get_balance_for_scripthash(
-                        scripthash, self.response_queue.put)
-            elif method == 'blockchain.scripthash.get_balance':
-                scripthash = r.get('params')[0]
-                addr = self.network.h2addr.get(scripthash, None)
-                if addr is None:
-                    util.print_error(
-                        "can't find address for scripthash: %s" % scripthash)
-                l = self.subscriptions.get(addr, [])
-                for ws, amount in l:
-                    if not ws.closed:
-                        if sum(result.values()) >=amount:
-                            ws.sendMessage('paid')
+            if kind == 'request':
+                self.subscribe(ws, data)
+            elif kind == 'close':
+                self.unsubscribe(ws)
+            elif kind == 'tx':
+                for addr, v in data.get_outputs():
+                    if addr in self.subscriptions:
+                        self.check_address(addr)
+        self.network.unregister_callback(self.on_new_transaction)
+        self.on_stop()
 
 
 
 class WebSocketServer(threading.Thread):
 
-    def __init__(self, config, ns):
+    def __init__(self, config, daemon):
         threading.Thread.__init__(self)
         self.config = config
-        self.net_server = ns
+        self.electrum_daemon = daemon
         self.daemon = True
 
     def run(self):
-        t = WsClientThread(self.config, self.net_server)
+        t = WsClientThread(self.config, self.electrum_daemon)
         t.start()
 
         host = self.config.get('websocket_server')
@@ -136,5 +152,3 @@ class WebSocketServer(threading.Thread):
         keyfile = self.config.get('ssl_privkey')
         self.server = SimpleSSLWebSocketServer(host, port, ElectrumWebSocket, certfile, keyfile)
         self.server.serveforever()
-
-